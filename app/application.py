@@ -1,10 +1,18 @@
-from ExpressIntegrations.Utils import Utils
-from fastapi import FastAPI
+import time
+
+import anyio
+from dependency_injector import providers
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from google.cloud import firestore
 
-from . import endpoints, functions
+from . import capture, endpoints, functions, ledger, services
 from .containers import Container
+from .credentials import CredentialRefresher
+from .services import LazyLogger
+
+log_name = 'intellifi.application'
+logger = LazyLogger(log_name)
 
 origins = [
     "https://intelifi-5653905.hs-sites.com",
@@ -16,57 +24,48 @@ origins = [
 
 
 def create_app(env: str = 'prod') -> FastAPI:
+    started = time.perf_counter()
     container = Container()
-    # Load the config variables
-    container.config.from_yaml(f'etc/config-{env}.yaml')
+    # Load the config variables and credentials, then keep them fresh in the background
+    credential_refresher = CredentialRefresher(container=container, config_path=f'etc/config-{env}.yaml')
+    credential_refresher.refresh()
 
-    db = firestore.Client()
+    def reset_clients():
+        # gRPC clients created before a fork are not reused by the workers
+        container.firestore_client.reset()
+        LazyLogger.reset()
 
-    # Set the Emerge properties
-    auth_doc = (
-        db
-        .collection(container.config.get('emerge.firestore.collection'))
-        .document(container.config.get('emerge.firestore.auth_document'))
-    )
-    auth = auth_doc.get().to_dict()
-    container.config.emerge.access_token.from_value(
-        auth[container.config.get('emerge.firestore.access_token.location')]
-    )
+    build_started = time.perf_counter()
+    # the reset runs before build_app's own startup handlers build the buffer and other singletons
+    app = build_app(container, startup=[reset_clients, credential_refresher.start])
+    timings = {
+        **credential_refresher.timings,
+        'build_app': round(time.perf_counter() - build_started, 3),
+        'total': round(time.perf_counter() - started, 3)
+    }
+    logger.log_text(f"Created the app in {timings['total']}s: {timings}", severity='INFO')
+    if container.config.get('warmup.on_startup'):
+        # runs in each worker, since the caches are per process
+        async def warm_up():
+            try:
+                await run_in_threadpool(functions.warm_up)
+            except Exception as e:
+                logger.log_text(f"Warm-up failed: {str(e)}", severity='WARNING')
 
-    # Set the HubSpot properties
-    auth_doc = (
-        db
-        .collection(container.config.get('hubspot.firestore.collection'))
-        .document(container.config.get('hubspot.firestore.auth_document'))
-    )
-    auth = auth_doc.get().to_dict()
-    container.config.hubspot.access_token.from_value(auth['access_token'])
-    container.config.hubspot.expires_at.from_value(auth['expires_at'])
-    container.config.hubspot.refresh_token.from_value(auth['refresh_token'])
-
-    # Get the HubSpot client secret
-    container.config.hubspot.client_secret.from_value(
-        Utils.access_secret_version(
-            container.config.get('gcloud.project'),
-            container.config.get('hubspot.client_secret.location'),
-            container.config.get('hubspot.client_secret.version')
-        )
-    )
+        app.add_event_handler('startup', warm_up)
+    app.add_event_handler('shutdown', credential_refresher.stop)
+    return app
 
-    # Get the Pandadoc api key
-    container.config.pandadoc.api_key.from_value(
-        Utils.access_secret_version(
-            container.config.get('gcloud.project'),
-            container.config.get('pandadoc.api_key_secret.location'),
-            container.config.get('pandadoc.api_key_secret.version')
-        )
-    )
 
+def build_app(container: Container, startup: list = tuple()) -> FastAPI:
     # Wire up the endpoints for dependency injection
     container.wire(modules=[endpoints, functions])
+    container.task_handlers.override(providers.Object(functions.TASK_HANDLERS))
 
     # Initialize the API with the endpoints
     app = FastAPI()
+    for handler in startup:
+        app.add_event_handler('startup', handler)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=origins,
@@ -76,4 +75,72 @@ def create_app(env: str = 'prod') -> FastAPI:
     )
     app.container = container
     app.include_router(endpoints.router)
+
+    ledger.instrument_requests()
+    report_jobs = set(container.config.get('ledger.reports.jobs') or [])
+
+    @app.middleware('http')
+    async def record_calls(request: Request, call_next):
+        run_id = request.headers.get(ledger.RUN_ID_HEADER)
+        call_ledger = ledger.CallLedger(run_id=run_id, job=request.url.path)
+        with ledger.recording(call_ledger):
+            response = await call_next(request)
+        response.headers[ledger.RUN_ID_HEADER] = call_ledger.run_id
+        route = request.scope.get('route')
+        job = route.path if route else request.url.path
+        if len(call_ledger) and container.config.get('ledger.reports.enabled') and (run_id or job in report_jobs):
+            try:
+                await run_in_threadpool(
+                    container.firestore_service().record_run_report,
+                    run_id=call_ledger.run_id,
+                    job=job,
+                    calls=call_ledger.summary()
+                )
+            except Exception as e:
+                logger.log_text(f"Failed to record the run report for {call_ledger.run_id}: {str(e)}", severity='DEBUG')
+        return response
+
+    @app.middleware('http')
+    async def bind_task(request: Request, call_next):
+        with services.task_scope(request.headers.get(services.TASK_NAME_HEADER)):
+            return await call_next(request)
+
+    threadpool_size = container.config.get('server.threadpool_size')
+    if threadpool_size:
+        # sync endpoints run on anyio's thread pool, so this bounds concurrent requests per worker
+        app.add_event_handler(
+            'startup',
+            lambda: setattr(anyio.to_thread.current_default_thread_limiter(), 'total_tokens', threadpool_size)
+        )
+
+    if container.config.get('capture.enabled'):
+        delivery_capture = capture.DeliveryCapture(
+            path=container.config.get('capture.path'),
+            redact_keys=container.config.get('capture.redact')
+        )
+        capture_paths = set(container.config.get('capture.paths') or [])
+
+        @app.middleware('http')
+        async def capture_deliveries(request: Request, call_next):
+            if request.url.path in capture_paths:
+                body = await request.body()
+                try:
+                    delivery_capture.record(
+                        method=request.method,
+                        path=request.url.path,
+                        query=request.url.query,
+                        headers=dict(request.headers),
+                        body=body
+                    )
+                except Exception as e:
+                    logger.log_text(f"Failed to capture delivery to {request.url.path}: {str(e)}", severity='DEBUG')
+            return await call_next(request)
+
+        app.add_event_handler('shutdown', delivery_capture.close)
+
+    if container.config.get('hubspot.webhooks.buffer.enabled'):
+        app.add_event_handler('startup', lambda: container.webhook_event_buffer().start())
+        app.add_event_handler('shutdown', lambda: container.webhook_event_buffer().stop())
+    if container.config.get('gcloud.tasks.backend') == 'in_process':
+        app.add_event_handler('shutdown', lambda: container.in_process_task_service().shutdown())
     return app
@@ -0,0 +1,84 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from typing import Iterator, List
+from urllib.parse import parse_qsl, urlencode
+
+from . import serialization
+
+CAPTURED_HEADERS = ('content-type', 'x-cloudscheduler-jobname')
+CAPTURED_HEADER_PREFIXES = ('x-cloudtasks-',)
+SIGNATURE_HEADER = 'x-hubspot-signature-v3'
+
+
+def redact(value, keys: set):
+    if isinstance(value, dict):
+        return {
+            key: redacted(item) if key in keys and item is not None else redact(item, keys)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, keys) for item in value]
+    return value
+
+
+def redacted(value):
+    # hashed rather than blanked so repeated values stay repeated in a replay
+    return f"redacted-{hashlib.sha1(str(value).encode()).hexdigest()[:12]}"
+
+
+class DeliveryCapture:
+
+    def __init__(self, path: str, redact_keys: List[str]) -> None:
+        self.path = path
+        self.redact_keys = set(redact_keys or [])
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.file = None
+
+    def record(self, method: str, path: str, query: str, headers: dict, body: bytes):
+        delivery = {
+            'offset': round(time.monotonic() - self.started, 4),
+            'method': method,
+            'path': path,
+            'query': urlencode([
+                (key, redacted(value) if key in self.redact_keys else value) for key, value in parse_qsl(query)
+            ]),
+            'headers': {
+                key: value for key, value in headers.items()
+                if key in CAPTURED_HEADERS or key.startswith(CAPTURED_HEADER_PREFIXES)
+            },
+            # the signature is recomputed on replay, since the body and target change
+            'signed': SIGNATURE_HEADER in headers,
+            'body': self.redact_body(body)
+        }
+        line = serialization.dumps(delivery) + b'\n'
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                # appending starts a new gzip member, which readers treat as one stream
+                self.file = gzip.open(self.path, 'ab')
+            self.file.write(line)
+
+    def redact_body(self, body: bytes):
+        if not body:
+            return None
+        try:
+            return redact(serialization.loads(body), self.redact_keys)
+        except ValueError:
+            return redacted(body)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_deliveries(path: str) -> Iterator[dict]:
+    with gzip.open(path, 'rb') as file:
+        for line in file:
+            if line.strip():
+                yield serialization.loads(line)
@@ -1,6 +1,6 @@
 from dependency_injector import containers, providers
-from ExpressIntegrations.Emerge import emerge
 from ExpressIntegrations.HubSpot import hubspot
+from ExpressIntegrations.Utils import Utils
 from google.cloud import firestore, tasks_v2
 
 from . import services
@@ -9,13 +9,15 @@ from . import services
 class Container(containers.DeclarativeContainer):
     config = providers.Configuration()
 
-    firestore_client = providers.Factory(
+    # one gRPC channel per process, shared by every service and the credential refresher
+    firestore_client = providers.Singleton(
         firestore.Client
     )
 
     firestore_service = providers.Factory(
         services.FirestoreService,
-        firestore_client=firestore_client
+        firestore_client=firestore_client,
+        settings_cache_ttl=config.firestore.settings.cache_ttl
     )
 
     cloud_tasks_client = providers.Factory(
@@ -29,7 +31,54 @@ class Container(containers.DeclarativeContainer):
         location=config.gcloud.location,
         queue=config.gcloud.tasks.queue,
         base_url=config.gcloud.base_url,
-        service_account_email=config.gcloud.tasks.service_account_email
+        service_account_email=config.gcloud.tasks.service_account_email,
+        lanes=config.gcloud.tasks.lanes
+    )
+
+    # overridden with functions.TASK_HANDLERS by create_app
+    task_handlers = providers.Object({})
+
+    in_process_task_service = providers.Singleton(
+        services.InProcessTaskService,
+        handlers=task_handlers,
+        max_workers=config.gcloud.tasks.in_process.max_workers,
+        max_retries=config.gcloud.tasks.in_process.max_retries,
+        backoff_seconds=config.gcloud.tasks.in_process.backoff_seconds
+    )
+
+    task_service = providers.Selector(
+        config.gcloud.tasks.backend,
+        cloud_tasks=cloud_tasks_service,
+        in_process=in_process_task_service
+    )
+
+    webhook_event_buffer = providers.Singleton(
+        services.WebhookEventBuffer,
+        task_service=task_service,
+        firestore_service=firestore_service,
+        max_size=config.hubspot.webhooks.buffer.max_size,
+        batch_size=config.hubspot.webhooks.buffer.batch_size,
+        flush_interval=config.hubspot.webhooks.buffer.flush_interval,
+        replay_interval=config.hubspot.webhooks.buffer.replay_interval,
+        claim_seconds=config.hubspot.webhooks.buffer.claim_seconds
+    )
+
+    # called with the scope of the work being checkpointed, the task name comes from the current request
+    task_checkpoint = providers.Factory(
+        services.TaskCheckpoint,
+        firestore_service=firestore_service,
+        task_name=providers.Callable(services.current_task_name.get),
+        ttl_seconds=config.gcloud.tasks.checkpoints.ttl_seconds,
+        max_retries=config.gcloud.tasks.checkpoints.max_retries,
+        backoff_seconds=config.gcloud.tasks.checkpoints.backoff_seconds
+    )
+
+    webhook_event_deduplicator = providers.Singleton(
+        services.WebhookEventDeduplicator,
+        firestore_service=firestore_service,
+        memory_size=config.hubspot.webhooks.dedupe.memory_size,
+        ttl_seconds=config.hubspot.webhooks.dedupe.ttl_seconds,
+        claim_seconds=config.hubspot.webhooks.dedupe.claim_seconds
     )
 
     hubspot_client = providers.Factory(
@@ -41,6 +90,15 @@ class Container(containers.DeclarativeContainer):
         refresh_token=config.hubspot.refresh_token
     )
 
+    hubspot_batch_executor = providers.Singleton(
+        services.BatchExecutor,
+        chunk_size=config.hubspot.batch.chunk_size,
+        max_concurrency=config.hubspot.batch.max_concurrency,
+        max_retries=config.hubspot.batch.max_retries,
+        backoff_seconds=config.hubspot.batch.backoff_seconds,
+        requests_per_second=config.hubspot.batch.requests_per_second
+    )
+
     hubspot_service = providers.Factory(
         services.HubSpotService,
         firestore_collection=config.hubspot.firestore.collection,
@@ -48,21 +106,67 @@ class Container(containers.DeclarativeContainer):
         access_token_location=config.hubspot.firestore.access_token.location,
         expires_at_location=config.hubspot.firestore.expires_at.location,
         hubspot_client=hubspot_client,
-        firestore_client=firestore_client
+        firestore_client=firestore_client,
+        batch_executor=hubspot_batch_executor,
+        association_cache_ttl=config.hubspot.associations.cache_ttl,
+        product_cache_ttl=config.hubspot.products.cache_ttl
     )
 
     emerge_client = providers.Factory(
-        emerge.emerge,
+        services.EmergeClient,
         environment=config.emerge.environment,
-        access_token=config.emerge.access_token
+        access_token=config.emerge.access_token,
+        timeout=providers.List(config.emerge.timeout.connect_seconds, config.emerge.timeout.read_seconds),
+        customers_timeout=providers.List(
+            config.emerge.timeout.connect_seconds,
+            config.emerge.timeout.customers_read_seconds
+        ),
+        throttle_retries=config.emerge.throttle.max_retries,
+        throttle_backoff_seconds=config.emerge.throttle.backoff_seconds,
+        throttle_max_wait_seconds=config.emerge.throttle.max_wait_seconds
+    )
+
+    billing_snapshot_service = providers.Factory(
+        services.BillingSnapshotService,
+        firestore_client=firestore_client,
+        collection=config.emerge.snapshots.collection,
+        current_month_ttl=config.emerge.snapshots.current_month_ttl
+    )
+
+    emerge_circuit_breaker = providers.Singleton(
+        services.CircuitBreaker,
+        name='emerge',
+        failure_rate_threshold=config.emerge.circuit_breaker.failure_rate_threshold,
+        minimum_calls=config.emerge.circuit_breaker.minimum_calls,
+        window_size=config.emerge.circuit_breaker.window_size,
+        slow_call_seconds=config.emerge.circuit_breaker.slow_call_seconds,
+        open_seconds=config.emerge.circuit_breaker.open_seconds,
+        half_open_max_calls=config.emerge.circuit_breaker.half_open_max_calls
     )
 
     emerge_service = providers.Factory(
         services.EmergeService,
-        emerge_client=emerge_client
+        emerge_client=emerge_client,
+        billing_snapshot_service=billing_snapshot_service,
+        bulk_max_concurrency=config.emerge.bulk.max_concurrency,
+        bulk_timeout=config.emerge.bulk.timeout,
+        circuit_breaker=emerge_circuit_breaker
+    )
+
+    # only proposals need PandaDoc, so its secret is read on first use rather than at startup
+    pandadoc_api_key = providers.Singleton(
+        Utils.access_secret_version,
+        config.gcloud.project,
+        config.pandadoc.api_key_secret.location,
+        config.pandadoc.api_key_secret.version
     )
 
-    pandadoc_service = providers.Factory(
+    pandadoc_service = providers.Singleton(
         services.PandadocService,
-        api_key=config.pandadoc.api_key
+        api_key=pandadoc_api_key,
+        connect_timeout=config.pandadoc.http.connect_timeout,
+        read_timeout=config.pandadoc.http.read_timeout,
+        max_retries=config.pandadoc.http.max_retries,
+        backoff_seconds=config.pandadoc.http.backoff_seconds,
+        pool_maxsize=config.pandadoc.http.pool_maxsize
     )
@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from ExpressIntegrations.Utils import Utils
+
+from .services import BaseService
+
+
+class CredentialRefresher(BaseService):
+
+    def __init__(self, container, config_path: str, refresh_seconds: float = 300.0) -> None:
+        self.container = container
+        self.config_path = config_path
+        self.refresh_seconds = refresh_seconds
+        self.stopped = threading.Event()
+        self.thread = None
+        self.timings = {}
+        super().__init__()
+
+    def timed(self, name, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 3)
+
+    def get_document(self, collection: str, document: str) -> dict:
+        return self.container.firestore_client().collection(collection).document(document).get().to_dict()
+
+    def load(self) -> dict:
+        with open(self.config_path) as config_file:
+            config = yaml.safe_load(config_file)
+        emerge_firestore = config['emerge']['firestore']
+        hubspot_firestore = config['hubspot']['firestore']
+        project = config['gcloud']['project']
+        client_secret = config['hubspot']['client_secret']
+
+        # the token documents and the secret are independent, so they are read concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            emerge_auth = executor.submit(
+                self.timed, 'emerge_auth', self.get_document,
+                emerge_firestore['collection'], emerge_firestore['auth_document']
+            )
+            hubspot_auth = executor.submit(
+                self.timed, 'hubspot_auth', self.get_document,
+                hubspot_firestore['collection'], hubspot_firestore['auth_document']
+            )
+            hubspot_client_secret = executor.submit(
+                self.timed, 'hubspot_client_secret', Utils.access_secret_version,
+                project, client_secret['location'], client_secret['version']
+            )
+
+            # Set the Emerge properties
+            config['emerge']['access_token'] = emerge_auth.result()[emerge_firestore['access_token']['location']]
+
+            # Set the HubSpot properties
+            auth = hubspot_auth.result()
+            config['hubspot']['access_token'] = auth['access_token']
+            config['hubspot']['expires_at'] = auth['expires_at']
+            config['hubspot']['refresh_token'] = auth['refresh_token']
+            config['hubspot']['client_secret'] = hubspot_client_secret.result()
+        return config
+
+    def refresh(self):
+        config = self.timed('load', self.load)
+        # applied in one step, so readers never see the secret locations in place of the secrets
+        self.container.config.from_dict(config)
+        self.refresh_seconds = config.get('credentials', {}).get('refresh_seconds', self.refresh_seconds)
+
+    def refresh_pandadoc_api_key(self):
+        # read in the background, so a rotated key is picked up without putting the secret on the startup path
+        pandadoc_secret = self.container.config.get('pandadoc.api_key_secret')
+        api_key = Utils.access_secret_version(
+            self.container.config.get('gcloud.project'),
+            pandadoc_secret['location'],
+            pandadoc_secret['version']
+        )
+        if api_key != self.container.pandadoc_api_key():
+            self.logger.log_text('PandaDoc API key rotated. Rebuilding the PandaDoc client.', severity='INFO')
+            self.container.pandadoc_api_key.reset()
+            self.container.pandadoc_service.reset()
+
+    def run(self):
+        while not self.stopped.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+                self.refresh_pandadoc_api_key()
+            except Exception as e:
+                # keep serving the last known values until the next attempt
+                self.logger.log_text(f"Failed to refresh configuration and secrets: {str(e)}", severity='WARNING')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='credential-refresher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
@@ -6,30 +6,32 @@ from typing import List
 
 from dependency_injector.wiring import inject, Provide
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
-from fastapi.responses import HTMLResponse
-from google.cloud import logging
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse
 
 from . import functions
 from .containers import Container
 from .models import (
+    EmergeSyncShardBatchRequest,
+    EmergeSyncShardRequest,
     HubSpotCompanySyncRequest,
     HubSpotDealSyncRequest,
     HubSpotWebhookEvent,
     HubSpotLineItemSyncRequest,
-    PandadocProposalRequest
+    PandadocProposalRequest,
+    PricingTier
 )
-from .services import CloudTasksService, FirestoreService
+from .services import FirestoreService, LazyLogger, TaskService, WebhookEventBuffer, WebhookEventDeduplicator
 
 log_name = 'intellifi.endpoints'
-logging_client = logging.Client()
-logger = logging_client.logger(log_name)
+logger = LazyLogger(log_name)
 
 router = APIRouter()
 
 
 @router.get('/intelifi/v1/hubspot/forms')
 @inject
-async def get_forms_enabled(
+def get_forms_enabled(
     firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
 ):
     return {
@@ -42,16 +44,19 @@ async def get_proposal_session(
     request: Request
 ):
     body = await request.json()
-    print(body)
+    logger.log_text(f"Proposal request: {body}", severity='DEBUG')
     pandadoc_proposal_request = PandadocProposalRequest.model_validate(body)
-    return functions.get_pandadoc_proposal_session(pandadoc_proposal_request=pandadoc_proposal_request)
+    return await run_in_threadpool(
+        functions.get_pandadoc_proposal_session,
+        pandadoc_proposal_request=pandadoc_proposal_request
+    )
 
 
 @router.get('/intellifi/v1/companies')
 @inject
 async def get_emerge_company_crm_card(
     request: Request,
-    cloud_tasks_service: CloudTasksService = Depends(Provide[Container.cloud_tasks_service]),
+    task_service: TaskService = Depends(Provide[Container.task_service]),
     webhook_secret_key: str = Depends(Provide[Container.config.hubspot.client_secret]),
     user_id: int = Query(default=None, alias='userId'),
     user_email: str = Query(default=None, alias='userEmail'),
@@ -89,23 +94,30 @@ async def get_emerge_company_crm_card(
         emerge_company_id=emerge_company_id
     )
 
+    # the body is read on the event loop for the signature, the Cloud Tasks and Emerge calls run on the threadpool
     if associated_object_type == 'COMPANY':
-        cloud_tasks_service.enqueue(
+        await run_in_threadpool(
+            task_service.enqueue,
             'hubspot/v1/company-sync/worker',
-            payload=hubspot_company_sync_request.model_dump(exclude_unset=True, exclude_none=True)
+            payload=hubspot_company_sync_request,
+            lane='interactive'
         )
-    return functions.get_emerge_company(
+    company = await run_in_threadpool(
+        functions.get_emerge_company,
         hubspot_company_sync_request=hubspot_company_sync_request
-    ).to_hubspot_crm_card()
+    )
+    return company.to_hubspot_crm_card()
 
 
 @router.post('/hubspot/v1/events')
 @inject
 async def process_hubspot_events(
     request: Request,
-    cloud_tasks_service: CloudTasksService = Depends(Provide[Container.cloud_tasks_service]),
     webhook_secret_key: str = Depends(Provide[Container.config.hubspot.client_secret]),
-    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    webhook_event_buffer: WebhookEventBuffer = Depends(Provide[Container.webhook_event_buffer]),
+    webhook_buffer_enabled: bool = Depends(Provide[Container.config.hubspot.webhooks.buffer.enabled]),
+    deduplicator: WebhookEventDeduplicator = Depends(Provide[Container.webhook_event_deduplicator]),
+    dedupe_enabled: bool = Depends(Provide[Container.config.hubspot.webhooks.dedupe.enabled]),
     events: List[HubSpotWebhookEvent] = tuple()
 ):
     expected_sig = request.headers['x-hubspot-signature-v3']
@@ -119,39 +131,28 @@ async def process_hubspot_events(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You are not authorized",
         )
+    if dedupe_enabled:
+        events = deduplicator.accept(events)
+        if not events:
+            return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
+    if webhook_buffer_enabled:
+        if webhook_event_buffer.offer(events):
+            return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
+        try:
+            # the buffer is full or shutting down, so persist the events before acknowledging them
+            await run_in_threadpool(webhook_event_buffer.persist_events, events)
+        except Exception:
+            logger.log_text(
+                traceback.format_exc(),
+                severity='DEBUG'
+            )
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Unable to accept the hubspot events",
+            )
+        return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
     try:
-        for event in events:
-            # turning this off due to infinite loops
-            # if event.propertyName == 'emerge_company_id' and event.subscriptionType == 'company.propertyChange':
-            #     cloud_tasks_service.enqueue(
-            #         'hubspot/v1/company-sync/worker',
-            #         payload=HubSpotCompanySyncRequest(
-            #             object_id=event.objectId,
-            #             emerge_company_id=int(event.propertyValue) if event.propertyValue and len(
-            #                 event.propertyValue
-            #             ) > 0 else None
-            #         ).dict()
-            #     )
-
-            if event.propertyName == 'customer_deal' and event.subscriptionType == 'deal.propertyChange':
-                cloud_tasks_service.enqueue(
-                    'hubspot/v1/deal-sync/worker',
-                    payload=HubSpotDealSyncRequest(
-                        object_id=event.objectId
-                    ).model_dump(exclude_unset=True, exclude_none=True)
-                )
-
-            if event.propertyName == 'pricing_tier' and event.subscriptionType == 'deal.propertyChange':
-                if not firestore_service.line_item_sync_enabled():
-                    print(f"Line Item Sync is disabled. Skip webhook: {event}")
-                    return
-                cloud_tasks_service.enqueue(
-                    'hubspot/v1/line-item-sync/worker',
-                    payload=HubSpotLineItemSyncRequest(
-                        object_id=event.objectId,
-                        pricing_tier=event.propertyValue if event.propertyValue != '' else None
-                    ).model_dump(exclude_unset=True, exclude_none=True)
-                )
+        await run_in_threadpool(functions.route_hubspot_events, events=events)
     except Exception:
         logger.log_text(
             traceback.format_exc(),
@@ -164,12 +165,27 @@ async def process_hubspot_events(
     return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
 
 
+@router.post('/hubspot/v1/events/worker')
+def hubspot_events_worker(events: List[HubSpotWebhookEvent]):
+    try:
+        functions.route_hubspot_events(events=events)
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to enqueue the hubspot events",
+        )
+    return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
+
+
 @router.post('/hubspot/v1/line-item-sync/worker')
 def hubspot_line_item_sync_worker(event: HubSpotLineItemSyncRequest):
     try:
-        functions.sync_line_items(sync_request=event)
+        plan = functions.sync_line_items(sync_request=event)
     except Exception:
-        print(traceback.format_exc())
         logger.log_text(
             traceback.format_exc(),
             severity='DEBUG'
@@ -178,6 +194,8 @@ def hubspot_line_item_sync_worker(event: HubSpotLineItemSyncRequest):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to process the hubspot deal pricing tier event",
         )
+    if event.dry_run:
+        return plan.model_dump()
     return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -213,18 +231,113 @@ def hubspot_deal_sync_worker(event: HubSpotDealSyncRequest):
     return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
 
 
+@router.post('/hubspot/v1/line-item-sync/batch/worker')
+def hubspot_line_item_sync_batch_worker(events: List[HubSpotLineItemSyncRequest]):
+    try:
+        results = functions.process_batch(
+            functions.sync_line_items_batch,
+            'hubspot/v1/line-item-sync/worker',
+            events,
+            lane='line_items'
+        )
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to process the hubspot deal pricing tier events",
+        )
+    return [result.model_dump() for result in results]
+
+
+@router.post('/hubspot/v1/company-sync/batch/worker')
+def hubspot_company_sync_batch_worker(events: List[HubSpotCompanySyncRequest]):
+    try:
+        results = functions.process_batch(
+            functions.sync_emerge_companies_batch,
+            'hubspot/v1/company-sync/worker',
+            events,
+            lane='bulk'
+        )
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to process the hubspot company events",
+        )
+    return [result.model_dump() for result in results]
+
+
+@router.post('/hubspot/v1/deal-sync/batch/worker')
+def hubspot_deal_sync_batch_worker(events: List[HubSpotDealSyncRequest]):
+    try:
+        results = functions.process_batch(
+            functions.associate_customer_deals_batch,
+            'hubspot/v1/deal-sync/worker',
+            events,
+            lane='webhooks'
+        )
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to process the hubspot deal events",
+        )
+    return [result.model_dump() for result in results]
+
+
 @router.post('/intellifi/v1/companies/sync')
 def sync_emerge_companies_to_hubspot(
     request: Request,
-    force: bool = False
+    force: bool = False,
+    shards: int = Query(default=1, ge=1),
+    dry_run: bool = False
 ):
     if request.headers.get('x-cloudscheduler-jobname') != 'intellifi_companies_sync':
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You are not authorized",
         )
+    if dry_run:
+        try:
+            return functions.project_emerge_sync_budget(force=force)
+        except Exception:
+            logger.log_text(
+                traceback.format_exc(),
+                severity='DEBUG'
+            )
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to project the emerge company sync budget",
+            )
+    if force and shards > 1:
+        try:
+            run_id = functions.start_sharded_resync(shard_count=shards)
+        except Exception:
+            logger.log_text(
+                traceback.format_exc(),
+                severity='DEBUG'
+            )
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to start the sharded emerge company sync",
+            )
+        if run_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Another emerge company sync is already running",
+            )
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={'run_id': run_id})
     try:
-        functions.sync_emerge_companies_to_hubspot(force=force)
+        started = functions.sync_emerge_companies_to_hubspot(force=force)
     except Exception:
         logger.log_text(
             traceback.format_exc(),
@@ -234,4 +347,128 @@ def sync_emerge_companies_to_hubspot(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to sync the emerge companies",
         )
+    if not started:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Another emerge company sync is already running",
+        )
     return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post('/intellifi/v1/deals/reprice')
+def reprice_deals(
+    request: Request,
+    pricing_tier: List[PricingTier] = Query(default=None),
+    dry_run: bool = False
+):
+    if request.headers.get('x-cloudscheduler-jobname') != 'intellifi_deals_reprice':
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not authorized",
+        )
+    try:
+        report = functions.reprice_deals(
+            pricing_tiers=pricing_tier or list(PricingTier),
+            dry_run=dry_run
+        )
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to reprice the hubspot deals",
+        )
+    return report.model_dump()
+
+
+@router.post('/intellifi/v1/companies/sync/shard/worker')
+def sync_emerge_companies_shard_worker(event: EmergeSyncShardRequest):
+    try:
+        functions.sync_emerge_companies_shard(shard_request=event)
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to sync the emerge company shard",
+        )
+    return HTMLResponse(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post('/intellifi/v1/companies/sync/shard/batch/worker')
+def sync_emerge_companies_shard_batch_worker(event: EmergeSyncShardBatchRequest):
+    try:
+        results = functions.sync_emerge_companies_shard_batch(batch_request=event)
+    except Exception:
+        logger.log_text(
+            traceback.format_exc(),
+            severity='DEBUG'
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to sync the emerge company shard batch",
+        )
+    return [result.model_dump() for result in results]
+
+
+@router.get('/intellifi/v1/companies/sync/{run_id}')
+@inject
+def get_sharded_resync_progress(
+    request: Request,
+    run_id: str,
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service])
+):
+    if request.headers.get('x-cloudscheduler-jobname') != 'intellifi_companies_sync':
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not authorized",
+        )
+    run = firestore_service.get_resync_run(run_id=run_id)
+    if not run:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No sharded sync found with ID {run_id}",
+        )
+    return run
+
+
+@router.get('/intellifi/v1/runs/{run_id}/report')
+@inject
+def get_run_report(
+    request: Request,
+    run_id: str,
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service])
+):
+    if request.headers.get('x-cloudscheduler-jobname') != 'intellifi_companies_sync':
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not authorized",
+        )
+    report = firestore_service.get_run_report(run_id=run_id)
+    if not report:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No run report found with ID {run_id}",
+        )
+    return report
+
+
+@router.get('/_ah/warmup')
+def warm_up(request: Request):
+    if request.headers.get('x-cloudscheduler-jobname') != 'intellifi_warm_up':
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You are not authorized",
+        )
+    try:
+        return functions.warm_up()
+    except Exception as e:
+        logger.log_text(traceback.format_exc(), severity='DEBUG')
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to warm up",
+        )
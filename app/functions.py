@@ -1,20 +1,29 @@
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from typing import List, Optional
+from uuid import uuid4
 
-from dependency_injector.wiring import inject, Provide
+from dependency_injector.wiring import inject, Provide, Provider
 from fastapi import Depends
-from google.cloud import logging
+from google.cloud import firestore
 
+from . import ledger, serialization
 from .containers import Container
 from .models import HubSpotCompanySyncRequest, HubSpotDealSyncRequest, HubSpotLineItemSyncRequest, PricingTier, \
-    PandadocProposalRequest
-from .services import CloudTasksService, EmergeService, HubSpotService, PandadocService, FirestoreService
+    PandadocProposalRequest, LineItemSyncPlan, DealRepricingReport, HubSpotWebhookEvent, BatchItemResult, BatchItemStatus, \
+    EmergeCompanyBillingInfo, EmergeCompanyInfo, EmergeSyncShardRequest, EmergeSyncShardBatchRequest
+from .services import EmergeService, HubSpotService, PandadocService, FirestoreService, TaskService, \
+    BatchExecutionError, LazyLogger, TaskCheckpoint, WebhookEventDeduplicator
 
 log_name = 'intellifi.functions'
-logging_client = logging.Client()
-logger = logging_client.logger(log_name)
+logger = LazyLogger(log_name)
 
+HUBSPOT_BATCH_LIMIT = 100
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 PRODUCT_PROPERTIES = ['name', 'price', 'tier_2', 'tier_3', 'hs_product_id', 'hs_sku']
-LINE_ITEM_PROPERTIES = ['hs_product_id', 'price', 'hs_sku']
+LINE_ITEM_PROPERTIES = ['hs_product_id', 'price', 'hs_sku', 'quantity', 'name']
 
 
 @inject
@@ -29,7 +38,8 @@ def get_pandadoc_proposal_session(
 def sync_emerge_company_to_hubspot(
     hubspot_company_sync_request: HubSpotCompanySyncRequest,
     emerge_service: EmergeService = Depends(Provide[Container.emerge_service]),
-    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service]),
+    task_checkpoint=Depends(Provider[Container.task_checkpoint])
 ):
     if not hubspot_company_sync_request.emerge_company_id:
         logger.log_text(
@@ -37,24 +47,79 @@ def sync_emerge_company_to_hubspot(
             severity='DEBUG'
         )
         return
-    emerge_company = emerge_service.get_customer_billing_info(
-        company_id=hubspot_company_sync_request.emerge_company_id,
-        year=hubspot_company_sync_request.year,
-        month=hubspot_company_sync_request.month
+    checkpoint = task_checkpoint(
+        scope=f"company-sync-{hubspot_company_sync_request.emerge_company_id}-{hubspot_company_sync_request.object_id}"
+    )
+    emerge_company = checkpoint.step(
+        'billing',
+        lambda: emerge_service.get_customer_billing_info(
+            company_id=hubspot_company_sync_request.emerge_company_id,
+            year=hubspot_company_sync_request.year,
+            month=hubspot_company_sync_request.month,
+            # HubSpot gets live figures for the open month, closed months come from the snapshot store
+            use_snapshot=False
+        ),
+        model=EmergeCompanyBillingInfo
     )
     logger.log_text(
         f"Syncing Emerge Company {emerge_company.json()}",
         severity='DEBUG'
     )
+    target = checkpoint.step(
+        'company',
+        lambda: locate_hubspot_company(
+            hubspot_company_sync_request=hubspot_company_sync_request,
+            hubspot_service=hubspot_service
+        )
+    )
+    if target is None:
+        checkpoint.complete()
+        return
+    hubspot_company_id = target['company_id']
+    for company_to_merge in target['merge']:
+        # a merged company is gone, so a merge is never repeated
+        checkpoint.step(
+            f"merge-{company_to_merge}",
+            lambda: hubspot_service.merge_companies(
+                company_to_merge=company_to_merge,
+                company_to_keep=hubspot_company_id
+            )['content'],
+            retry=False
+        )
+    owner_id = hubspot_service.get_owner_by_email(email=hubspot_company_sync_request.account_manager_email)
+    update_result = checkpoint.step(
+        'update',
+        lambda: hubspot_service.update_company(
+            company_id=hubspot_company_id,
+            properties=emerge_company.to_hubspot_company(
+                days_from_last_report=hubspot_company_sync_request.days_from_last_report,
+                owner_id=owner_id,
+                status_change_date=hubspot_company_sync_request.status_change_date
+            )
+        )
+    )
+    logger.log_text(
+        f"Company update result for {hubspot_company_id}: {update_result}",
+        severity='DEBUG'
+    )
+    checkpoint.complete()
+
+
+def locate_hubspot_company(
+    hubspot_company_sync_request: HubSpotCompanySyncRequest,
+    hubspot_service: HubSpotService
+) -> Optional[dict]:
     hubspot_company_id = None
+    deal_company = None
     if hubspot_company_sync_request.object_id:
         if hubspot_company_sync_request.type == 'COMPANY':
             hubspot_company_id = hubspot_company_sync_request.object_id
         if hubspot_company_sync_request.type == 'DEAL':
-            associations = hubspot_service.get_company_for_deal(
+            deal_company = hubspot_service.get_company_for_deal(
                 deal_id=hubspot_company_sync_request.object_id
-            )
-            hubspot_company_id = associations.first().id if associations.first() else None
+            ).first()
+            hubspot_company_id = deal_company.id if deal_company else None
+    companies_to_merge = []
     if not hubspot_company_id:
         companies = hubspot_service.get_company_by_emerge_company(
             emerge_company_id=hubspot_company_sync_request.emerge_company_id
@@ -72,9 +137,16 @@ def sync_emerge_company_to_hubspot(
                     ),
                     severity='DEBUG'
                 )
-                return
-            c_association = hubspot_service.get_company_for_deal(hubspot_company_sync_request.object_id).results[0]
-            hubspot_company_id = c_association['to'][0]['id']
+                return None
+            if deal_company is None and hubspot_company_sync_request.type != 'DEAL':
+                deal_company = hubspot_service.get_company_for_deal(hubspot_company_sync_request.object_id).first()
+            if deal_company is None:
+                logger.log_text(
+                    f"No Company associated with {hubspot_company_sync_request.object_id} in HubSpot. Skipping...",
+                    severity='DEBUG'
+                )
+                return None
+            hubspot_company_id = deal_company.id
             logger.log_text(
                 f"No Company found in HubSpot with Emerge Company ID {hubspot_company_sync_request.emerge_company_id}. "
                 f"Located company {hubspot_company_id} by deal ID {hubspot_company_sync_request.object_id} in HubSpot",
@@ -92,24 +164,182 @@ def sync_emerge_company_to_hubspot(
                 f"{companies}",
                 severity='DEBUG'
             )
-            for company_to_merge in companies['results'][1:]:
-                hubspot_service.merge_companies(
-                    company_to_merge=company_to_merge['id'],
-                    company_to_keep=hubspot_company_id
-                )
-    owner_id = hubspot_service.get_owner_by_email(email=hubspot_company_sync_request.account_manager_email)
-    update_result = hubspot_service.update_company(
-        company_id=hubspot_company_id,
-        properties=emerge_company.to_hubspot_company(
-            days_from_last_report=hubspot_company_sync_request.days_from_last_report,
-            owner_id=owner_id,
-            status_change_date=hubspot_company_sync_request.status_change_date
+            companies_to_merge = [company_to_merge['id'] for company_to_merge in companies['results'][1:]]
+    return {'company_id': hubspot_company_id, 'merge': companies_to_merge}
+
+
+@inject
+def resolve_customer_deal_company(
+    deal_id: int,
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+):
+    deal = hubspot_service.get_deal(
+        deal_id=deal_id,
+        property_names=['original_closed_won_deal', 'dealname']
+    )
+    deal_name = deal['properties']['dealname'].replace('Customer Deal - ', '')
+    company_id = get_or_create_hubspot_company_by_name(
+        company_name=deal_name
+    )
+
+    original_deal_id = deal['properties'].get('original_closed_won_deal')
+    if not original_deal_id or len(original_deal_id) == 0:
+        deals = hubspot_service.get_deal_by_name(
+            deal_name=deal_name
         )
+        if deals['total'] == 0:
+            # This should never happen
+            raise Exception(
+                f"No deals found with name {deal_name}: {deals}"
+            )
+        elif deals['total'] == 1:
+            original_deal = deals['results'][0]
+            logger.log_text(
+                f"Found Deal in HubSpot with name {deal_name}: {original_deal['id']}",
+                severity='DEBUG'
+            )
+            original_deal_id = original_deal['id']
+            # update the original closed won deal property
+            update_result = hubspot_service.update_deal(
+                deal_id=deal_id,
+                properties={
+                    "original_closed_won_deal": original_deal_id
+                }
+            )
+            logger.log_text(
+                f"Update customer deal with original deal ID result: {update_result}",
+                severity='DEBUG'
+            )
+        else:
+            # This should never happen
+            raise Exception(
+                f"Multiple deals found with name {deal_name}: {deals}"
+            )
+    # associate the company to the original deal
+    company_association_result = hubspot_service.set_company_for_deal(
+        deal_id=original_deal_id,
+        company_id=company_id
     )
     logger.log_text(
-        f"Company update result for {hubspot_company_id}: {update_result}",
+        f"Company association result for original deal {original_deal_id}: {company_association_result}",
         severity='DEBUG'
     )
+    return company_id
+
+
+@inject
+def get_or_create_hubspot_companies_by_name(
+    company_names: List[str],
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> dict:
+    companies = hubspot_service.get_companies_by_names(company_names=company_names)
+    company_ids = {}
+    missing = {}
+    for company_name in company_names:
+        matches = companies.get(company_name.strip().lower(), [])
+        if len(matches) == 0:
+            missing.setdefault(company_name.strip().lower(), company_name.strip())
+            continue
+        company_ids[company_name.strip().lower()] = matches[0]['id']
+        if len(matches) > 1:
+            logger.log_text(
+                f"Multiple companies found with name {company_name}. Merging {len(matches)} companies: {matches}",
+                severity='DEBUG'
+            )
+            for company_to_merge in matches[1:]:
+                hubspot_service.merge_companies(
+                    company_to_merge=company_to_merge['id'],
+                    company_to_keep=matches[0]['id']
+                )
+    if missing:
+        logger.log_text(f"Creating {len(missing)} companies: {list(missing.values())}", severity='DEBUG')
+        try:
+            created = hubspot_service.create_companies(companies=[{'name': name} for name in missing.values()])
+        except BatchExecutionError as e:
+            created = e.results
+        # batch create results are unordered, so match them back by name
+        for company in created:
+            company_ids[company['properties']['name'].strip().lower()] = company['id']
+    return company_ids
+
+
+@inject
+def resolve_customer_deal_companies(
+    deal_ids: List[str],
+    index_for_deal: dict,
+    results: List[BatchItemResult],
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> dict:
+    try:
+        deals = {
+            deal['id']: deal for deal in hubspot_service.get_deals(
+                deal_ids=deal_ids,
+                properties=['original_closed_won_deal', 'dealname']
+            )
+        }
+    except BatchExecutionError as e:
+        deals = {deal['id']: deal for deal in e.results}
+    deal_names = {}
+    for deal_id in deal_ids:
+        if deal_id not in deals:
+            results[index_for_deal[deal_id]].fail(f"Unable to read deal {deal_id}")
+            continue
+        deal_names[deal_id] = deals[deal_id]['properties']['dealname'].replace('Customer Deal - ', '').strip()
+
+    company_ids = get_or_create_hubspot_companies_by_name(company_names=list(set(deal_names.values())))
+    without_original = {
+        deal_id: deal_name for deal_id, deal_name in deal_names.items()
+        if not deals[deal_id]['properties'].get('original_closed_won_deal')
+    }
+    original_deals = hubspot_service.get_deals_by_names(
+        deal_names=list(set(without_original.values()))
+    ) if without_original else {}
+
+    companies_for_deals = {}
+    original_deal_ids = {}
+    updates = []
+    for deal_id, deal_name in deal_names.items():
+        if deal_name.lower() not in company_ids:
+            results[index_for_deal[deal_id]].fail(f"Unable to create a company named {deal_name}")
+            continue
+        original_deal_id = deals[deal_id]['properties'].get('original_closed_won_deal')
+        if not original_deal_id:
+            matches = original_deals.get(deal_name.lower(), [])
+            if len(matches) != 1:
+                # This should never happen
+                results[index_for_deal[deal_id]].fail(f"{len(matches)} deals found with name {deal_name}: {matches}")
+                continue
+            original_deal_id = matches[0]['id']
+            updates.append({'id': deal_id, 'properties': {'original_closed_won_deal': original_deal_id}})
+        original_deal_ids[deal_id] = original_deal_id
+        companies_for_deals[deal_id] = company_ids[deal_name.lower()]
+
+    # several customer deals can share an original deal, a failed association fails all of them
+    deals_for_original = {}
+    for deal_id, original_deal_id in original_deal_ids.items():
+        deals_for_original.setdefault(str(original_deal_id), []).append(deal_id)
+    run_batch_write(
+        write=lambda inputs: hubspot_service.update_deals(records=inputs),
+        inputs=updates,
+        index_for_input=lambda update: index_for_deal[str(update['id'])],
+        results=results
+    )
+    # associate the company to the original deal
+    run_batch_write(
+        write=lambda inputs: hubspot_service.set_company_for_deals(associations=inputs),
+        inputs=[
+            {'deal_id': original_deal_id, 'company_id': companies_for_deals[deal_id]}
+            for deal_id, original_deal_id in original_deal_ids.items()
+        ],
+        index_for_input=lambda association: [index_for_deal[deal_id] for deal_id in deals_for_original[
+            str(association['from']['id'] if 'from' in association else association['deal_id'])
+        ]],
+        results=results
+    )
+    return {
+        deal_id: company_id for deal_id, company_id in companies_for_deals.items()
+        if results[index_for_deal[deal_id]].status != BatchItemStatus.FAILED
+    }
 
 
 @inject
@@ -121,57 +351,7 @@ def associate_customer_deal(
         deal_id=hubspot_deal_sync_request.object_id
     )
     if len(associations.results) == 0:
-        deal = hubspot_service.get_deal(
-            deal_id=hubspot_deal_sync_request.object_id,
-            property_names=['original_closed_won_deal', 'dealname']
-        )
-        deal_name = deal['properties']['dealname'].replace('Customer Deal - ', '')
-        company_id = get_or_create_hubspot_company_by_name(
-            company_name=deal_name
-        )
-
-        original_deal_id = deal['properties'].get('original_closed_won_deal')
-        if not original_deal_id or len(original_deal_id) == 0:
-            deals = hubspot_service.get_deal_by_name(
-                deal_name=deal_name
-            )
-            if deals['total'] == 0:
-                # This should never happen
-                raise Exception(
-                    f"No deals found with name {deal_name}: {deals}"
-                )
-            elif deals['total'] == 1:
-                original_deal = deals['results'][0]
-                logger.log_text(
-                    f"Found Deal in HubSpot with name {deal_name}: {original_deal['id']}",
-                    severity='DEBUG'
-                )
-                original_deal_id = original_deal['id']
-                # update the original closed won deal property
-                update_result = hubspot_service.update_deal(
-                    deal_id=hubspot_deal_sync_request.object_id,
-                    properties={
-                        "original_closed_won_deal": original_deal_id
-                    }
-                )
-                logger.log_text(
-                    f"Update customer deal with original deal ID result: {update_result}",
-                    severity='DEBUG'
-                )
-            else:
-                # This should never happen
-                raise Exception(
-                    f"Multiple deals found with name {deal_name}: {deals}"
-                )
-        # associate the company to the original deal
-        company_association_result = hubspot_service.set_company_for_deal(
-            deal_id=original_deal_id,
-            company_id=company_id
-        )
-        logger.log_text(
-            f"Company association result for original deal {original_deal_id}: {company_association_result}",
-            severity='DEBUG'
-        )
+        company_id = resolve_customer_deal_company(deal_id=hubspot_deal_sync_request.object_id)
     else:
         company_id = associations.first().id
     company_association_result = hubspot_service.set_customer_company_for_deal(
@@ -185,59 +365,450 @@ def associate_customer_deal(
     )
 
 
+@inject
+def route_hubspot_events(
+    events: List[HubSpotWebhookEvent],
+    task_service: TaskService = Depends(Provide[Container.task_service]),
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    deduplicator: WebhookEventDeduplicator = Depends(Provide[Container.webhook_event_deduplicator]),
+    dedupe_enabled: bool = Depends(Provide[Container.config.hubspot.webhooks.dedupe.enabled])
+):
+    if dedupe_enabled:
+        events = deduplicator.claim(events)
+    try:
+        enqueue_hubspot_event_tasks(events=events, task_service=task_service, firestore_service=firestore_service)
+    except Exception:
+        if dedupe_enabled and events:
+            deduplicator.release(events)
+        raise
+    if dedupe_enabled and events:
+        try:
+            deduplicator.complete(events)
+        except Exception as e:
+            # the tasks are enqueued, so the pending claims are left to expire rather than failing the delivery
+            logger.log_text(f"Failed to mark webhook events processed: {str(e)}", severity='WARNING')
+
+
+def enqueue_hubspot_event_tasks(
+    events: List[HubSpotWebhookEvent],
+    task_service: TaskService,
+    firestore_service: FirestoreService
+):
+    line_item_sync_enabled = None
+    deal_sync_requests = []
+    line_item_sync_requests = []
+    for event in events:
+        # turning this off due to infinite loops
+        # if event.propertyName == 'emerge_company_id' and event.subscriptionType == 'company.propertyChange':
+        #     task_service.enqueue(
+        #         'hubspot/v1/company-sync/worker',
+        #         payload=HubSpotCompanySyncRequest(
+        #             object_id=event.objectId,
+        #             emerge_company_id=int(event.propertyValue) if event.propertyValue and len(
+        #                 event.propertyValue
+        #             ) > 0 else None
+        #         ).dict()
+        #     )
+
+        if event.propertyName == 'customer_deal' and event.subscriptionType == 'deal.propertyChange':
+            deal_sync_requests.append(
+                HubSpotDealSyncRequest(
+                    object_id=event.objectId
+                )
+            )
+
+        if event.propertyName == 'pricing_tier' and event.subscriptionType == 'deal.propertyChange':
+            if line_item_sync_enabled is None:
+                line_item_sync_enabled = firestore_service.line_item_sync_enabled()
+            if not line_item_sync_enabled:
+                logger.log_text(f"Line Item Sync is disabled. Skip webhook: {event}", severity='DEBUG')
+                continue
+            line_item_sync_requests.append(
+                HubSpotLineItemSyncRequest(
+                    object_id=event.objectId,
+                    pricing_tier=event.propertyValue if event.propertyValue != '' else None
+                )
+            )
+
+    if len(deal_sync_requests) > 0:
+        task_service.enqueue('hubspot/v1/deal-sync/batch/worker', payload=deal_sync_requests, lane='webhooks')
+    if len(line_item_sync_requests) > 0:
+        task_service.enqueue(
+            'hubspot/v1/line-item-sync/batch/worker',
+            payload=line_item_sync_requests,
+            lane='line_items'
+        )
+
+
 @inject
 def get_emerge_company(
     hubspot_company_sync_request: HubSpotCompanySyncRequest,
     emerge_service: EmergeService = Depends(Provide[Container.emerge_service])
 ):
-    return emerge_service.get_customer_billing_info(
+    return emerge_service.get_customer_billing_info_or_stale(
         company_id=hubspot_company_sync_request.emerge_company_id,
         year=hubspot_company_sync_request.year,
         month=hubspot_company_sync_request.month
     )
 
 
+def as_utc(value: Optional[datetime]):
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def customer_sync_key(customer: EmergeCompanyInfo):
+    return as_utc(customer.last_modified_date) or EPOCH, customer.company_id
+
+
+def build_company_sync_request(customer: EmergeCompanyInfo) -> HubSpotCompanySyncRequest:
+    return HubSpotCompanySyncRequest(
+        emerge_company_id=customer.company_id,
+        type='DEAL',
+        object_id=customer.hubspot_object_id,
+        days_from_last_report=customer.days_from_last_report,
+        account_manager_email=customer.account_manager_email,
+        status_change_date=int(
+            customer.status_change_date.timestamp() * 1000
+        ) if customer.status_change_date else None
+    )
+
+
+def sync_watermark(state: dict) -> Optional[str]:
+    watermark = state.get('watermark')
+    if not watermark and state.get('last_run_date'):
+        watermark = datetime.strptime(state['last_run_date'], '%m-%d-%Y').replace(tzinfo=timezone.utc).isoformat()
+    return watermark
+
+
+def customers_to_sync(emerge_service: EmergeService, since: Optional[str], position: Optional[list] = None):
+    since_date = None
+    if since:
+        since = datetime.fromisoformat(since)
+        # Emerge only filters by date, so ask for the day before and filter on the full timestamp here
+        since_date = (since - timedelta(days=1)).strftime('%m-%d-%Y')
+    logger.log_text(
+        f"Checking for records updated since {since or '01-01-2000'}...",
+        severity='DEBUG'
+    )
+    customers = sorted(
+        (
+            customer for customer in emerge_service.get_all_customers(since=since_date or '01-01-2000')
+            if not since or not customer.last_modified_date or as_utc(customer.last_modified_date) >= since
+        ),
+        key=customer_sync_key
+    )
+    if position:
+        position = (datetime.fromisoformat(position[0]), position[1])
+        customers = [customer for customer in customers if customer_sync_key(customer) > position]
+    return customers
+
+
+def dispatch_interval(
+    task_count: int,
+    window_seconds: float,
+    requests_per_task: float,
+    requests_per_second: float
+) -> float:
+    # spread tasks evenly over the window, but never faster than the HubSpot rate budget allows
+    if task_count <= 1:
+        return 0.0
+    interval = window_seconds / task_count
+    if requests_per_second:
+        interval = max(interval, requests_per_task / requests_per_second)
+    return interval
+
+
 @inject
 def sync_emerge_companies_to_hubspot(
     emerge_service: EmergeService = Depends(Provide[Container.emerge_service]),
-    cloud_tasks_service: CloudTasksService = Depends(Provide[Container.cloud_tasks_service]),
+    task_service: TaskService = Depends(Provide[Container.task_service]),
     firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    batch_size: int = Depends(Provide[Container.config.emerge.sync.batch_size]),
+    lease_seconds: float = Depends(Provide[Container.config.emerge.sync.lease_seconds]),
+    dispatch_window_seconds: float = Depends(Provide[Container.config.emerge.sync.dispatch_window_seconds]),
+    requests_per_task: float = Depends(Provide[Container.config.emerge.sync.hubspot_requests_per_task]),
+    requests_per_second: float = Depends(Provide[Container.config.hubspot.batch.requests_per_second]),
     force: bool = False
-):
-    start_time = datetime.now()
-    last_run_date = firestore_service.get_emerge_sync_last_run_date()
-    if force:
-        last_run_date = '01-01-2000'
+) -> bool:
+    holder = uuid4().hex
+    if not firestore_service.acquire_emerge_sync_lease(holder=holder, duration=lease_seconds):
+        logger.log_text("Another Emerge sync holds the lease. Skipping...", severity='DEBUG')
+        return False
+    try:
+        state = firestore_service.get_emerge_sync_state()
+        run = state.get('run')
+        if run and (run['force'] or not force):
+            logger.log_text(f"Resuming Emerge sync started at {run['started_at']} from {run['position']}", severity='DEBUG')
+            ledger.bind_run(run.get('run_id'))
+        else:
+            run = {
+                'run_id': ledger.current_run_id(),
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'force': force,
+                'since': None if force else sync_watermark(state),
+                'position': None
+            }
+            firestore_service.set_emerge_sync_run(run=run)
+
+        customers = customers_to_sync(emerge_service=emerge_service, since=run['since'], position=run['position'])
+
+        interval = dispatch_interval(
+            task_count=-(-len(customers) // batch_size),
+            window_seconds=dispatch_window_seconds,
+            requests_per_task=requests_per_task,
+            requests_per_second=requests_per_second
+        )
+        dispatch_start = datetime.now(timezone.utc)
+        logger.log_text(
+            f"Dispatching {len(customers)} customers in batches of {batch_size} every {interval:.1f}s",
+            severity='DEBUG'
+        )
+        for start in range(0, len(customers), batch_size):
+            batch = customers[start:start + batch_size]
+            try:
+                task_service.enqueue(
+                    'hubspot/v1/company-sync/batch/worker',
+                    payload=[build_company_sync_request(customer) for customer in batch],
+                    lane='bulk',
+                    schedule_time=dispatch_start + timedelta(seconds=start // batch_size * interval)
+                )
+            except Exception as e:
+                # the position stays before this batch, so the next run resumes from it instead of skipping it
+                logger.log_text(
+                    f"Job failed at customers {start + 1}-{start + len(batch)}: "
+                    f"{[customer.company_id for customer in batch]} with the failure: {str(e)}",
+                    severity='ERROR'
+                )
+                raise
+            last_modified_date, company_id = customer_sync_key(batch[-1])
+            run['position'] = [last_modified_date.isoformat(), company_id]
+            firestore_service.set_emerge_sync_run(run=run)
+            if not firestore_service.acquire_emerge_sync_lease(holder=holder, duration=lease_seconds):
+                raise RuntimeError('Lost the Emerge sync lease. The next run will resume from the checkpoint.')
+
+        watermark = run['since']
+        if run['position'] and datetime.fromisoformat(run['position'][0]) > EPOCH:
+            watermark = run['position'][0]
+        logger.log_text(
+            f"Finished enqueueing tasks. Updating watermark to {watermark}.",
+            severity='DEBUG'
+        )
+        firestore_service.complete_emerge_sync_run(
+            watermark=watermark,
+            last_run_date=datetime.fromisoformat(run['started_at']).strftime('%m-%d-%Y')
+        )
+    finally:
+        firestore_service.release_emerge_sync_lease(holder=holder)
+    return True
+
+
+@inject
+def project_emerge_sync_budget(
+    emerge_service: EmergeService = Depends(Provide[Container.emerge_service]),
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    batch_size: int = Depends(Provide[Container.config.emerge.sync.batch_size]),
+    dispatch_window_seconds: float = Depends(Provide[Container.config.emerge.sync.dispatch_window_seconds]),
+    requests_per_task: float = Depends(Provide[Container.config.emerge.sync.hubspot_requests_per_task]),
+    requests_per_second: float = Depends(Provide[Container.config.hubspot.batch.requests_per_second]),
+    force: bool = False
+) -> dict:
+    state = firestore_service.get_emerge_sync_state()
+    run = state.get('run')
+    resuming = bool(run and (run['force'] or not force))
+    if resuming:
+        customers = customers_to_sync(emerge_service=emerge_service, since=run['since'], position=run['position'])
+    else:
+        customers = customers_to_sync(emerge_service=emerge_service, since=None if force else sync_watermark(state))
+    tasks = -(-len(customers) // batch_size)
+    interval = dispatch_interval(
+        task_count=tasks,
+        window_seconds=dispatch_window_seconds,
+        requests_per_task=requests_per_task,
+        requests_per_second=requests_per_second
+    )
+    return {
+        'resuming': resuming,
+        'customers': len(customers),
+        'tasks': tasks,
+        'dispatch_seconds': round(interval * max(tasks - 1, 0)),
+        'calls': {
+            # one customer list, then a billing read per customer
+            'emerge': 1 + len(customers),
+            'hubspot': int(tasks * requests_per_task),
+            'cloud_tasks': tasks,
+            # lease, state, run and completion writes, a checkpoint and lease renewal per batch,
+            # and a snapshot write per customer in the workers
+            'firestore': 5 + 2 * tasks + len(customers)
+        }
+    }
+
+
+def resync_lease_holder(run_id: str):
+    # every shard and batch of a resync renews the global lease under the run, so an incremental sync cannot overlap it
+    return f"resync-{run_id}"
+
+
+@inject
+def start_sharded_resync(
+    shard_count: int,
+    emerge_service: EmergeService = Depends(Provide[Container.emerge_service]),
+    task_service: TaskService = Depends(Provide[Container.task_service]),
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    batch_size: int = Depends(Provide[Container.config.emerge.sync.batch_size]),
+    lease_seconds: float = Depends(Provide[Container.config.emerge.sync.lease_seconds])
+) -> Optional[str]:
+    run_id = uuid4().hex
+    if not firestore_service.acquire_emerge_sync_lease(holder=resync_lease_holder(run_id), duration=lease_seconds):
+        logger.log_text("Another Emerge sync holds the lease. Skipping...", severity='DEBUG')
+        return None
+    try:
+        customers = sorted(
+            emerge_service.get_all_customers(since='01-01-2000'),
+            key=lambda customer: customer.company_id
+        )
+        shard_batches = []
+        for shard_index in range(shard_count):
+            shard_customers = customers[shard_index::shard_count]
+            shard_batches.append([
+                [build_company_sync_request(customer).model_dump(mode='json') for customer in batch]
+                for batch in chunks(shard_customers, batch_size)
+            ])
+        firestore_service.create_resync_run(run_id=run_id, shard_batches=shard_batches)
+        for shard_index in range(shard_count):
+            task_service.enqueue(
+                'intellifi/v1/companies/sync/shard/worker',
+                payload=EmergeSyncShardRequest(
+                    run_id=run_id,
+                    shard_index=shard_index,
+                    shard_count=shard_count
+                ),
+                lane='bulk'
+            )
+    except Exception:
+        firestore_service.release_emerge_sync_lease(holder=resync_lease_holder(run_id))
+        raise
     logger.log_text(
-        f"Checking for records updated since {last_run_date}...",
+        f"Started sharded resync {run_id} of {len(customers)} customers with {shard_count} shards",
         severity='DEBUG'
     )
-    for index, customer in enumerate(emerge_service.get_all_customers(since=last_run_date)):
-        try:
-            scd = int(customer.status_change_date.timestamp() * 1000) if customer.status_change_date else None
-            cloud_tasks_service.enqueue(
-                'hubspot/v1/company-sync/worker',
-                payload=HubSpotCompanySyncRequest(
-                    emerge_company_id=customer.company_id,
-                    type='DEAL',
-                    object_id=customer.hubspot_object_id,
-                    days_from_last_report=customer.days_from_last_report,
-                    account_manager_email=customer.account_manager_email,
-                    status_change_date=scd
-                ).model_dump(exclude_unset=True, exclude_none=True)
-            )
-        except Exception as e:
+    return run_id
+
+
+@inject
+def sync_emerge_companies_shard(
+    shard_request: EmergeSyncShardRequest,
+    task_service: TaskService = Depends(Provide[Container.task_service]),
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    lease_seconds: float = Depends(Provide[Container.config.emerge.sync.lease_seconds]),
+    dispatch_window_seconds: float = Depends(Provide[Container.config.emerge.sync.dispatch_window_seconds]),
+    requests_per_task: float = Depends(Provide[Container.config.emerge.sync.hubspot_requests_per_task]),
+    requests_per_second: float = Depends(Provide[Container.config.hubspot.batch.requests_per_second])
+):
+    shard = firestore_service.get_resync_shard(run_id=shard_request.run_id, shard_index=shard_request.shard_index)
+    if shard['status'] in ('dispatched', 'completed'):
+        return
+    holder = uuid4().hex
+    # the lease only keeps a redelivery of this shard's task from dispatching alongside it, other shards run in parallel
+    if not firestore_service.acquire_resync_shard_lease(
+        run_id=shard_request.run_id,
+        shard_index=shard_request.shard_index,
+        holder=holder,
+        duration=lease_seconds
+    ):
+        raise RuntimeError(f"Shard {shard_request.shard_index} of resync {shard_request.run_id} is already dispatching")
+    try:
+        firestore_service.acquire_emerge_sync_lease(
+            holder=resync_lease_holder(shard_request.run_id),
+            duration=lease_seconds
+        )
+        first_batch = 0
+        if shard['position'] is not None:
             logger.log_text(
-                f"Job failed at customer {index + 1}: {customer.company_name} ({customer.company_id}) with the failure:"
-                f" {str(e)}",
+                f"Resuming shard {shard_request.shard_index} of resync {shard_request.run_id} "
+                f"after batch {shard['position']}",
                 severity='DEBUG'
             )
+            first_batch = shard['position'] + 1
+        else:
+            firestore_service.update_resync_shard(
+                run_id=shard_request.run_id,
+                shard_index=shard_request.shard_index,
+                status='running'
+            )
 
-    logger.log_text(
-        f"Finished enqueueing tasks. Updating last run date to {start_time.strftime('%m-%d-%Y')}.",
-        severity='DEBUG'
+        # shards dispatch side by side, so each gets its share of the HubSpot rate budget
+        interval = dispatch_interval(
+            task_count=shard['batch_count'] - first_batch,
+            window_seconds=dispatch_window_seconds,
+            requests_per_task=requests_per_task,
+            requests_per_second=requests_per_second / shard_request.shard_count if requests_per_second else None
+        )
+        dispatch_start = datetime.now(timezone.utc)
+        # the shard only dispatches, each batch is synced by its own task so no request runs into the timeout
+        for batch_index in range(first_batch, shard['batch_count']):
+            task_service.enqueue(
+                'intellifi/v1/companies/sync/shard/batch/worker',
+                payload=EmergeSyncShardBatchRequest(
+                    run_id=shard_request.run_id,
+                    shard_index=shard_request.shard_index,
+                    batch_id=f"{shard_request.shard_index}-{batch_index}"
+                ),
+                lane='bulk',
+                schedule_time=dispatch_start + timedelta(seconds=(batch_index - first_batch) * interval)
+            )
+            firestore_service.update_resync_shard(
+                run_id=shard_request.run_id,
+                shard_index=shard_request.shard_index,
+                position=batch_index
+            )
+        if firestore_service.record_resync_shard_progress(
+            run_id=shard_request.run_id,
+            shard_index=shard_request.shard_index,
+            dispatched=True
+        ):
+            firestore_service.release_emerge_sync_lease(holder=resync_lease_holder(shard_request.run_id))
+    finally:
+        firestore_service.release_resync_shard_lease(
+            run_id=shard_request.run_id,
+            shard_index=shard_request.shard_index,
+            holder=holder
+        )
+
+
+@inject
+def sync_emerge_companies_shard_batch(
+    batch_request: EmergeSyncShardBatchRequest,
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    lease_seconds: float = Depends(Provide[Container.config.emerge.sync.lease_seconds])
+) -> List[BatchItemResult]:
+    batch = firestore_service.get_resync_batch(run_id=batch_request.run_id, batch_id=batch_request.batch_id)
+    if batch['status'] == 'done':
+        logger.log_text(
+            f"Batch {batch_request.batch_id} of resync {batch_request.run_id} already synced",
+            severity='DEBUG'
+        )
+        return []
+    results = process_batch(
+        sync_emerge_companies_batch,
+        'hubspot/v1/company-sync/worker',
+        serialization.validate_list(HubSpotCompanySyncRequest, batch['sync_requests']),
+        lane='bulk'
+    )
+    firestore_service.acquire_emerge_sync_lease(
+        holder=resync_lease_holder(batch_request.run_id),
+        duration=lease_seconds
     )
-    firestore_service.set_emerge_sync_last_run_date(last_run_date=start_time.strftime('%m-%d-%Y'))
+    if firestore_service.record_resync_shard_progress(
+        run_id=batch_request.run_id,
+        shard_index=batch_request.shard_index,
+        batch_id=batch_request.batch_id,
+        processed=len(results),
+        failed=len([result for result in results if result.status == BatchItemStatus.FAILED])
+    ):
+        firestore_service.release_emerge_sync_lease(holder=resync_lease_holder(batch_request.run_id))
+    return results
 
 
 @inject
@@ -286,81 +857,665 @@ def get_or_create_hubspot_company_by_name(
         return company_id
 
 
+def get_pricing_property(pricing_tier: PricingTier):
+    if pricing_tier == PricingTier.TIER_2:
+        return 'tier_2'
+    if pricing_tier == PricingTier.TIER_3:
+        return 'tier_3'
+    return 'price'
+
+
+def amounts_equal(current, target):
+    if current is None or target is None:
+        return current == target
+    try:
+        return Decimal(str(current)) == Decimal(str(target))
+    except InvalidOperation:
+        return str(current) == str(target)
+
+
+def plan_line_item_sync(
+    deal_id: int,
+    pricing_tier: Optional[PricingTier],
+    products: dict,
+    deal_line_items: list,
+    prices_only: bool = False
+) -> LineItemSyncPlan:
+    plan = LineItemSyncPlan(deal_id=deal_id, pricing_tier=pricing_tier)
+    if not pricing_tier:
+        plan.line_item_ids_to_delete = [line_item['id'] for line_item in deal_line_items]
+        return plan
+
+    pricing_property = get_pricing_property(pricing_tier)
+    target_products = {
+        product_id: product for product_id, product in products.items()
+        if product.get(pricing_property) and product.get('hs_sku')
+    }
+
+    matched_line_items = {}
+    stale_line_items = []
+    for line_item in deal_line_items:
+        product_id = line_item['properties'].get('hs_product_id')
+        if product_id in target_products and product_id not in matched_line_items:
+            matched_line_items[product_id] = line_item
+        else:
+            # unknown products, products without a price in this tier and duplicates
+            stale_line_items.append(line_item)
+
+    for product_id, line_item in matched_line_items.items():
+        current = line_item['properties']
+        changes = {}
+        if not amounts_equal(current.get('price'), target_products[product_id][pricing_property]):
+            changes['price'] = target_products[product_id][pricing_property]
+        if not prices_only:
+            try:
+                quantity_valid = Decimal(str(current.get('quantity'))) > 0
+            except InvalidOperation:
+                quantity_valid = False
+            if not quantity_valid:
+                changes['quantity'] = "1"
+        if changes:
+            plan.line_items_to_update.append({'id': line_item['id'], 'properties': changes})
+        else:
+            plan.unchanged_line_item_ids.append(line_item['id'])
+
+    if prices_only:
+        return plan
+
+    for product_id, product in target_products.items():
+        if product_id in matched_line_items:
+            continue
+        properties = {
+            'name': product['name'],
+            'hs_product_id': product_id,
+            'quantity': "1",
+            'price': product[pricing_property],
+            'hs_sku': product['hs_sku']
+        }
+        if stale_line_items:
+            # patch a line item we would otherwise delete instead of deleting and recreating it
+            line_item = stale_line_items.pop(0)
+            plan.line_items_to_update.append({'id': line_item['id'], 'properties': properties})
+        else:
+            plan.line_items_to_create.append(properties)
+
+    plan.line_item_ids_to_delete = [line_item['id'] for line_item in stale_line_items]
+    return plan
+
+
 @inject
-def sync_line_items(
-    sync_request: HubSpotLineItemSyncRequest,
+def apply_line_item_sync_plan(
+    plan: LineItemSyncPlan,
+    checkpoint: TaskCheckpoint,
     hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
 ):
+    # the batch executor already retries each chunk, so these steps only record progress
+    if len(plan.line_items_to_update) > 0:
+        checkpoint.step(
+            'update',
+            lambda: hubspot_service.update_line_items(records=plan.line_items_to_update),
+            retry=False
+        )
+
+    if len(plan.line_item_ids_to_delete) > 0:
+        checkpoint.step(
+            'delete',
+            lambda: hubspot_service.delete_line_items(line_item_ids=plan.line_item_ids_to_delete),
+            retry=False
+        )
+
+    if len(plan.line_items_to_create) > 0:
+        def create_line_items():
+            progress = checkpoint.get('create-progress', default={'created': [], 'remaining': plan.line_items_to_create})
+            try:
+                return progress['created'] + hubspot_service.create_line_items(line_items=progress['remaining'])
+            except BatchExecutionError as e:
+                # keep what was created, so a retry only creates the rest
+                checkpoint.record('create-progress', {
+                    'created': progress['created'] + e.results,
+                    'remaining': [item['properties'] for item in e.failed_inputs]
+                })
+                raise
+
+        line_items = checkpoint.step('create', create_line_items, retry=False)
+        checkpoint.step(
+            'associate',
+            lambda: hubspot_service.set_deal_for_line_items(
+                line_items=line_items,
+                deal_id=plan.deal_id
+            ),
+            retry=False
+        )
+
+
+@inject
+def sync_line_items(
+    sync_request: HubSpotLineItemSyncRequest,
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service]),
+    task_checkpoint=Depends(Provider[Container.task_checkpoint])
+) -> LineItemSyncPlan:
+    checkpoint = task_checkpoint(scope=f"line-item-sync-{sync_request.object_id}", enabled=not sync_request.dry_run)
+    # a retry keeps the plan it started with, since the deal's line items change as the plan is applied
+    plan = checkpoint.step(
+        'plan',
+        lambda: read_line_item_sync_plan(sync_request=sync_request, hubspot_service=hubspot_service),
+        model=LineItemSyncPlan
+    )
+    logger.log_text(
+        f"Line item sync plan{' (dry run)' if sync_request.dry_run else ''}: {plan.summary()}",
+        severity='DEBUG'
+    )
+    if not sync_request.dry_run and not plan.is_empty():
+        apply_line_item_sync_plan(plan=plan, checkpoint=checkpoint)
+    checkpoint.complete()
+    return plan
+
+
+def read_line_item_sync_plan(
+    sync_request: HubSpotLineItemSyncRequest,
+    hubspot_service: HubSpotService
+) -> LineItemSyncPlan:
     deal = hubspot_service.get_deal(
         deal_id=sync_request.object_id,
         associations=['line_item']
     )
-    if not sync_request.pricing_tier:
-        if deal.get('associations'):
-            line_item_ids = [association['id'] for association in deal['associations']['line items']['results']]
-            hubspot_service.delete_line_items(line_item_ids=line_item_ids)
-            return
-    products = hubspot_service.get_all_products(property_names=PRODUCT_PROPERTIES)
-    pricing_property = 'price'
-    if sync_request.pricing_tier == PricingTier.TIER_2:
-        pricing_property = 'tier_2'
-    elif sync_request.pricing_tier == PricingTier.TIER_3:
-        pricing_property = 'tier_3'
-
-    line_items_to_update = []
-    line_items_to_delete = []
-    line_items_to_create = []
+    line_item_ids = []
     if deal.get('associations'):
-        known_product_ids = []
         line_item_ids = [association['id'] for association in deal['associations']['line items']['results']]
-        deal_line_items = hubspot_service.get_line_items(line_item_ids=line_item_ids)
-        for line_item in deal_line_items:
-            product_id = line_item['properties']['hs_product_id']
-            if (
-                product_id in products.keys()
-                and products[product_id].get(pricing_property)
-                and products[product_id].get('hs_sku')
-            ):
-                # update existing line items with new prices
-                known_product_ids.append(product_id)
-                amount = products[line_item['properties']['hs_product_id']][pricing_property]
-                line_item['properties']['price'] = amount
-                line_items_to_update.append(line_item)
+
+    products = {}
+    deal_line_items = [{'id': line_item_id, 'properties': {}} for line_item_id in line_item_ids]
+    if sync_request.pricing_tier:
+        products = hubspot_service.get_all_products(property_names=PRODUCT_PROPERTIES)
+        if len(line_item_ids) > 0:
+            deal_line_items = hubspot_service.get_line_items(
+                line_item_ids=line_item_ids,
+                properties=LINE_ITEM_PROPERTIES
+            )
+
+    return plan_line_item_sync(
+        deal_id=sync_request.object_id,
+        pricing_tier=sync_request.pricing_tier,
+        products=products,
+        deal_line_items=deal_line_items
+    )
+
+
+def chunks(items: list, size: int = HUBSPOT_BATCH_LIMIT):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def reprice_deal_chunk(
+    deal_ids: List[str],
+    pricing_tier: PricingTier,
+    products: dict,
+    dry_run: bool,
+    hubspot_service: HubSpotService
+):
+    associations = hubspot_service.get_line_items_for_deals(deal_ids=deal_ids)
+    deal_for_line_item = {
+        line_item.id: result.from_object.id for result in associations.results for line_item in result.to
+    }
+    line_items_by_deal = {deal_id: [] for deal_id in deal_ids}
+    if len(deal_for_line_item) > 0:
+        for line_item in hubspot_service.get_line_items(
+            line_item_ids=list(deal_for_line_item.keys()),
+            properties=LINE_ITEM_PROPERTIES
+        ):
+            line_items_by_deal[deal_for_line_item[line_item['id']]].append(line_item)
+
+    deals_repriced = 0
+    line_items_unchanged = 0
+    line_items_to_update = []
+    for deal_id, deal_line_items in line_items_by_deal.items():
+        plan = plan_line_item_sync(
+            deal_id=deal_id,
+            pricing_tier=pricing_tier,
+            products=products,
+            deal_line_items=deal_line_items,
+            prices_only=True
+        )
+        line_items_unchanged += len(plan.unchanged_line_item_ids)
+        if len(plan.line_items_to_update) > 0:
+            deals_repriced += 1
+            line_items_to_update += plan.line_items_to_update
+
+    if not dry_run and len(line_items_to_update) > 0:
+        hubspot_service.update_line_items(records=line_items_to_update)
+    return deals_repriced, len(line_items_to_update), line_items_unchanged
+
+
+@inject
+def reprice_deals(
+    pricing_tiers: List[PricingTier] = tuple(PricingTier),
+    dry_run: bool = False,
+    max_workers: int = 4,
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> DealRepricingReport:
+    report = DealRepricingReport(pricing_tiers=pricing_tiers, dry_run=dry_run, started_at=datetime.now(timezone.utc))
+    products = hubspot_service.get_all_products(property_names=PRODUCT_PROPERTIES)
+    for pricing_tier in pricing_tiers:
+        deal_ids = hubspot_service.get_all_deal_ids_by_pricing_tier(pricing_tier=pricing_tier.value)
+        report.deals_scanned += len(deal_ids)
+        logger.log_text(
+            f"Repricing {len(deal_ids)} deals on pricing tier {pricing_tier.value}{' (dry run)' if dry_run else ''}",
+            severity='DEBUG'
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    reprice_deal_chunk,
+                    deal_ids=deal_id_chunk,
+                    pricing_tier=pricing_tier,
+                    products=products,
+                    dry_run=dry_run,
+                    hubspot_service=hubspot_service
+                ): deal_id_chunk for deal_id_chunk in chunks(deal_ids)
+            }
+            for future in as_completed(futures):
+                try:
+                    deals_repriced, line_items_updated, line_items_unchanged = future.result()
+                except Exception as e:
+                    logger.log_text(
+                        f"Repricing failed for deals {futures[future]} with the failure: {str(e)}",
+                        severity='DEBUG'
+                    )
+                    report.failed_deal_ids += futures[future]
+                    continue
+                report.deals_repriced += deals_repriced
+                report.line_items_updated += line_items_updated
+                report.line_items_unchanged += line_items_unchanged
+
+    report.completed_at = datetime.now(timezone.utc)
+    logger.log_text(
+        f"Finished repricing deals: {report.model_dump_json()}",
+        severity='DEBUG'
+    )
+    return report
+
+
+def run_batch_write(write, inputs: list, index_for_input, results: List[BatchItemResult]):
+    if len(inputs) == 0:
+        return
+    try:
+        write(inputs)
+        return
+    except BatchExecutionError as e:
+        failed_inputs = e.failed_inputs
+        error = e
+    except Exception as e:
+        failed_inputs = inputs
+        error = e
+    for failed_input in failed_inputs:
+        indexes = index_for_input(failed_input)
+        for index in indexes if isinstance(indexes, list) else [indexes]:
+            results[index].fail(error)
+
+
+@inject
+def enqueue_failed_batch_items(
+    relative_handler_uri: str,
+    sync_requests: list,
+    results: List[BatchItemResult],
+    lane: str = None,
+    task_service: TaskService = Depends(Provide[Container.task_service])
+):
+    # failed items are retried one by one on the single item worker instead of retrying the whole batch
+    for sync_request, result in zip(sync_requests, results):
+        if result.status == BatchItemStatus.FAILED:
+            task_service.enqueue(
+                relative_handler_uri,
+                payload=sync_request,
+                lane=lane
+            )
+
+
+def process_batch(
+    batch_function,
+    relative_handler_uri: str,
+    sync_requests: list,
+    lane: str = None
+) -> List[BatchItemResult]:
+    results = batch_function(sync_requests=sync_requests)
+    failed = len([result for result in results if result.status == BatchItemStatus.FAILED])
+    logger.log_text(
+        f"Processed batch of {len(sync_requests)} for {relative_handler_uri} with {failed} failures",
+        severity='DEBUG'
+    )
+    enqueue_failed_batch_items(
+        relative_handler_uri=relative_handler_uri,
+        sync_requests=sync_requests,
+        results=results,
+        lane=lane
+    )
+    return results
+
+
+def dedupe_batch_items(sync_requests: list, results: List[BatchItemResult]):
+    latest = {}
+    for index, sync_request in enumerate(sync_requests):
+        if sync_request.object_id in latest:
+            results[latest[sync_request.object_id]].skip(f"Superseded by a later request for {sync_request.object_id}")
+        latest[sync_request.object_id] = index
+    return list(latest.values())
+
+
+@inject
+def sync_emerge_companies_batch(
+    sync_requests: List[HubSpotCompanySyncRequest],
+    emerge_service: EmergeService = Depends(Provide[Container.emerge_service]),
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> List[BatchItemResult]:
+    results = [BatchItemResult(object_id=sync_request.object_id) for sync_request in sync_requests]
+    indices = []
+    for index, sync_request in enumerate(sync_requests):
+        if not sync_request.emerge_company_id:
+            results[index].skip(f"Emerge Company ID was blank for {sync_request.object_id}")
+        else:
+            indices.append(index)
+
+    # shared lookups for the whole batch
+    billing_results = {}
+    periods = {}
+    for index in indices:
+        sync_request = sync_requests[index]
+        periods.setdefault((sync_request.year, sync_request.month), set()).add(sync_request.emerge_company_id)
+    for (year, month), company_ids in periods.items():
+        for billing_result in emerge_service.get_customers_billing_info(
+            company_ids=list(company_ids),
+            year=year,
+            month=month,
+            use_snapshot=False
+        ):
+            billing_results[(billing_result.company_id, year, month)] = billing_result
+
+    deal_ids = list({
+        sync_requests[index].object_id for index in indices
+        if sync_requests[index].object_id and sync_requests[index].type != 'COMPANY'
+    })
+    try:
+        companies_for_deals = hubspot_service.get_companies_for_deals(deal_ids=deal_ids) if deal_ids else {}
+    except Exception as e:
+        for index in indices:
+            results[index].fail(e)
+        return results
+
+    owner_ids = {}
+    for email in {sync_requests[index].account_manager_email for index in indices}:
+        try:
+            owner_ids[email] = hubspot_service.get_owner_by_email(email=email)
+        except Exception as e:
+            logger.log_text(f"Failed to look up owner {email}: {str(e)}", severity='DEBUG')
+
+    # resolve the HubSpot company for every request
+    hubspot_company_ids = {}
+    unresolved = []
+    for index in indices:
+        sync_request = sync_requests[index]
+        billing_result = billing_results[(sync_request.emerge_company_id, sync_request.year, sync_request.month)]
+        if not billing_result.ok:
+            results[index].fail(billing_result.error)
+        elif sync_request.type == 'COMPANY' and sync_request.object_id:
+            hubspot_company_ids[index] = sync_request.object_id
+        elif sync_request.type == 'DEAL' and str(sync_request.object_id) in companies_for_deals:
+            hubspot_company_ids[index] = companies_for_deals[str(sync_request.object_id)]
+        else:
+            unresolved.append(index)
+    try:
+        companies_by_emerge_company = hubspot_service.get_companies_by_emerge_companies(
+            emerge_company_ids=list({sync_requests[index].emerge_company_id for index in unresolved})
+        ) if unresolved else {}
+    except Exception as e:
+        for index in unresolved:
+            results[index].fail(e)
+        unresolved = []
+    for index in unresolved:
+        sync_request = sync_requests[index]
+        companies = companies_by_emerge_company.get(str(sync_request.emerge_company_id), [])
+        if len(companies) == 0:
+            if str(sync_request.object_id) in companies_for_deals:
+                hubspot_company_ids[index] = companies_for_deals[str(sync_request.object_id)]
             else:
-                # delete line items for unknown products or unknown price
-                line_items_to_delete.append(line_item['id'])
-
-        if len(line_items_to_update) > 0:
-            hubspot_service.update_line_items(records=line_items_to_update)
-
-        if len(line_items_to_delete) > 0:
-            hubspot_service.delete_line_items(line_item_ids=line_items_to_delete)
-
-        # create missing line items
-        for product_id, product in products.items():
-            if product_id not in known_product_ids:
-                if product.get(pricing_property) and product.get('hs_sku'):
-                    properties = {
-                        'name': product['name'],
-                        'hs_product_id': product_id,
-                        'quantity': "1",
-                        'price': product[pricing_property]
-                    }
-                    line_items_to_create.append(properties)
-    else:
-        for product_id, product in products.items():
-            if product.get(pricing_property) and product.get('hs_sku'):
-                properties = {
-                    'name': product['name'],
-                    'hs_product_id': product_id,
-                    'quantity': 1,
-                    'price': product[pricing_property]
-                }
-                line_items_to_create.append(properties)
+                results[index].skip(
+                    f"Unable to locate a company in HubSpot by Emerge Company ID {sync_request.emerge_company_id}"
+                )
+            continue
+        hubspot_company_ids[index] = companies[0]['id']
+        try:
+            for company_to_merge in companies[1:]:
+                hubspot_service.merge_companies(
+                    company_to_merge=company_to_merge['id'],
+                    company_to_keep=companies[0]['id']
+                )
+        except Exception as e:
+            results[index].fail(e)
+            del hubspot_company_ids[index]
+
+    # batch the company updates, keeping the last request for each company
+    updates = {}
+    for index, hubspot_company_id in hubspot_company_ids.items():
+        sync_request = sync_requests[index]
+        if str(hubspot_company_id) in updates:
+            results[updates[str(hubspot_company_id)][0]].skip(
+                f"Superseded by a later request for company {hubspot_company_id}"
+            )
+        billing_result = billing_results[(sync_request.emerge_company_id, sync_request.year, sync_request.month)]
+        updates[str(hubspot_company_id)] = (
+            index,
+            billing_result.billing_info.to_hubspot_company(
+                days_from_last_report=sync_request.days_from_last_report,
+                owner_id=owner_ids.get(sync_request.account_manager_email),
+                status_change_date=sync_request.status_change_date
+            )
+        )
+    run_batch_write(
+        write=lambda records: hubspot_service.update_companies(records=records),
+        inputs=[{'id': company_id, 'properties': properties} for company_id, (_, properties) in updates.items()],
+        index_for_input=lambda record: updates[record['id']][0],
+        results=results
+    )
+    return results
+
+
+@inject
+def associate_customer_deals_batch(
+    sync_requests: List[HubSpotDealSyncRequest],
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> List[BatchItemResult]:
+    results = [BatchItemResult(object_id=sync_request.object_id) for sync_request in sync_requests]
+    indices = dedupe_batch_items(sync_requests=sync_requests, results=results)
+    try:
+        companies_for_deals = hubspot_service.get_companies_for_deals(
+            deal_ids=[sync_requests[index].object_id for index in indices]
+        )
+    except Exception as e:
+        for index in indices:
+            results[index].fail(e)
+        return results
+
+    index_for_deal = {str(sync_requests[index].object_id): index for index in indices}
+    unresolved = [deal_id for deal_id in index_for_deal if deal_id not in companies_for_deals]
+    if unresolved:
+        companies_for_deals.update(
+            resolve_customer_deal_companies(deal_ids=unresolved, index_for_deal=index_for_deal, results=results)
+        )
+    associations = [
+        {'deal_id': deal_id, 'company_id': companies_for_deals[deal_id]}
+        for deal_id in index_for_deal if deal_id in companies_for_deals
+    ]
+    run_batch_write(
+        write=lambda inputs: hubspot_service.set_customer_company_for_deals(associations=inputs),
+        inputs=associations,
+        index_for_input=lambda association: index_for_deal[
+            str(association['from']['id'] if 'from' in association else association['deal_id'])
+        ],
+        results=results
+    )
+    return results
+
+
+@inject
+def sync_line_items_batch(
+    sync_requests: List[HubSpotLineItemSyncRequest],
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service])
+) -> List[BatchItemResult]:
+    results = [BatchItemResult(object_id=sync_request.object_id) for sync_request in sync_requests]
+    indices = dedupe_batch_items(sync_requests=sync_requests, results=results)
+    try:
+        associations = hubspot_service.get_line_items_for_deals(
+            deal_ids=[sync_requests[index].object_id for index in indices]
+        )
+        line_item_ids_by_deal = {
+            result.from_object.id: [line_item.id for line_item in result.to] for result in associations.results
+        }
+        tiered = [index for index in indices if sync_requests[index].pricing_tier]
+        products = hubspot_service.get_all_products(property_names=PRODUCT_PROPERTIES) if tiered else {}
+        line_item_ids = [
+            line_item_id for index in tiered
+            for line_item_id in line_item_ids_by_deal.get(str(sync_requests[index].object_id), [])
+        ]
+        line_items = {
+            line_item['id']: line_item for line_item in hubspot_service.get_line_items(
+                line_item_ids=line_item_ids,
+                properties=LINE_ITEM_PROPERTIES
+            )
+        } if line_item_ids else {}
+    except Exception as e:
+        for index in indices:
+            results[index].fail(e)
+        return results
 
-    if len(line_items_to_create) > 0:
-        line_items = hubspot_service.create_line_items(line_items=line_items_to_create)
-        hubspot_service.set_deal_for_line_items(
-            line_items=line_items,
-            deal_id=sync_request.object_id
+    index_for_line_item = {}
+    index_for_deal = {}
+    updates = []
+    deletes = []
+    creates = {}
+    for index in indices:
+        sync_request = sync_requests[index]
+        deal_line_item_ids = line_item_ids_by_deal.get(str(sync_request.object_id), [])
+        plan = plan_line_item_sync(
+            deal_id=sync_request.object_id,
+            pricing_tier=sync_request.pricing_tier,
+            products=products,
+            deal_line_items=[
+                line_items[line_item_id] for line_item_id in deal_line_item_ids if line_item_id in line_items
+            ] if sync_request.pricing_tier else [
+                {'id': line_item_id, 'properties': {}} for line_item_id in deal_line_item_ids
+            ]
         )
+        results[index].detail = plan.summary()
+        if sync_request.dry_run or plan.is_empty():
+            continue
+        for line_item in plan.line_items_to_update:
+            index_for_line_item[line_item['id']] = index
+        for line_item_id in plan.line_item_ids_to_delete:
+            index_for_line_item[line_item_id] = index
+        updates += plan.line_items_to_update
+        deletes += plan.line_item_ids_to_delete
+        if len(plan.line_items_to_create) > 0:
+            index_for_deal[str(sync_request.object_id)] = index
+            creates[sync_request.object_id] = plan.line_items_to_create
+
+    run_batch_write(
+        write=lambda records: hubspot_service.update_line_items(records=records),
+        inputs=updates,
+        index_for_input=lambda record: index_for_line_item[record['id']],
+        results=results
+    )
+    run_batch_write(
+        write=lambda line_item_ids: hubspot_service.delete_line_items(line_item_ids=line_item_ids),
+        inputs=deletes,
+        index_for_input=lambda failed_input: index_for_line_item[
+            failed_input['id'] if isinstance(failed_input, dict) else failed_input
+        ],
+        results=results
+    )
+    run_batch_write(
+        write=lambda deal_ids: hubspot_service.create_deal_line_items(
+            line_items_by_deal={deal_id: creates[deal_id] for deal_id in deal_ids}
+        ),
+        inputs=list(creates.keys()),
+        index_for_input=lambda failed_input: index_for_deal[
+            str(failed_input['associations'][0]['to']['id']) if isinstance(failed_input, dict) else str(failed_input)
+        ],
+        results=results
+    )
+    return results
+
+
+@inject
+def warm_up(
+    hubspot_service: HubSpotService = Depends(Provide[Container.hubspot_service]),
+    firestore_service: FirestoreService = Depends(Provide[Container.firestore_service]),
+    config=Depends(Provider[Container.config])
+) -> dict:
+    # building the HubSpot client already refreshed an expired token, persist it and hand it to later clients
+    if hubspot_service.hubspot_client.auth_refreshed:
+        hubspot_service.ensure_auth()
+        config.from_dict({
+            'hubspot': {
+                'access_token': hubspot_service.hubspot_client.access_token,
+                'expires_at': hubspot_service.hubspot_client.expires_at
+            }
+        })
+        logger.log_text('Refreshed the HubSpot access token during warm-up', severity='INFO')
+
+    steps = {
+        'products': lambda: len(hubspot_service.get_all_products(property_names=PRODUCT_PROPERTIES, refresh=True)),
+        'owners': hubspot_service.load_owners,
+        'settings': lambda: len(firestore_service.get_hubspot_sync_settings(refresh=True))
+    }
+
+    def run(name):
+        started = time.perf_counter()
+        try:
+            return {'loaded': steps[name](), 'seconds': round(time.perf_counter() - started, 3)}
+        except Exception as e:
+            logger.log_text(f"Warm-up step {name} failed: {str(e)}", severity='WARNING')
+            return {'failed': True, 'seconds': round(time.perf_counter() - started, 3)}
+
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        results = dict(zip(steps, executor.map(run, steps)))
+    logger.log_text(f"Warm-up finished: {results}", severity='INFO')
+    return results
+
+
+# handlers for the in-process task backend, keyed by the worker endpoint they stand in for
+TASK_HANDLERS = {
+    'hubspot/v1/events/worker': lambda payload: route_hubspot_events(
+        events=[HubSpotWebhookEvent.model_validate(event) for event in payload]
+    ),
+    'hubspot/v1/company-sync/worker': lambda payload: sync_emerge_company_to_hubspot(
+        hubspot_company_sync_request=HubSpotCompanySyncRequest.model_validate(payload)
+    ),
+    'hubspot/v1/deal-sync/worker': lambda payload: associate_customer_deal(
+        hubspot_deal_sync_request=HubSpotDealSyncRequest.model_validate(payload)
+    ),
+    'hubspot/v1/line-item-sync/worker': lambda payload: sync_line_items(
+        sync_request=HubSpotLineItemSyncRequest.model_validate(payload)
+    ),
+    'intellifi/v1/companies/sync/shard/worker': lambda payload: sync_emerge_companies_shard(
+        shard_request=EmergeSyncShardRequest.model_validate(payload)
+    ),
+    'intellifi/v1/companies/sync/shard/batch/worker': lambda payload: sync_emerge_companies_shard_batch(
+        batch_request=EmergeSyncShardBatchRequest.model_validate(payload)
+    ),
+    'hubspot/v1/company-sync/batch/worker': lambda payload: process_batch(
+        sync_emerge_companies_batch,
+        'hubspot/v1/company-sync/worker',
+        [HubSpotCompanySyncRequest.model_validate(item) for item in payload],
+        lane='bulk'
+    ),
+    'hubspot/v1/deal-sync/batch/worker': lambda payload: process_batch(
+        associate_customer_deals_batch,
+        'hubspot/v1/deal-sync/worker',
+        [HubSpotDealSyncRequest.model_validate(item) for item in payload],
+        lane='webhooks'
+    ),
+    'hubspot/v1/line-item-sync/batch/worker': lambda payload: process_batch(
+        sync_line_items_batch,
+        'hubspot/v1/line-item-sync/worker',
+        [HubSpotLineItemSyncRequest.model_validate(item) for item in payload],
+        lane='line_items'
+    ),
+}
@@ -0,0 +1,147 @@
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+import requests
+
+RUN_ID_HEADER = 'X-Intellifi-Run-Id'
+# rate limited or overloaded responses the clients back off from, counted apart from errors
+THROTTLED_STATUSES = (429, 502)
+SERVICE_HOSTS = {
+    'api.hubapi.com': 'hubspot',
+    'hbintegration.intelifi.com': 'emerge',
+    'test.intelifi.com': 'emerge',
+}
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+EMERGE_DATE = re.compile(r'/\d{2}-\d{2}-\d{4}(?=/|$)')
+
+
+class CallLedger:
+
+    def __init__(self, run_id: str = None, job: str = None) -> None:
+        self.run_id = run_id or uuid4().hex
+        self.job = job
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def record(
+        self,
+        service: str,
+        endpoint: str,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        throttled: bool = False,
+        failed: bool = False
+    ):
+        with self.lock:
+            entry = self.entries.setdefault(
+                (service, endpoint),
+                {'calls': 0, 'bytes_sent': 0, 'bytes_received': 0, 'throttled': 0, 'errors': 0}
+            )
+            entry['calls'] += 1
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+            entry['throttled'] += int(throttled)
+            entry['errors'] += int(failed)
+
+    def summary(self) -> dict:
+        with self.lock:
+            summary = {}
+            for (service, endpoint), entry in self.entries.items():
+                summary.setdefault(service, {})[endpoint] = dict(entry)
+            return summary
+
+    def __len__(self):
+        return len(self.entries)
+
+
+current_ledger: ContextVar[Optional[CallLedger]] = ContextVar('current_ledger', default=None)
+
+
+def current_run_id() -> Optional[str]:
+    ledger = current_ledger.get()
+    return ledger.run_id if ledger else None
+
+
+def bind_run(run_id: str):
+    # resumed jobs keep reporting against the run they started under
+    ledger = current_ledger.get()
+    if ledger is not None and run_id:
+        ledger.run_id = run_id
+
+
+def record(service: str, endpoint: str, **kwargs):
+    ledger = current_ledger.get()
+    if ledger is not None:
+        ledger.record(service, endpoint, **kwargs)
+
+
+@contextmanager
+def recording(ledger: CallLedger):
+    token = current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        current_ledger.reset(token)
+
+
+def counted(service: str):
+    # for gRPC backed clients, where calls are counted per service method rather than on the wire
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                record(service, function.__name__, failed=True)
+                raise
+            record(service, function.__name__)
+            return result
+        return wrapper
+    return decorator
+
+
+def endpoint_for(method: str, url: str):
+    parts = urlsplit(url)
+    path = EMERGE_DATE.sub('/{date}', ID_SEGMENT.sub('/{id}', parts.path))
+    return SERVICE_HOSTS.get(parts.hostname, parts.hostname), f"{method} {path}"
+
+
+def instrument_requests():
+    # the Emerge and HubSpot clients call requests directly, so calls are counted where they hit the wire
+    if getattr(requests.Session.send, 'ledger_instrumented', False):
+        return
+    send = requests.Session.send
+
+    @wraps(send)
+    def counted_send(session, request, **kwargs):
+        ledger = current_ledger.get()
+        if ledger is None:
+            return send(session, request, **kwargs)
+        service, endpoint = endpoint_for(request.method, request.url)
+        body = request.body or b''
+        bytes_sent = len(body.encode() if isinstance(body, str) else body)
+        try:
+            response = send(session, request, **kwargs)
+        except Exception:
+            ledger.record(service, endpoint, bytes_sent=bytes_sent, failed=True)
+            raise
+        ledger.record(
+            service,
+            endpoint,
+            bytes_sent=bytes_sent,
+            bytes_received=int(response.headers.get('Content-Length', 0)) if kwargs.get('stream') else len(
+                response.content or b''
+            ),
+            throttled=response.status_code in THROTTLED_STATUSES,
+            failed=response.status_code >= 400 and response.status_code not in THROTTLED_STATUSES
+        )
+        return response
+
+    counted_send.ledger_instrumented = True
+    requests.Session.send = counted_send
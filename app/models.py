@@ -34,20 +34,32 @@ class HubSpotWebhookEvent(BaseModel):
 
 
 class HubSpotCompanySyncRequest(BaseModel):
-    object_id: Optional[int]
+    object_id: Optional[int] = None
     type: str
-    year: int = datetime.today().year
-    month: int = datetime.today().month
-    emerge_company_id: Optional[int]
-    days_from_last_report: Optional[int]
-    account_manager_email: Optional[str]
-    status_change_date: Optional[int]
+    year: int = Field(default_factory=lambda: datetime.today().year)
+    month: int = Field(default_factory=lambda: datetime.today().month)
+    emerge_company_id: Optional[int] = None
+    days_from_last_report: Optional[int] = None
+    account_manager_email: Optional[str] = None
+    status_change_date: Optional[int] = None
 
 
 class HubSpotDealSyncRequest(BaseModel):
     object_id: int
 
 
+class EmergeSyncShardRequest(BaseModel):
+    run_id: str
+    shard_index: int
+    shard_count: int
+
+
+class EmergeSyncShardBatchRequest(BaseModel):
+    run_id: str
+    shard_index: int
+    batch_id: str
+
+
 class PricingTier(str, Enum):
     TIER_1 = "A"
     TIER_2 = "B"
@@ -56,7 +68,60 @@ class PricingTier(str, Enum):
 
 class HubSpotLineItemSyncRequest(BaseModel):
     object_id: int
-    pricing_tier: Optional[PricingTier]
+    pricing_tier: Optional[PricingTier] = None
+    dry_run: bool = False
+
+
+class LineItemSyncPlan(BaseModel):
+    deal_id: int
+    pricing_tier: Optional[PricingTier] = None
+    line_items_to_create: List[dict] = []
+    line_items_to_update: List[dict] = []
+    line_item_ids_to_delete: List[str] = []
+    unchanged_line_item_ids: List[str] = []
+
+    def is_empty(self):
+        return not (self.line_items_to_create or self.line_items_to_update or self.line_item_ids_to_delete)
+
+    def summary(self):
+        return (
+            f"Deal {self.deal_id} (tier {self.pricing_tier.value if self.pricing_tier else None}): "
+            f"create {len(self.line_items_to_create)}, update {len(self.line_items_to_update)}, "
+            f"delete {len(self.line_item_ids_to_delete)}, associate {len(self.line_items_to_create)}, "
+            f"unchanged {len(self.unchanged_line_item_ids)}"
+        )
+
+
+class DealRepricingReport(BaseModel):
+    pricing_tiers: List[PricingTier]
+    dry_run: bool = False
+    started_at: datetime
+    completed_at: Optional[datetime] = None
+    deals_scanned: int = 0
+    deals_repriced: int = 0
+    line_items_updated: int = 0
+    line_items_unchanged: int = 0
+    failed_deal_ids: List[str] = []
+
+
+class BatchItemStatus(str, Enum):
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+
+class BatchItemResult(BaseModel):
+    object_id: Optional[int] = None
+    status: BatchItemStatus = BatchItemStatus.SUCCEEDED
+    detail: Optional[str] = None
+
+    def fail(self, error):
+        self.status = BatchItemStatus.FAILED
+        self.detail = str(error)
+
+    def skip(self, reason: str):
+        self.status = BatchItemStatus.SKIPPED
+        self.detail = reason
 
 
 class HubSpotAssociation(BaseModel):
@@ -130,6 +195,8 @@ class EmergeCompanyBillingInfo(BaseModel):
     product_types_last_month: Optional[EmergeProductTypes] = Field(alias="ProductsTypeLastMonth", default=None)
     product_types_current_month: Optional[EmergeProductTypes] = Field(alias="ProductsTypeCurrentMonth", default=None)
     product_types_ytd: Optional[EmergeProductTypes] = Field(alias="ProductsTypeYTD", default=None)
+    stale_as_of: Optional[datetime] = Field(default=None, exclude=True)
+    unavailable: bool = Field(default=False, exclude=True)
 
     def to_hubspot_company(
         self,
@@ -239,6 +306,10 @@ class EmergeCompanyBillingInfo(BaseModel):
 
                 if self.sales_current_month.volume > 499:
                     company_name = f"{company_name} ⭐"
+            if self.unavailable:
+                company_name = 'Emerge is temporarily unavailable'
+            elif self.stale_as_of:
+                company_name = f"{company_name} (as of {self.stale_as_of.strftime('%b %d %H:%M UTC')})"
             data = {
                 "objectId": self.company_id,
                 "title": company_name,
@@ -265,3 +336,13 @@ class EmergeCompanyBillingInfo(BaseModel):
         return {
             'results': results
         }
+
+
+class EmergeBillingInfoResult(BaseModel):
+    company_id: int
+    billing_info: Optional[EmergeCompanyBillingInfo] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.error is None
@@ -0,0 +1,223 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import os
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import sleep
+
+import requests
+from dependency_injector import providers
+from ExpressIntegrations.Emerge import emerge
+from ExpressIntegrations.HubSpot import hubspot
+
+from . import serialization
+from .capture import read_deliveries
+from .services import RateLimiter
+
+
+class StandInHubSpotClient(hubspot.hubspot):
+
+    def __init__(self, latency: float = 0.05) -> None:
+        # skips the OAuth refresh in the real constructor
+        self.latency = latency
+        self.auth_refreshed = False
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            return str(next(self.ids))
+
+    def custom_request(self, method=None, endpoint=None, **kwargs):
+        sleep(self.latency)
+        body = serialization.loads(kwargs['data']) if kwargs.get('data') else {}
+        now = datetime.now(timezone.utc).isoformat()
+        if endpoint.endswith('/search'):
+            content = {'total': 0, 'results': []}
+        elif 'associations' in endpoint and endpoint.endswith('/batch/read'):
+            content = {'status': 'COMPLETE', 'results': [], 'startedAt': now, 'completedAt': now}
+        elif '/batch/' in endpoint:
+            content = {
+                'status': 'COMPLETE',
+                'results': [
+                    item if 'from' in item else {
+                        'id': str(item.get('id') or self.next_id()),
+                        'properties': item.get('properties', {})
+                    } for item in body.get('inputs', [])
+                ],
+                'startedAt': now,
+                'completedAt': now
+            }
+        else:
+            content = {'id': self.next_id(), 'properties': body.get('properties', {}), 'results': []}
+        return {'status_code': 200, 'content': content}
+
+
+class StandInEmergeClient(emerge.emerge):
+
+    def __init__(self, latency: float = 0.2, customers: int = 100) -> None:
+        self.latency = latency
+        self.customer_count = customers
+
+    def api_call(self, method, endpoint, data=None):
+        sleep(self.latency)
+        if '/customers/' in endpoint:
+            return [self.customer(company_id) for company_id in range(1, self.customer_count + 1)]
+        company_id = int(endpoint.split('/billing/')[1].split('/')[0])
+        return {
+            **self.customer(company_id),
+            'SalesLastMonth': {'Volume': 100, 'Sales': 1000.0},
+            'SalesCurrentMonth': {'Volume': 120, 'Sales': 1200.0}
+        }
+
+    @staticmethod
+    def customer(company_id: int):
+        return {
+            'EmergeCompanyId': company_id,
+            'EmergeCompanyName': f"Stand-in Company {company_id}",
+            'HubSpotObjectId': None,
+            'AccountStatus': 'Active',
+            'DateOpened': '2020-01-01T00:00:00',
+            'NumberOfUsers': 5,
+            'NumberOfLocations': 1,
+            'LastModifiedDate': datetime.now(timezone.utc).isoformat()
+        }
+
+
+def serve(args):
+    import uvicorn
+
+    from .application import build_app
+    from .containers import Container
+
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit('Start the Firestore emulator and set FIRESTORE_EMULATOR_HOST before serving stand-ins')
+    container = Container()
+    container.config.from_yaml(f'etc/config-{args.env}.yaml')
+    container.config.hubspot.client_secret.from_value(args.secret)
+    container.config.gcloud.tasks.backend.from_value('in_process')
+    container.hubspot_client.override(providers.Factory(StandInHubSpotClient, latency=args.hubspot_latency))
+    container.emerge_client.override(
+        providers.Factory(StandInEmergeClient, latency=args.emerge_latency, customers=args.customers)
+    )
+    db = container.firestore_client()
+    db.collection('hubspot_sync').document('settings').set({'line_item_sync_enabled': True, 'forms_enabled': True})
+    db.collection('emerge_sync').document('settings').set({}, merge=True)
+    uvicorn.run(build_app(container), host=args.host, port=args.port, log_level='warning')
+
+
+def sign(secret: str, method: str, url: str, body: str, timestamp: str) -> str:
+    message = f"{method}{url.replace('http://', 'https://')}{body}{timestamp}"
+    return base64.b64encode(hmac.new(key=secret.encode(), msg=message.encode(), digestmod=hashlib.sha256).digest()).decode()
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def replay(args):
+    deliveries = [
+        delivery for delivery in read_deliveries(args.capture)
+        if not args.path or delivery['path'] in args.path
+    ] * args.repeat
+    if not deliveries:
+        raise SystemExit(f"No deliveries to replay in {args.capture}")
+    rate_limiter = RateLimiter(requests_per_second=args.rate)
+    sessions = threading.local()
+    latencies = []
+    statuses = Counter()
+    by_path = {}
+    lock = threading.Lock()
+
+    def send(delivery):
+        rate_limiter.acquire()
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        url = f"{args.target.rstrip('/')}{delivery['path']}"
+        if delivery['query']:
+            url = f"{url}?{delivery['query']}"
+        body = serialization.dumps(delivery['body']).decode() if delivery['body'] is not None else ''
+        headers = dict(delivery['headers'])
+        if delivery['signed']:
+            timestamp = str(int(time.time() * 1000))
+            headers['x-hubspot-request-timestamp'] = timestamp
+            headers['x-hubspot-signature-v3'] = sign(args.secret, delivery['method'], url, body, timestamp)
+        started = time.perf_counter()
+        try:
+            status = sessions.session.request(
+                delivery['method'],
+                url,
+                data=body.encode(),
+                headers=headers,
+                timeout=args.timeout
+            ).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+            by_path.setdefault(delivery['path'], []).append((elapsed, status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, deliveries))
+    duration = time.perf_counter() - started
+
+    def failed(status):
+        return not isinstance(status, int) or status >= 400
+
+    print(f"Replayed {len(deliveries)} deliveries in {duration:.1f}s ({len(deliveries) / duration:.1f}/s)"
+          f" with concurrency {args.concurrency}")
+    print(f"Latency p50 {percentile(latencies, 0.5) * 1000:.0f}ms, p90 {percentile(latencies, 0.9) * 1000:.0f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms, max {max(latencies) * 1000:.0f}ms")
+    print(f"Errors {sum(count for status, count in statuses.items() if failed(status)) / len(deliveries):.1%}: "
+          f"{dict(statuses)}")
+    for path, results in sorted(by_path.items()):
+        path_latencies = [elapsed for elapsed, _ in results]
+        print(f"  {path}: {len(results)} requests, mean {statistics.mean(path_latencies) * 1000:.0f}ms, "
+              f"p99 {percentile(path_latencies, 0.99) * 1000:.0f}ms, "
+              f"{len([status for _, status in results if failed(status)])} errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured deliveries against a local instance')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='Run the app against stand-in HubSpot and Emerge clients')
+    serve_parser.add_argument('--env', default='dev')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--secret', default='replay-secret')
+    serve_parser.add_argument('--hubspot-latency', type=float, default=0.05)
+    serve_parser.add_argument('--emerge-latency', type=float, default=0.2)
+    serve_parser.add_argument('--customers', type=int, default=100)
+    serve_parser.set_defaults(function=serve)
+
+    run_parser = commands.add_parser('run', help='Fire captured deliveries at a target')
+    run_parser.add_argument('capture')
+    run_parser.add_argument('--target', default='http://127.0.0.1:8080')
+    run_parser.add_argument('--secret', default='replay-secret')
+    run_parser.add_argument('--rate', type=float, default=0, help='requests per second, 0 for unthrottled')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--repeat', type=int, default=1)
+    run_parser.add_argument('--timeout', type=float, default=30)
+    run_parser.add_argument('--path', action='append', help='only replay deliveries to this path')
+    run_parser.set_defaults(function=replay)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
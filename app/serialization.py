@@ -0,0 +1,39 @@
+from functools import lru_cache
+from typing import Any, List, Type
+
+import pydantic_core
+from pydantic import BaseModel, TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def type_adapter(tp: Any) -> TypeAdapter:
+    return TypeAdapter(tp)
+
+
+def validate_list(model: Type[BaseModel], items: list) -> list:
+    return type_adapter(List[model]).validate_python(items)
+
+
+def dumps(value: Any, exclude_unset: bool = False, exclude_none: bool = False, by_alias: bool = False) -> bytes:
+    # models are serialized straight to JSON bytes without an intermediate dict, using pydantic-core's encoder
+    if isinstance(value, BaseModel):
+        return type_adapter(type(value)).dump_json(
+            value,
+            exclude_unset=exclude_unset,
+            exclude_none=exclude_none,
+            by_alias=by_alias
+        )
+    if isinstance(value, list) and len(value) > 0 and isinstance(value[0], BaseModel) and all(
+        type(item) is type(value[0]) for item in value
+    ):
+        return type_adapter(List[type(value[0])]).dump_json(
+            value,
+            exclude_unset=exclude_unset,
+            exclude_none=exclude_none,
+            by_alias=by_alias
+        )
+    return pydantic_core.to_json(value, by_alias=by_alias)
+
+
+def loads(data: bytes) -> Any:
+    return pydantic_core.from_json(data)
@@ -1,9 +1,23 @@
-import json
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 from time import sleep
+from typing import Callable, Dict, Iterator, List, Optional
+from uuid import uuid4
 
 import pandadoc_client
+import requests
 from ExpressIntegrations.Emerge import emerge
 from ExpressIntegrations.HubSpot import hubspot
+from google.api_core.exceptions import NotFound
 from google.cloud import firestore, logging, tasks_v2
 from pandadoc_client.api import documents_api
 from pandadoc_client.model.document_create_by_template_request_tokens import DocumentCreateByTemplateRequestTokens
@@ -14,18 +28,245 @@ from pandadoc_client.model.pricing_table_request import PricingTableRequest
 from pandadoc_client.model.pricing_table_request_row_options import PricingTableRequestRowOptions
 from pandadoc_client.model.pricing_table_request_rows import PricingTableRequestRows
 from pandadoc_client.model.pricing_table_request_sections import PricingTableRequestSections
+from urllib3.util.retry import Retry
 
-from .models import EmergeCompanyBillingInfo, EmergeCompanyInfo, HubSpotAssociationBatchReadResponse, \
-    PandadocProposalRequest
+from . import ledger, serialization
+from .models import EmergeBillingInfoResult, EmergeCompanyBillingInfo, EmergeCompanyInfo, \
+    HubSpotAssociationBatchReadResponse, HubSpotAssociationResult, HubSpotWebhookEvent, PandadocProposalRequest
 
 log_name = 'intellifi.services'
 
+TASK_NAME_HEADER = 'X-CloudTasks-TaskName'
+
+current_task_name: ContextVar[Optional[str]] = ContextVar('current_task_name', default=None)
+
+
+@contextmanager
+def task_scope(task_name: Optional[str]):
+    token = current_task_name.set(task_name)
+    try:
+        yield task_name
+    finally:
+        current_task_name.reset(token)
+
+
+class LazyLogger:
+    # one Cloud Logging client per process, created on the first log line rather than at import
+    client = None
+    lock = threading.Lock()
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.logger = None
+
+    def log_text(self, text: str, **kwargs):
+        with LazyLogger.lock:
+            if LazyLogger.client is None:
+                LazyLogger.client = logging.Client()
+            client = LazyLogger.client
+        if self.logger is None or self.logger.client is not client:
+            self.logger = client.logger(self.name)
+        return self.logger.log_text(text, **kwargs)
+
+    @classmethod
+    def reset(cls):
+        # forked workers build their own client instead of sharing the parent's channel
+        with cls.lock:
+            cls.client = None
+
 
 class BaseService:
 
     def __init__(self) -> None:
-        logging_client = logging.Client()
-        self.logger = logging_client.logger(log_name)
+        self.logger = LazyLogger(log_name)
+
+
+class RateLimiter:
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(BaseService):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        minimum_calls: int = 10,
+        window_size: int = 20,
+        slow_call_seconds: float = 10.0,
+        open_seconds: float = 30.0,
+        half_open_max_calls: int = 1
+    ) -> None:
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.outcomes = deque(maxlen=window_size)
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        super().__init__()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self.half_open_calls = 0
+            if self.state == self.HALF_OPEN:
+                if self.half_open_calls >= self.half_open_max_calls:
+                    return False
+                self.half_open_calls += 1
+            return True
+
+    def record(self, succeeded: bool):
+        tripped = False
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if succeeded:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                else:
+                    self.trip()
+                    tripped = True
+            else:
+                self.outcomes.append(succeeded)
+                failures = self.outcomes.count(False)
+                if len(self.outcomes) >= self.minimum_calls and \
+                        failures / len(self.outcomes) >= self.failure_rate_threshold:
+                    self.trip()
+                    tripped = True
+        if tripped:
+            # logged outside the lock, so callers checking allow() do not wait on Cloud Logging
+            self.logger.log_text(f"Circuit {self.name} opened for {self.open_seconds}s", severity='WARNING')
+
+    def trip(self):
+        # callers hold the lock
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+
+    def call(self, function: Callable, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit {self.name} is open")
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        # slow calls count against the circuit so a hanging upstream trips it as well as a failing one
+        self.record(time.monotonic() - started < self.slow_call_seconds)
+        return result
+
+
+class BatchExecutionError(Exception):
+
+    def __init__(self, message: str, results: list, failed_inputs: list) -> None:
+        super().__init__(message)
+        self.results = results
+        self.failed_inputs = failed_inputs
+
+
+class BatchExecutor(BaseService):
+
+    def __init__(
+        self,
+        chunk_size: int = 100,
+        max_concurrency: int = 4,
+        max_retries: int = 3,
+        backoff_seconds: float = 1.0,
+        requests_per_second: float = 10.0
+    ) -> None:
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.rate_limiter = RateLimiter(requests_per_second=requests_per_second)
+        super().__init__()
+
+    def chunks(self, inputs: list):
+        return [inputs[i:i + self.chunk_size] for i in range(0, len(inputs), self.chunk_size)]
+
+    def dispatch(self, request: Callable[[list], Optional[list]], chunk: list):
+        self.rate_limiter.acquire()
+        return request(chunk) or []
+
+    def execute(self, inputs: list, request: Callable[[list], Optional[list]], retry: bool = True):
+        results = []
+        pending = self.chunks(list(inputs))
+        attempt = 0
+        while pending:
+            failed = []
+            errors = []
+            if len(pending) == 1:
+                try:
+                    results += self.dispatch(request, pending[0])
+                except Exception as e:
+                    failed.append(pending[0])
+                    errors.append(e)
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pending))) as executor:
+                    futures = {
+                        executor.submit(contextvars.copy_context().run, self.dispatch, request, chunk): chunk
+                        for chunk in pending
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            results += future.result()
+                        except Exception as e:
+                            failed.append(futures[future])
+                            errors.append(e)
+            if not failed:
+                break
+            attempt += 1
+            if not retry or attempt > self.max_retries:
+                raise BatchExecutionError(
+                    f"{len(failed)} of {len(self.chunks(list(inputs)))} batch chunks failed. Last error: {errors[-1]}",
+                    results=results,
+                    failed_inputs=[item for chunk in failed for item in chunk]
+                )
+            self.logger.log_text(
+                f"Retrying {len(failed)} failed batch chunks (attempt {attempt}). Last error: {errors[-1]}",
+                severity='DEBUG'
+            )
+            sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            pending = failed
+        return results
+
+
+class PandadocRetry(Retry):
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        # PandaDoc may already have created or sent the document when a POST gets a 5xx, a 429 means it did not
+        if method.upper() == 'POST':
+            return bool(self.total) and status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
 
 
 class PandadocService:
@@ -44,15 +285,31 @@ class PandadocService:
     MAX_CHECK_RETRIES = 5
     DOCUMENT_LIFETIME = 1814400.0
 
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
     def __init__(
         self,
         api_key: str,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        max_retries: int = 3,
+        backoff_seconds: float = 0.5,
+        pool_maxsize: int = 10
     ) -> None:
         self.api_key = api_key
+        self.request_timeout = (connect_timeout, read_timeout)
         cfg = pandadoc_client.Configuration(
             host="https://api.pandadoc.com",
             api_key={"apiKey": f"API-Key {api_key}"},
         )
+        cfg.connection_pool_maxsize = pool_maxsize
+        cfg.retries = PandadocRetry(
+            total=max_retries,
+            backoff_factor=backoff_seconds,
+            status_forcelist=self.RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
         self.pandadoc_api_client = pandadoc_client.ApiClient(cfg)
         self.api_instance = documents_api.DocumentsApi(self.pandadoc_api_client)
         super().__init__()
@@ -137,7 +394,10 @@ class PandadocService:
             ],
             pricing_tables=pricing_tables
         )
-        document = self.api_instance.create_document(document_create_request=document_create_request)
+        document = self.api_instance.create_document(
+            document_create_request=document_create_request,
+            _request_timeout=self.request_timeout
+        )
         self.ensure_document_created(document=document)
         self.send_document(document=document)
         return self.get_document_session(recipient=pandadoc_proposal_request.email, document=document)
@@ -148,7 +408,7 @@ class PandadocService:
             sleep(2)
             retries += 1
 
-            doc_status = self.api_instance.status_document(id=document['id'])
+            doc_status = self.api_instance.status_document(id=document['id'], _request_timeout=self.request_timeout)
             if doc_status.status == 'document.draft':
                 return
 
@@ -160,11 +420,10 @@ class PandadocService:
             document_send_request=DocumentSendRequest(
                 silent=True, subject='This doc was send via python SDK'
             ),
+            _request_timeout=self.request_timeout
         )
 
     def get_document_session(self, recipient, document):
-        import requests
-
         url = f"https://api.pandadoc.com/public/v1/documents/{document['id']}/session"
 
         headers = {
@@ -178,41 +437,432 @@ class PandadocService:
             "lifetime": self.DOCUMENT_LIFETIME
         }
 
-        response = requests.post(url, headers=headers, json=data)
-        return response.json()
+        # Shares the SDK's keep-alive pool, retry policy and timeouts.
+        response = self.pandadoc_api_client.rest_client.POST(
+            url,
+            headers=headers,
+            body=data,
+            _request_timeout=self.request_timeout
+        )
+        return serialization.loads(response.data)
 
 
 class FirestoreService(BaseService):
+    # (expires at, hubspot_sync settings)
+    settings_cache = {}
+
     def __init__(
         self,
         firestore_client: firestore.Client,
+        settings_cache_ttl: float = 30.0
     ) -> None:
         self.firestore_client = firestore_client
+        self.settings_cache_ttl = settings_cache_ttl
         super().__init__()
 
-    def line_item_sync_enabled(self):
+    def get_hubspot_sync_settings(self, refresh: bool = False):
+        cached = self.settings_cache.get('hubspot_sync')
+        if not refresh and cached and cached[0] > time.monotonic():
+            return cached[1]
+        settings = self.read_hubspot_sync_settings()
+        self.settings_cache['hubspot_sync'] = (time.monotonic() + self.settings_cache_ttl, settings)
+        return settings
+
+    @ledger.counted('firestore')
+    def read_hubspot_sync_settings(self):
         doc = self.firestore_client.collection('hubspot_sync').document('settings')
-        settings = doc.get().to_dict()
-        return settings['line_item_sync_enabled']
+        return doc.get().to_dict()
+
+    def line_item_sync_enabled(self):
+        return self.get_hubspot_sync_settings()['line_item_sync_enabled']
 
     def forms_enabled(self):
-        doc = self.firestore_client.collection('hubspot_sync').document('settings')
-        settings = doc.get().to_dict()
-        return settings['forms_enabled']
+        return self.get_hubspot_sync_settings()['forms_enabled']
 
+    @ledger.counted('firestore')
     def get_emerge_sync_last_run_date(self):
         doc = self.firestore_client.collection('emerge_sync').document('settings')
         settings = doc.get().to_dict()
         return settings['last_run_date']
 
+    @ledger.counted('firestore')
     def set_emerge_sync_last_run_date(self, last_run_date: str):
         doc = self.firestore_client.collection('emerge_sync').document('settings')
         settings = doc.get().to_dict()
         settings['last_run_date'] = last_run_date
         return doc.set(document_data=settings)
 
+    @ledger.counted('firestore')
+    def get_emerge_sync_state(self):
+        doc = self.firestore_client.collection('emerge_sync').document('settings')
+        return doc.get().to_dict()
+
+    @ledger.counted('firestore')
+    def set_emerge_sync_run(self, run: dict):
+        doc = self.firestore_client.collection('emerge_sync').document('settings')
+        return doc.set({'run': run}, merge=True)
+
+    @ledger.counted('firestore')
+    def complete_emerge_sync_run(self, watermark: str, last_run_date: str):
+        doc = self.firestore_client.collection('emerge_sync').document('settings')
+        return doc.update({
+            'watermark': watermark,
+            'last_run_date': last_run_date,
+            'run': firestore.DELETE_FIELD
+        })
+
+    def acquire_lease(self, doc, holder: str, duration: float) -> bool:
+        @firestore.transactional
+        def acquire(transaction):
+            snapshot = doc.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            if lease.get('holder') not in (None, holder) and lease.get('expires_at') and lease['expires_at'] > now:
+                return False
+            transaction.set(doc, {'holder': holder, 'expires_at': now + timedelta(seconds=duration)})
+            return True
+
+        return acquire(self.firestore_client.transaction())
+
+    def release_lease(self, doc, holder: str):
+        @firestore.transactional
+        def release(transaction):
+            snapshot = doc.get(transaction=transaction)
+            if snapshot.exists and snapshot.to_dict().get('holder') == holder:
+                transaction.delete(doc)
+
+        return release(self.firestore_client.transaction())
+
+    @ledger.counted('firestore')
+    def acquire_emerge_sync_lease(self, holder: str, duration: float) -> bool:
+        return self.acquire_lease(
+            self.firestore_client.collection('emerge_sync').document('lease'),
+            holder=holder,
+            duration=duration
+        )
+
+    @ledger.counted('firestore')
+    def release_emerge_sync_lease(self, holder: str):
+        return self.release_lease(self.firestore_client.collection('emerge_sync').document('lease'), holder=holder)
+
+    def resync_runs(self):
+        return self.firestore_client.collection('emerge_sync').document('resyncs').collection('runs')
+
+    def resync_shard_lease(self, run_id: str, shard_index: int):
+        return self.resync_runs().document(run_id).collection('leases').document(str(shard_index))
+
+    @ledger.counted('firestore')
+    def acquire_resync_shard_lease(self, run_id: str, shard_index: int, holder: str, duration: float) -> bool:
+        return self.acquire_lease(self.resync_shard_lease(run_id, shard_index), holder=holder, duration=duration)
+
+    @ledger.counted('firestore')
+    def release_resync_shard_lease(self, run_id: str, shard_index: int, holder: str):
+        return self.release_lease(self.resync_shard_lease(run_id, shard_index), holder=holder)
+
+    @ledger.counted('firestore')
+    def create_resync_run(self, run_id: str, shard_batches: List[List[list]]):
+        # the customer list is fetched once for the run, each shard reads its own batches back by id
+        run_doc = self.resync_runs().document(run_id)
+        writes = [(run_doc, {
+            'shard_count': len(shard_batches),
+            'completed_shards': 0,
+            'status': 'running',
+            'started_at': datetime.now(timezone.utc)
+        })]
+        for shard_index, batches in enumerate(shard_batches):
+            writes.append((run_doc.collection('shards').document(str(shard_index)), {
+                'status': 'pending',
+                'position': None,
+                'batch_count': len(batches),
+                'total': sum(len(batch) for batch in batches),
+                'processed': 0,
+                'failed': 0
+            }))
+            for batch_index, sync_requests in enumerate(batches):
+                writes.append((run_doc.collection('batches').document(f"{shard_index}-{batch_index}"), {
+                    'shard_index': shard_index,
+                    'sync_requests': sync_requests,
+                    'status': 'pending'
+                }))
+        for start in range(0, len(writes), 500):
+            batch = self.firestore_client.batch()
+            for doc, fields in writes[start:start + 500]:
+                batch.set(doc, fields)
+            batch.commit()
+
+    @ledger.counted('firestore')
+    def get_resync_shard(self, run_id: str, shard_index: int):
+        return self.resync_runs().document(run_id).collection('shards').document(str(shard_index)).get().to_dict()
+
+    @ledger.counted('firestore')
+    def get_resync_batch(self, run_id: str, batch_id: str):
+        return self.resync_runs().document(run_id).collection('batches').document(batch_id).get().to_dict()
+
+    @ledger.counted('firestore')
+    def update_resync_shard(self, run_id: str, shard_index: int, **fields):
+        return self.resync_runs().document(run_id).collection('shards').document(str(shard_index)).update(fields)
+
+    @ledger.counted('firestore')
+    def record_resync_shard_progress(
+        self,
+        run_id: str,
+        shard_index: int,
+        batch_id: str = None,
+        processed: int = 0,
+        failed: int = 0,
+        dispatched: bool = False
+    ) -> bool:
+        run_doc = self.resync_runs().document(run_id)
+        shard_doc = run_doc.collection('shards').document(str(shard_index))
+        batch_doc = run_doc.collection('batches').document(batch_id) if batch_id else None
+
+        # batch workers and the shard dispatcher finish in any order, the last one to land completes the shard.
+        # A batch is counted once, so a redelivered batch task does not add to the progress again
+        @firestore.transactional
+        def record(transaction):
+            if batch_doc is not None and batch_doc.get(transaction=transaction).to_dict()['status'] == 'done':
+                return False
+            shard = shard_doc.get(transaction=transaction).to_dict()
+            run = run_doc.get(transaction=transaction).to_dict()
+            fields = {'processed': shard['processed'] + processed, 'failed': shard['failed'] + failed}
+            if dispatched:
+                fields['status'] = 'dispatched'
+            run_completed = False
+            if fields.get('status', shard['status']) == 'dispatched' and fields['processed'] >= shard['total']:
+                now = datetime.now(timezone.utc)
+                fields.update({'status': 'completed', 'completed_at': now})
+                run_fields = {'completed_shards': run['completed_shards'] + 1}
+                if run_fields['completed_shards'] >= run['shard_count']:
+                    run_fields.update({'status': 'completed', 'completed_at': now})
+                    run_completed = True
+                transaction.update(run_doc, run_fields)
+            transaction.update(shard_doc, fields)
+            if batch_doc is not None:
+                transaction.update(batch_doc, {'status': 'done', 'processed': processed, 'failed': failed})
+            return run_completed
+
+        return record(self.firestore_client.transaction())
+
+    @ledger.counted('firestore')
+    def get_resync_run(self, run_id: str):
+        run_doc = self.resync_runs().document(run_id)
+        snapshot = run_doc.get()
+        if not snapshot.exists:
+            return None
+        run = snapshot.to_dict()
+        shards = {doc.id: doc.to_dict() for doc in run_doc.collection('shards').stream()}
+        run['shards'] = shards
+        run['total'] = sum(shard['total'] or 0 for shard in shards.values())
+        run['processed'] = sum(shard['processed'] for shard in shards.values())
+        run['failed'] = sum(shard['failed'] for shard in shards.values())
+        return run
+
+    def record_run_report(self, run_id: str, job: str, calls: dict):
+        # not counted, the report write is bookkeeping for the ledger itself
+        self.firestore_client.collection('run_reports').document(run_id).set(
+            {
+                'updated_at': datetime.now(timezone.utc),
+                'jobs': {job: firestore.Increment(1)},
+                'calls': {
+                    service: {
+                        endpoint: {field: firestore.Increment(value) for field, value in entry.items()}
+                        for endpoint, entry in endpoints.items()
+                    } for service, endpoints in calls.items()
+                }
+            },
+            merge=True
+        )
 
-class CloudTasksService(BaseService):
+    def get_run_report(self, run_id: str):
+        doc = self.firestore_client.collection('run_reports').document(run_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def pending_webhook_events(self):
+        return self.firestore_client.collection('hubspot_sync').document('pending_events').collection('batches')
+
+    @ledger.counted('firestore')
+    def add_pending_webhook_events(self, events: List[dict]):
+        return self.pending_webhook_events().add({
+            'events': events,
+            'created_at': datetime.now(timezone.utc)
+        })
+
+    @ledger.counted('firestore')
+    def get_pending_webhook_event_batch_ids(self):
+        return [doc.id for doc in self.pending_webhook_events().select(['created_at']).stream()]
+
+    @ledger.counted('firestore')
+    def claim_pending_webhook_events(self, batch_id: str, holder: str, lease_seconds: float):
+        doc = self.pending_webhook_events().document(batch_id)
+
+        # instances draining at the same time each replay a batch only once, an expired claim is taken over
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = doc.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            batch = snapshot.to_dict()
+            now = datetime.now(timezone.utc)
+            if batch.get('claimed_by') not in (None, holder) and batch.get('claimed_until') and \
+                    batch['claimed_until'] > now:
+                return None
+            transaction.update(doc, {'claimed_by': holder, 'claimed_until': now + timedelta(seconds=lease_seconds)})
+            return batch['events']
+
+        return claim(self.firestore_client.transaction())
+
+    @ledger.counted('firestore')
+    def delete_pending_webhook_events(self, batch_id: str):
+        return self.pending_webhook_events().document(batch_id).delete()
+
+    def task_checkpoints(self):
+        return self.firestore_client.collection('task_checkpoints')
+
+    @ledger.counted('firestore')
+    def get_task_checkpoint(self, key: str):
+        doc = self.task_checkpoints().document(key).get()
+        return doc.to_dict().get('steps', {}) if doc.exists else None
+
+    @ledger.counted('firestore')
+    def record_task_step(self, key: str, step: str, value: str, ttl_seconds: float):
+        # expires_at backs a Firestore TTL policy for checkpoints of tasks that never succeed
+        return self.task_checkpoints().document(key).set({
+            'steps': {step: value},
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        }, merge=True)
+
+    @ledger.counted('firestore')
+    def delete_task_checkpoint(self, key: str):
+        return self.task_checkpoints().document(key).delete()
+
+    def processed_webhook_events(self):
+        return self.firestore_client.collection('hubspot_sync').document('processed_events').collection('events')
+
+    @ledger.counted('firestore')
+    def claim_webhook_events(self, event_ids: List[int], lease_seconds: float) -> set:
+        refs = {event_id: self.processed_webhook_events().document(str(event_id)) for event_id in event_ids}
+
+        # a pending claim only holds the events while they are routed, so a claim left by an instance that died
+        # before enqueueing expires and the HubSpot redelivery claims the events again
+        @firestore.transactional
+        def claim(transaction):
+            now = datetime.now(timezone.utc)
+            snapshots = self.firestore_client.get_all(list(refs.values()), transaction=transaction)
+            taken = {
+                int(snapshot.id) for snapshot in snapshots
+                if snapshot.exists and (
+                    snapshot.to_dict().get('status') != 'pending' or snapshot.to_dict()['expires_at'] > now
+                )
+            }
+            claimed = {event_id for event_id in event_ids if event_id not in taken}
+            for event_id in claimed:
+                transaction.set(refs[event_id], {
+                    'status': 'pending',
+                    'expires_at': now + timedelta(seconds=lease_seconds)
+                })
+            return claimed
+
+        return claim(self.firestore_client.transaction())
+
+    @ledger.counted('firestore')
+    def complete_webhook_events(self, event_ids: List[int], ttl_seconds: float):
+        # expires_at backs a Firestore TTL policy, so processed events clean themselves up after HubSpot stops retrying
+        batch = self.firestore_client.batch()
+        for event_id in event_ids:
+            batch.set(self.processed_webhook_events().document(str(event_id)), {
+                'status': 'processed',
+                'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+            })
+        return batch.commit()
+
+    @ledger.counted('firestore')
+    def release_webhook_events(self, event_ids: List[int]):
+        batch = self.firestore_client.batch()
+        for event_id in event_ids:
+            batch.delete(self.processed_webhook_events().document(str(event_id)))
+        return batch.commit()
+
+
+class BillingSnapshotService(BaseService):
+    # Emerge still books late reports against a month for a day after it ends
+    CLOSED_MONTH_GRACE = timedelta(days=1)
+
+    def __init__(
+        self,
+        firestore_client: firestore.Client,
+        collection: str,
+        current_month_ttl: float = 900.0
+    ) -> None:
+        self.firestore_client = firestore_client
+        self.collection = collection
+        self.current_month_ttl = current_month_ttl
+        super().__init__()
+
+    @staticmethod
+    def period_key(year: int, month: int):
+        return f"{year}-{month:02d}"
+
+    def is_closed(self, year: int, month: int, as_of: datetime = None):
+        month_end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+        return (as_of or datetime.now(timezone.utc)) >= month_end + self.CLOSED_MONTH_GRACE
+
+    @ledger.counted('firestore')
+    def get_snapshot(
+        self,
+        company_id: int,
+        year: int,
+        month: int,
+        allow_stale: bool = False,
+        closed_only: bool = False
+    ) -> Optional[EmergeCompanyBillingInfo]:
+        doc = self.firestore_client.collection(self.collection).document(
+            f"{company_id}-{self.period_key(year, month)}"
+        ).get()
+        if not doc.exists:
+            return None
+        snapshot = doc.to_dict()
+        # a snapshot is final only if it was fetched after its month closed, one fetched while the month was
+        # open ages like any other
+        closed = self.is_closed(year, month, as_of=snapshot['fetched_at'])
+        if closed_only and not closed:
+            return None
+        age = (datetime.now(timezone.utc) - snapshot['fetched_at']).total_seconds()
+        stale = not closed and age > self.current_month_ttl
+        if stale and not allow_stale:
+            return None
+        billing_info = EmergeCompanyBillingInfo.model_validate(snapshot['billing_info'])
+        if stale:
+            billing_info.stale_as_of = snapshot['fetched_at']
+        return billing_info
+
+    @ledger.counted('firestore')
+    def set_snapshot(self, company_id: int, year: int, month: int, billing_info: EmergeCompanyBillingInfo):
+        fetched_at = datetime.now(timezone.utc)
+        self.firestore_client.collection(self.collection).document(f"{company_id}-{self.period_key(year, month)}").set(
+            {
+                'company_id': company_id,
+                'period': self.period_key(year, month),
+                'closed': self.is_closed(year, month, as_of=fetched_at),
+                'fetched_at': fetched_at,
+                'billing_info': billing_info.model_dump(mode='json', by_alias=True, exclude_none=True)
+            }
+        )
+
+
+class TaskService(BaseService, ABC):
+
+    @abstractmethod
+    def enqueue(
+        self,
+        relative_handler_uri: str,
+        payload: dict = None,
+        lane: str = None,
+        schedule_time: datetime = None
+    ) -> None:
+        pass
+
+
+class CloudTasksService(TaskService):
 
     def __init__(
         self,
@@ -221,23 +871,48 @@ class CloudTasksService(BaseService):
         location: str,
         queue: str,
         base_url: str,
-        service_account_email: str
+        service_account_email: str,
+        lanes: Dict[str, str] = None
     ) -> None:
         self.cloud_tasks_client = cloud_tasks_client
         self.project = project
         self.location = location
         self.queue = queue
+        self.lanes = lanes or {}
+        self.missing_queues = set()
         self.base_url = base_url
         self.service_account_email = service_account_email
         super().__init__()
 
+    def queue_for_lane(self, lane: str = None):
+        if lane is None:
+            return self.queue
+        if lane not in self.lanes:
+            self.logger.log_text(f"No queue configured for lane {lane}, using {self.queue}", severity='WARNING')
+        queue = self.lanes.get(lane, self.queue)
+        return self.queue if queue in self.missing_queues else queue
+
+    def create_task(self, queue: str, task: dict):
+        parent = self.cloud_tasks_client.queue_path(self.project, self.location, queue)
+        try:
+            return queue, self.cloud_tasks_client.create_task(request={'parent': parent, 'task': task})
+        except NotFound:
+            if queue == self.queue:
+                raise
+            # a lane queue that is not provisioned in this project falls back to the default queue from then on
+            self.logger.log_text(f"Queue {queue} does not exist, using {self.queue}", severity='WARNING')
+            self.missing_queues.add(queue)
+            return self.create_task(self.queue, task)
+
     def enqueue(
         self,
         relative_handler_uri: str,
-        payload: dict = None
+        payload: dict = None,
+        lane: str = None,
+        schedule_time: datetime = None
     ) -> None:
-        self.logger.log_text(f"Enqueueing task on {self.base_url}/{relative_handler_uri}", severity='DEBUG')
-        parent = self.cloud_tasks_client.queue_path(self.project, self.location, self.queue)
+        queue = self.queue_for_lane(lane)
+        self.logger.log_text(f"Enqueueing task on {self.base_url}/{relative_handler_uri} in {queue}", severity='DEBUG')
 
         # Construct the request body.
         task = {
@@ -251,14 +926,24 @@ class CloudTasksService(BaseService):
             }
         }
 
+        if schedule_time is not None:
+            task['schedule_time'] = schedule_time
+
         if payload is not None:
             # The API expects a payload of type bytes.
-            converted_payload = json.dumps(payload).encode()
+            # None values are kept, since the request models treat them as meaningful (no pricing tier, no owner)
+            converted_payload = serialization.dumps(payload)
 
             # Add the payload to the request.
             task['http_request']['body'] = converted_payload
 
-        response = self.cloud_tasks_client.create_task(request={'parent': parent, 'task': task})
+        run_id = ledger.current_run_id()
+        if run_id:
+            # worker invocations report their calls against the run that enqueued them
+            task['http_request']['headers'] = {ledger.RUN_ID_HEADER: run_id}
+
+        queue, response = self.create_task(queue, task)
+        ledger.record('cloud_tasks', f"create_task {queue}", bytes_sent=len(task['http_request'].get('body', b'')))
 
         self.logger.log_text(
             f"Created task {response.name} on {self.base_url}/{relative_handler_uri}",
@@ -266,32 +951,600 @@ class CloudTasksService(BaseService):
         )
 
 
+class InProcessTaskService(TaskService):
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[dict], None]],
+        max_workers: int = 8,
+        max_retries: int = 3,
+        backoff_seconds: float = 1.0
+    ) -> None:
+        self.handlers = handlers
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # one pool per lane so bulk work cannot starve interactive work
+        self.executors = {}
+        self.lock = threading.Lock()
+        # (due, sequence, lane, task) for scheduled tasks and retries, so no pool thread sleeps waiting for them
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition(self.lock)
+        self.scheduler = None
+        self.stopped = False
+        super().__init__()
+
+    def executor_for_lane(self, lane: str = None) -> ThreadPoolExecutor:
+        lane = lane or 'default'
+        with self.lock:
+            if lane not in self.executors:
+                self.executors[lane] = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=f"in-process-task-{lane}"
+                )
+            return self.executors[lane]
+
+    def enqueue(
+        self,
+        relative_handler_uri: str,
+        payload: dict = None,
+        lane: str = None,
+        schedule_time: datetime = None
+    ) -> None:
+        if relative_handler_uri not in self.handlers:
+            raise ValueError(f"No in-process handler registered for {relative_handler_uri}")
+        self.logger.log_text(f"Enqueueing in-process task on {relative_handler_uri}", severity='DEBUG')
+        # stands in for the Cloud Tasks task name, so retries resume from the last checkpointed step
+        task = (contextvars.copy_context(), relative_handler_uri, payload, f"in-process-{uuid4().hex}", 0)
+        delay = (schedule_time - datetime.now(timezone.utc)).total_seconds() if schedule_time else 0
+        self.submit(lane, task, delay)
+
+    def submit(self, lane: Optional[str], task: tuple, delay: float = 0):
+        if delay <= 0:
+            self.executor_for_lane(lane).submit(task[0].run, self.run, lane, *task[1:])
+            return
+        with self.condition:
+            if self.stopped:
+                self.logger.log_text(f"Dropping in-process task on {task[1]} scheduled after shutdown", severity='WARNING')
+                return
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), lane, task))
+            if self.scheduler is None:
+                self.scheduler = threading.Thread(target=self.schedule, name='in-process-task-scheduler', daemon=True)
+                self.scheduler.start()
+            self.condition.notify()
+
+    def schedule(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.delayed or self.delayed[0][0] > time.monotonic()):
+                    self.condition.wait(self.delayed[0][0] - time.monotonic() if self.delayed else None)
+                if self.stopped:
+                    return
+                _, _, lane, task = heapq.heappop(self.delayed)
+            self.submit(lane, task)
+
+    def run(self, lane: Optional[str], relative_handler_uri: str, payload: dict, task_name: str, attempt: int):
+        try:
+            with task_scope(task_name):
+                return self.handlers[relative_handler_uri](payload)
+        except Exception as e:
+            attempt += 1
+            if attempt > self.max_retries:
+                self.logger.log_text(
+                    f"In-process task on {relative_handler_uri} failed after {attempt} attempts: {str(e)}",
+                    severity='ERROR'
+                )
+                return
+            self.submit(
+                lane,
+                (contextvars.copy_context(), relative_handler_uri, payload, task_name, attempt),
+                self.backoff_seconds * 2 ** (attempt - 1)
+            )
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            dropped = len(self.delayed)
+            self.delayed.clear()
+            self.condition.notify_all()
+            executors = list(self.executors.values())
+        if dropped:
+            self.logger.log_text(f"Dropping {dropped} scheduled in-process tasks on shutdown", severity='WARNING')
+        # Cloud Run only allows a few seconds after SIGTERM, so queued work is cancelled rather than waited on
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WebhookEventBuffer(BaseService):
+    WORKER_URI = 'hubspot/v1/events/worker'
+    SHUTDOWN_TIMEOUT = 8.0
+
+    def __init__(
+        self,
+        task_service: TaskService,
+        firestore_service: FirestoreService,
+        max_size: int = 1000,
+        batch_size: int = 50,
+        flush_interval: float = 0.5,
+        replay_interval: float = 60.0,
+        claim_seconds: float = 60.0
+    ) -> None:
+        self.task_service = task_service
+        self.firestore_service = firestore_service
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_interval = replay_interval
+        self.claim_seconds = claim_seconds
+        self.holder = uuid4().hex
+        self.events = deque()
+        self.condition = threading.Condition()
+        self.accepting = False
+        self.thread = None
+        super().__init__()
+
+    def start(self):
+        with self.condition:
+            if self.thread:
+                return
+            self.accepting = True
+            self.thread = threading.Thread(target=self.run, name='webhook-event-flusher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.accepting = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=self.SHUTDOWN_TIMEOUT)
+            self.thread = None
+
+    def offer(self, events: List[HubSpotWebhookEvent]) -> bool:
+        with self.condition:
+            if not self.accepting or len(self.events) + len(events) > self.max_size:
+                return False
+            self.events.extend(events)
+            if len(self.events) >= self.batch_size:
+                self.condition.notify()
+            return True
+
+    def persist_events(self, events: List[HubSpotWebhookEvent]):
+        self.firestore_service.add_pending_webhook_events(events=[event.model_dump() for event in events])
+
+    def enqueue(self, events: list):
+        self.task_service.enqueue(self.WORKER_URI, payload=events, lane='webhooks')
+
+    def flush(self, batch: List[HubSpotWebhookEvent]) -> bool:
+        try:
+            self.enqueue(batch)
+            return True
+        except Exception as e:
+            self.logger.log_text(f"Failed to enqueue {len(batch)} webhook events: {str(e)}", severity='DEBUG')
+        try:
+            self.persist_events(batch)
+            return True
+        except Exception as e:
+            self.logger.log_text(f"Failed to persist {len(batch)} webhook events: {str(e)}", severity='DEBUG')
+        return False
+
+    def replay_pending_events(self):
+        try:
+            batch_ids = self.firestore_service.get_pending_webhook_event_batch_ids()
+        except Exception as e:
+            self.logger.log_text(f"Failed to load pending webhook events: {str(e)}", severity='DEBUG')
+            return
+        for batch_id in batch_ids:
+            try:
+                events = self.firestore_service.claim_pending_webhook_events(
+                    batch_id=batch_id,
+                    holder=self.holder,
+                    lease_seconds=self.claim_seconds
+                )
+                if events is None:
+                    # replayed already, or claimed by another instance
+                    continue
+                self.enqueue(events)
+                self.firestore_service.delete_pending_webhook_events(batch_id=batch_id)
+            except Exception as e:
+                # the claim expires, so the next drain on any instance picks the batch up again
+                self.logger.log_text(f"Failed to replay webhook event batch {batch_id}: {str(e)}", severity='DEBUG')
+
+    def run(self):
+        next_replay = time.monotonic()
+        while True:
+            if self.accepting and time.monotonic() >= next_replay:
+                # batches persisted on overflow, here or on another instance, are drained while the flusher runs
+                self.replay_pending_events()
+                next_replay = time.monotonic() + self.replay_interval
+            with self.condition:
+                if self.accepting and len(self.events) < self.batch_size:
+                    self.condition.wait(timeout=self.flush_interval)
+                batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+                accepting = self.accepting
+            if batch and not self.flush(batch):
+                if accepting:
+                    # keep the events buffered and try again on the next flush
+                    with self.condition:
+                        self.events.extendleft(reversed(batch))
+                    sleep(self.flush_interval)
+                else:
+                    self.logger.log_text(
+                        f"Dropping {len(batch)} webhook events on shutdown: "
+                        f"{serialization.dumps(batch).decode()}",
+                        severity='ERROR'
+                    )
+            if not accepting and not self.events:
+                return
+
+
+class TaskCheckpoint(BaseService):
+
+    def __init__(
+        self,
+        firestore_service: FirestoreService,
+        task_name: str = None,
+        scope: str = None,
+        enabled: bool = True,
+        ttl_seconds: float = 86400.0,
+        max_retries: int = 2,
+        backoff_seconds: float = 1.0
+    ) -> None:
+        self.firestore_service = firestore_service
+        # a retry of the same task carries the same name, so it finds the steps the last attempt completed
+        self.key = f"{task_name.rsplit('/', 1)[-1]}-{scope}" if task_name and scope and enabled else None
+        self.ttl_seconds = ttl_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.completed = None
+        super().__init__()
+
+    def load(self) -> dict:
+        if self.completed is None:
+            self.completed = (self.firestore_service.get_task_checkpoint(key=self.key) or {}) if self.key else {}
+        return self.completed
+
+    @staticmethod
+    def restore(value: str, model=None):
+        value = serialization.loads(value)
+        if model is None or value is None:
+            return value
+        if isinstance(value, list):
+            return serialization.validate_list(model, value)
+        return model.model_validate(value)
+
+    def get(self, name: str, model=None, default=None):
+        completed = self.load()
+        return self.restore(completed[name], model) if name in completed else default
+
+    def record(self, name: str, value):
+        if self.key:
+            # aliased models are restored with model_validate, which reads the aliases
+            encoded = serialization.dumps(value, by_alias=True).decode()
+            self.firestore_service.record_task_step(
+                key=self.key,
+                step=name,
+                value=encoded,
+                ttl_seconds=self.ttl_seconds
+            )
+            self.load()[name] = encoded
+
+    def call(self, function: Callable, retry: bool = True):
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            try:
+                return function()
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                self.logger.log_text(
+                    f"Retrying step of {self.key or 'an unnamed task'} (attempt {attempt + 1}): {str(e)}",
+                    severity='DEBUG'
+                )
+                sleep(self.backoff_seconds * 2 ** attempt)
+
+    def step(self, name: str, function: Callable, model=None, retry: bool = True):
+        if name in self.load():
+            self.logger.log_text(f"Resuming {self.key} after step {name}", severity='DEBUG')
+            return self.get(name, model)
+        result = self.call(function, retry=retry)
+        self.record(name, result)
+        return result
+
+    def complete(self):
+        if self.key and self.completed:
+            self.firestore_service.delete_task_checkpoint(key=self.key)
+
+
+class WebhookEventDeduplicator(BaseService):
+
+    def __init__(
+        self,
+        firestore_service: FirestoreService,
+        memory_size: int = 10000,
+        ttl_seconds: float = 172800.0,
+        claim_seconds: float = 120.0
+    ) -> None:
+        self.firestore_service = firestore_service
+        self.memory_size = memory_size
+        self.ttl_seconds = ttl_seconds
+        self.claim_seconds = claim_seconds
+        # recently processed event ids, checked before Firestore
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        super().__init__()
+
+    def remember(self, event_ids):
+        with self.lock:
+            for event_id in event_ids:
+                self.recent[event_id] = True
+                self.recent.move_to_end(event_id)
+            while len(self.recent) > self.memory_size:
+                self.recent.popitem(last=False)
+
+    def forget(self, event_ids):
+        with self.lock:
+            for event_id in event_ids:
+                self.recent.pop(event_id, None)
+
+    def unseen(self, events: List[HubSpotWebhookEvent]) -> List[HubSpotWebhookEvent]:
+        unseen = {}
+        with self.lock:
+            for event in events:
+                if event.eventId not in self.recent:
+                    unseen.setdefault(event.eventId, event)
+        return list(unseen.values())
+
+    def accept(self, events: List[HubSpotWebhookEvent]) -> List[HubSpotWebhookEvent]:
+        # cheap enough for the webhook request itself, the durable check happens when the events are routed
+        unseen = self.unseen(events)
+        self.record(received=len(events), dropped=len(events) - len(unseen))
+        return unseen
+
+    def claim(self, events: List[HubSpotWebhookEvent]) -> List[HubSpotWebhookEvent]:
+        unseen = self.unseen(events)
+        claimed = self.firestore_service.claim_webhook_events(
+            event_ids=[event.eventId for event in unseen],
+            lease_seconds=self.claim_seconds
+        ) if unseen else set()
+        self.record(received=0, dropped=len(events) - len(claimed))
+        return [event for event in unseen if event.eventId in claimed]
+
+    def complete(self, events: List[HubSpotWebhookEvent]):
+        # only events whose tasks were enqueued are marked processed, anything else stays reclaimable
+        event_ids = [event.eventId for event in events]
+        self.firestore_service.complete_webhook_events(event_ids=event_ids, ttl_seconds=self.ttl_seconds)
+        self.remember(event_ids)
+
+    def release(self, events: List[HubSpotWebhookEvent]):
+        # the events were not handed off, so a HubSpot or Cloud Tasks retry has to be let through
+        event_ids = [event.eventId for event in events]
+        self.forget(event_ids)
+        self.firestore_service.release_webhook_events(event_ids=event_ids)
+
+    def record(self, received: int, dropped: int):
+        with self.lock:
+            self.received += received
+            self.dropped += dropped
+            rate = self.dropped / self.received if self.received else 0
+        if dropped:
+            self.logger.log_text(
+                f"Dropped {dropped} webhook events as duplicates. Dedupe rate {rate:.1%} "
+                f"of {self.received} events since start",
+                severity='INFO'
+            )
+
+
+class EmergeClient(emerge.emerge):
+
+    def __init__(
+        self,
+        environment: str = '',
+        access_token: str = None,
+        timeout: tuple = (5.0, 10.0),
+        customers_timeout: tuple = (5.0, 120.0),
+        throttle_retries: int = 3,
+        throttle_backoff_seconds: float = 1.0,
+        throttle_max_wait_seconds: float = 10.0
+    ) -> None:
+        self.timeout = tuple(timeout)
+        self.customers_timeout = tuple(customers_timeout)
+        self.throttle_retries = throttle_retries
+        self.throttle_backoff_seconds = throttle_backoff_seconds
+        self.throttle_max_wait_seconds = throttle_max_wait_seconds
+        super().__init__(environment=environment, access_token=access_token)
+
+    def throttle_wait(self, response, attempt: int) -> Optional[float]:
+        if attempt >= self.throttle_retries:
+            return None
+        retry_after = response.headers.get('Retry-After')
+        wait = Retry().parse_retry_after(retry_after) if retry_after else self.throttle_backoff_seconds * 2 ** attempt
+        return wait if wait <= self.throttle_max_wait_seconds else None
+
+    def api_call(self, method, endpoint, data=None, timeout: tuple = None):
+        # the packaged client has no timeout, so a stalled Emerge request held the caller until Emerge gave up
+        timeout = timeout or self.timeout
+        for attempt in itertools.count():
+            r = requests.request(method, f"{self.base_url}{endpoint}", data=data, headers=self.headers, timeout=timeout)
+            if r.status_code != 429:
+                break
+            # sustained throttling fails the call, so the circuit breaker sees the overload instead of a hang
+            wait = self.throttle_wait(r, attempt)
+            if wait is None:
+                raise Exception(f"Emerge throttled {endpoint} after {attempt + 1} attempts")
+            sleep(wait)
+        if r.status_code >= 400:
+            raise Exception(r.text)
+        return r.json()
+
+    def customers(self, start: int = 0, end: int = 100, since: str = ''):
+        # the full customer list is slow to build on the Emerge side, so it gets a longer read timeout
+        return self.api_call('get', f"/api/hubspot/customers/{start}/{end}/{since}", timeout=self.customers_timeout)
+
+
 class EmergeService(BaseService):
+    QUEUED_POLL_SECONDS = 0.1
 
     def __init__(
         self,
-        emerge_client: emerge.emerge
+        emerge_client: emerge.emerge,
+        billing_snapshot_service: BillingSnapshotService = None,
+        bulk_max_concurrency: int = 8,
+        bulk_timeout: float = 30.0,
+        circuit_breaker: CircuitBreaker = None
     ) -> None:
         self.emerge_client = emerge_client
+        self.billing_snapshot_service = billing_snapshot_service
+        self.circuit_breaker = circuit_breaker
+        self.bulk_max_concurrency = bulk_max_concurrency
+        self.bulk_timeout = bulk_timeout
         super().__init__()
 
     def get_all_customers(self, since: str = ''):
         self.logger.log_text('Getting all customers', severity='DEBUG')
-        customers = self.emerge_client.customers(start=0, end=1000000000, since=since)
-        return [EmergeCompanyInfo.model_validate(customer) for customer in customers]
-
-    def get_customer_billing_info(self, company_id: int, year: int, month: int):
+        customers = self.call_emerge(self.emerge_client.customers, start=0, end=1000000000, since=since)
+        return serialization.validate_list(EmergeCompanyInfo, customers)
+
+    def get_customer_billing_info(self, company_id: int, year: int, month: int, use_snapshot: bool = True):
+        if not company_id:
+            return EmergeCompanyBillingInfo.model_validate({})
+        # closed months are served from the store on every path, the open month only where a snapshot is allowed
+        if self.billing_snapshot_service and (use_snapshot or self.billing_snapshot_service.is_closed(year, month)):
+            try:
+                snapshot = self.billing_snapshot_service.get_snapshot(
+                    company_id=company_id,
+                    year=year,
+                    month=month,
+                    closed_only=not use_snapshot
+                )
+                if snapshot:
+                    return snapshot
+            except Exception as e:
+                self.logger.log_text(f"Failed to read billing snapshot for {company_id}: {str(e)}", severity='DEBUG')
         self.logger.log_text(f"Getting customer {company_id}", severity='DEBUG')
-        billing_info = self.emerge_client.customer_billing_info(
-            company_id=company_id,
-            year=year,
-            month=month
-        ) if company_id else {}
-        return EmergeCompanyBillingInfo.model_validate(billing_info)
+        billing_info = EmergeCompanyBillingInfo.model_validate(
+            self.call_emerge(
+                self.emerge_client.customer_billing_info,
+                company_id=company_id,
+                year=year,
+                month=month
+            )
+        )
+        if self.billing_snapshot_service:
+            try:
+                self.billing_snapshot_service.set_snapshot(
+                    company_id=company_id,
+                    year=year,
+                    month=month,
+                    billing_info=billing_info
+                )
+            except Exception as e:
+                self.logger.log_text(f"Failed to store billing snapshot for {company_id}: {str(e)}", severity='DEBUG')
+        return billing_info
+
+    def call_emerge(self, function: Callable, **kwargs):
+        if self.circuit_breaker is None:
+            return function(**kwargs)
+        return self.circuit_breaker.call(function, **kwargs)
+
+    def get_customer_billing_info_or_stale(self, company_id: int, year: int, month: int):
+        try:
+            return self.get_customer_billing_info(company_id=company_id, year=year, month=month)
+        except Exception as e:
+            self.logger.log_text(
+                f"Emerge unavailable for {company_id}, falling back to last known billing info: {str(e)}",
+                severity='WARNING'
+            )
+        if self.billing_snapshot_service:
+            try:
+                snapshot = self.billing_snapshot_service.get_snapshot(
+                    company_id=company_id,
+                    year=year,
+                    month=month,
+                    allow_stale=True
+                )
+                if snapshot:
+                    return snapshot
+            except Exception as e:
+                self.logger.log_text(f"Failed to read billing snapshot for {company_id}: {str(e)}", severity='DEBUG')
+        return EmergeCompanyBillingInfo(EmergeCompanyId=company_id, unavailable=True)
+
+    def get_customers_billing_info(
+        self,
+        company_ids: List[int],
+        year: int,
+        month: int,
+        max_concurrency: int = None,
+        timeout: float = None,
+        use_snapshot: bool = True
+    ) -> Iterator[EmergeBillingInfoResult]:
+        max_concurrency = max_concurrency or self.bulk_max_concurrency
+        timeout = timeout or self.bulk_timeout
+        self.logger.log_text(
+            f"Getting billing info for {len(company_ids)} customers with concurrency {max_concurrency}",
+            severity='DEBUG'
+        )
+        remaining = iter(company_ids)
+        # future -> (company id, when its worker started the call), the deadline runs from the start of the call
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        def fetch(company_id, started):
+            started.append(time.monotonic())
+            return self.get_customer_billing_info(
+                company_id=company_id,
+                year=year,
+                month=month,
+                use_snapshot=use_snapshot
+            )
+
+        def submit_next():
+            for company_id in remaining:
+                started = []
+                future = executor.submit(contextvars.copy_context().run, fetch, company_id, started)
+                running[future] = (company_id, started)
+                if len(running) >= max_concurrency:
+                    return
+
+        try:
+            submit_next()
+            while running:
+                # a call queued behind an abandoned worker has no deadline yet, so poll until it starts
+                deadlines = [started[0] + timeout for _, started in running.values() if started]
+                if len(deadlines) < len(running):
+                    deadlines.append(time.monotonic() + self.QUEUED_POLL_SECONDS)
+                done, _ = wait(running, timeout=max(0.0, min(deadlines) - time.monotonic()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    company_id, _ = running.pop(future)
+                    try:
+                        yield EmergeBillingInfoResult(company_id=company_id, billing_info=future.result())
+                    except Exception as e:
+                        yield EmergeBillingInfoResult(company_id=company_id, error=str(e))
+                now = time.monotonic()
+                for future, (company_id, started) in list(running.items()):
+                    if started and started[0] + timeout <= now:
+                        # the Emerge client cannot be interrupted, so the call is abandoned and its worker is freed
+                        # by the client's own request timeout
+                        running.pop(future)
+                        yield EmergeBillingInfoResult(company_id=company_id, error=f"Timed out after {timeout}s")
+                submit_next()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 class HubSpotService(BaseService):
     cache = {}
+    # deal id -> (expires at, associated companies)
+    deal_company_cache = {}
+    # deal id -> association writes seen, so a read that overlapped a write does not cache what it read
+    deal_company_writes = {}
+    deal_company_lock = threading.Lock()
+    # property names -> (fetched at in epoch ms, products)
+    product_cache = {}
 
     def __init__(
         self,
@@ -300,7 +1553,10 @@ class HubSpotService(BaseService):
         access_token_location: str,
         expires_at_location: str,
         hubspot_client: hubspot.hubspot,
-        firestore_client: firestore.Client
+        firestore_client: firestore.Client,
+        batch_executor: BatchExecutor,
+        association_cache_ttl: float = 60.0,
+        product_cache_ttl: float = 300.0
     ) -> None:
         self.firestore_collection = firestore_collection
         self.auth_document = auth_document
@@ -308,6 +1564,9 @@ class HubSpotService(BaseService):
         self.expires_at_location = expires_at_location
         self.hubspot_client = hubspot_client
         self.firestore_client = firestore_client
+        self.batch_executor = batch_executor
+        self.association_cache_ttl = association_cache_ttl
+        self.product_cache_ttl = product_cache_ttl
         super().__init__()
 
     def ensure_auth(self):
@@ -336,6 +1595,30 @@ class HubSpotService(BaseService):
             properties=properties
         )['content']
 
+    def get_companies(self, company_ids, properties=None):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting {len(company_ids)} companies with properties {properties}", severity='DEBUG')
+        return self.batch_executor.execute(
+            inputs=[{'id': company_id} for company_id in company_ids],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/companies/batch/read",
+                data=serialization.dumps({'properties': properties, 'inputs': inputs})
+            )['content']['results']
+        )
+
+    def update_companies(self, records):
+        self.ensure_auth()
+        self.logger.log_text(f"Updating {len(records)} companies", severity='DEBUG')
+        return self.batch_executor.execute(
+            inputs=records,
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/companies/batch/update",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results']
+        )
+
     def get_company_by_emerge_company(
         self,
         emerge_company_id: int = None,
@@ -354,6 +1637,71 @@ class HubSpotService(BaseService):
             sorts=sorts
         )['content']
 
+    def search_by_property_values(
+        self,
+        object_type: str,
+        property_name: str,
+        property_values: list,
+        property_names: list = tuple(),
+        key=lambda value: value
+    ):
+        property_names = list({property_name, *property_names})
+        records = {key(str(value)): [] for value in property_values}
+        for start in range(0, len(property_values), self.batch_executor.chunk_size):
+            values = property_values[start:start + self.batch_executor.chunk_size]
+            after = None
+            while True:
+                self.batch_executor.rate_limiter.acquire()
+                result = self.hubspot_client.search_records_by_property_values(
+                    object_type=object_type,
+                    property_name=property_name,
+                    property_values=values,
+                    property_names=property_names,
+                    after=after
+                )['content']
+                for record in result['results']:
+                    records.setdefault(key(record['properties'][property_name]), []).append(record)
+                if not result.get('paging'):
+                    break
+                after = result['paging']['next']['after']
+        return records
+
+    def get_companies_by_emerge_companies(self, emerge_company_ids: List[int], property_names: list = tuple()):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting companies by {len(emerge_company_ids)} emerge companies", severity='DEBUG')
+        return self.search_by_property_values(
+            object_type='companies',
+            property_name='emerge_company_id',
+            property_values=emerge_company_ids,
+            property_names=property_names
+        )
+
+    def get_companies_by_names(self, company_names: List[str], property_names: list = tuple()):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting companies by {len(company_names)} names", severity='DEBUG')
+        # IN filters on string properties only match lowercase values, so results are keyed by lowercase name
+        return self.search_by_property_values(
+            object_type='companies',
+            property_name='name',
+            property_values=[company_name.strip().lower() for company_name in company_names],
+            property_names=property_names,
+            key=lambda value: value.strip().lower()
+        )
+
+    def create_companies(self, companies):
+        self.ensure_auth()
+        self.logger.log_text(f"Creating {len(companies)} companies", severity='DEBUG')
+        # creates are not idempotent, so a failed chunk is reported instead of retried
+        return self.batch_executor.execute(
+            inputs=[{'properties': properties} for properties in companies],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/companies/batch/create",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results'],
+            retry=False
+        )
+
     def get_company_by_name(
         self,
         company_name: str = None,
@@ -391,6 +1739,41 @@ class HubSpotService(BaseService):
             properties=properties
         )['content']
 
+    def get_deals(self, deal_ids, properties=None):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting {len(deal_ids)} deals with properties {properties}", severity='DEBUG')
+        return self.batch_executor.execute(
+            inputs=[{'id': deal_id} for deal_id in deal_ids],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/deals/batch/read",
+                data=serialization.dumps({'properties': properties, 'inputs': inputs})
+            )['content']['results']
+        )
+
+    def update_deals(self, records):
+        self.ensure_auth()
+        self.logger.log_text(f"Updating {len(records)} deals", severity='DEBUG')
+        return self.batch_executor.execute(
+            inputs=records,
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/deals/batch/update",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results']
+        )
+
+    def get_deals_by_names(self, deal_names: List[str], property_names: list = tuple()):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting deals by {len(deal_names)} names", severity='DEBUG')
+        return self.search_by_property_values(
+            object_type='deals',
+            property_name='dealname',
+            property_values=[deal_name.strip().lower() for deal_name in deal_names],
+            property_names=property_names,
+            key=lambda value: value.strip().lower()
+        )
+
     def get_deal_by_name(
         self,
         deal_name: str = None,
@@ -409,40 +1792,170 @@ class HubSpotService(BaseService):
             sorts=sorts
         )['content']
 
+    def get_deals_by_pricing_tier(
+        self,
+        pricing_tier: str,
+        property_names: list = tuple(),
+        after: int = None
+    ):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting deals by pricing tier {pricing_tier}", severity='DEBUG')
+        return self.hubspot_client.search_records_by_property_value(
+            object_type='deals',
+            property_name='pricing_tier',
+            property_value=pricing_tier,
+            property_names=property_names,
+            after=after,
+            sorts=[{'propertyName': 'hs_object_id', 'direction': 'ASCENDING'}]
+        )['content']
+
+    def get_all_deal_ids_by_pricing_tier(self, pricing_tier: str):
+        deal_ids = []
+        result = self.get_deals_by_pricing_tier(pricing_tier=pricing_tier)
+        deal_ids += [deal['id'] for deal in result['results']]
+        while result.get('paging'):
+            result = self.get_deals_by_pricing_tier(
+                pricing_tier=pricing_tier,
+                after=result['paging']['next']['after']
+            )
+            deal_ids += [deal['id'] for deal in result['results']]
+        return deal_ids
+
     def set_customer_company_for_deal(self, deal_id, company_id):
         self.ensure_auth()
         self.logger.log_text(f"Setting customer company {company_id} for deal {deal_id}", severity='DEBUG')
-        return self.hubspot_client.associate(
-            from_object_type='deals',
-            from_object_id=deal_id,
-            to_object_type='company',
-            to_object_id=company_id,
-            association_type='customer_deal'
-        )
+        try:
+            return self.hubspot_client.associate(
+                from_object_type='deals',
+                from_object_id=deal_id,
+                to_object_type='company',
+                to_object_id=company_id,
+                association_type='customer_deal'
+            )
+        finally:
+            self.invalidate_companies_for_deals([deal_id])
+
+    def set_customer_company_for_deals(self, associations):
+        self.ensure_auth()
+        self.logger.log_text(f"Setting customer companies for {len(associations)} deals", severity='DEBUG')
+        try:
+            return self.batch_executor.execute(
+                inputs=[
+                    {
+                        'from': {
+                            'id': association['deal_id']
+                        },
+                        'to': {
+                            'id': association['company_id']
+                        },
+                        'type': 'customer_deal'
+                    } for association in associations
+                ],
+                request=lambda inputs: self.hubspot_client.custom_request(
+                    method='POST',
+                    endpoint=f"crm/v3/associations/deals/companies/batch/create",
+                    data=serialization.dumps({'inputs': inputs})
+                )['content']['results']
+            )
+        finally:
+            self.invalidate_companies_for_deals([association['deal_id'] for association in associations])
 
     def set_company_for_deal(self, deal_id, company_id):
         self.ensure_auth()
         self.logger.log_text(f"Setting company {company_id} for deal {deal_id}", severity='DEBUG')
-        return self.hubspot_client.set_company_for_deal(
-            deal_id=deal_id,
-            company_id=company_id
-        )
+        try:
+            return self.hubspot_client.set_company_for_deal(
+                deal_id=deal_id,
+                company_id=company_id
+            )
+        finally:
+            self.invalidate_companies_for_deals([deal_id])
+
+    def set_company_for_deals(self, associations):
+        self.ensure_auth()
+        self.logger.log_text(f"Setting companies for {len(associations)} deals", severity='DEBUG')
+        try:
+            return self.batch_executor.execute(
+                inputs=[
+                    {
+                        'from': {
+                            'id': association['deal_id']
+                        },
+                        'to': {
+                            'id': association['company_id']
+                        },
+                        'type': 'deal_to_company'
+                    } for association in associations
+                ],
+                request=lambda inputs: self.hubspot_client.custom_request(
+                    method='POST',
+                    endpoint="crm/v3/associations/deals/companies/batch/create",
+                    data=serialization.dumps({'inputs': inputs})
+                )['content']['results']
+            )
+        finally:
+            self.invalidate_companies_for_deals([association['deal_id'] for association in associations])
+
+    def invalidate_companies_for_deals(self, deal_ids):
+        # called once the write has landed, or failed partway
+        with self.deal_company_lock:
+            for deal_id in deal_ids:
+                self.deal_company_cache.pop(str(deal_id), None)
+                self.deal_company_writes[str(deal_id)] = self.deal_company_writes.get(str(deal_id), 0) + 1
+
+    def cached_companies_for_deals(self, deal_ids) -> Dict[str, List[HubSpotAssociationResult]]:
+        now = time.monotonic()
+        cached = {}
+        for deal_id in deal_ids:
+            entry = self.deal_company_cache.get(str(deal_id))
+            if entry and entry[0] > now:
+                # callers pop from the association lists, so never hand out the cached objects
+                cached[str(deal_id)] = [result.model_copy(deep=True) for result in entry[1]]
+        return cached
+
+    def load_companies_for_deals(self, deal_ids) -> Dict[str, List[HubSpotAssociationResult]]:
+        cached = self.cached_companies_for_deals(deal_ids)
+        missing = list(dict.fromkeys(str(deal_id) for deal_id in deal_ids if str(deal_id) not in cached))
+        if missing:
+            self.logger.log_text(f"Getting companies for {len(missing)} deals", severity='DEBUG')
+            with self.deal_company_lock:
+                writes = {deal_id: self.deal_company_writes.get(deal_id, 0) for deal_id in missing}
+            associations = self.get_associations_batch(
+                from_object_type='deals',
+                to_object_type='companies',
+                from_object_ids=missing
+            )
+            loaded = {deal_id: [] for deal_id in missing}
+            for result in associations.results:
+                loaded.setdefault(result.from_object.id, []).append(result)
+            expires_at = time.monotonic() + self.association_cache_ttl
+            with self.deal_company_lock:
+                for deal_id, results in loaded.items():
+                    if self.deal_company_writes.get(deal_id, 0) == writes.get(deal_id, 0):
+                        self.deal_company_cache[deal_id] = (expires_at, results)
+            for deal_id, results in loaded.items():
+                cached[deal_id] = [result.model_copy(deep=True) for result in results]
+        return cached
 
     def get_company_for_deal(self, deal_id):
         self.ensure_auth()
-        self.logger.log_text(f"Getting company for deal {deal_id}", severity='DEBUG')
-        resp = self.hubspot_client.get_associations(
-            from_object_type='deals',
-            to_object_type='companies',
-            from_object_id=deal_id
-        )['content']
+        started_at = datetime.now(timezone.utc)
+        results = self.load_companies_for_deals([deal_id])[str(deal_id)]
         return HubSpotAssociationBatchReadResponse(
-            status=resp['status'],
-            results=resp['results'],
-            started_at=resp['startedAt'],
-            completed_at=resp['completedAt']
+            status='COMPLETE',
+            results=results,
+            started_at=started_at,
+            completed_at=datetime.now(timezone.utc)
         )
 
+    def get_companies_for_deals(self, deal_ids):
+        self.ensure_auth()
+        return {
+            deal_id: results[0].to[0].id
+            for deal_id, results in self.load_companies_for_deals(deal_ids).items()
+            if len(results) > 0 and len(results[0].to) > 0
+        }
+
     def merge_companies(self, company_to_merge: int, company_to_keep: int):
         self.ensure_auth()
         self.logger.log_text(f"Merging company {company_to_merge} into {company_to_keep}")
@@ -453,7 +1966,7 @@ class HubSpotService(BaseService):
         return self.hubspot_client.custom_request(
             method='POST',
             endpoint=f"crm/v3/objects/companies/merge",
-            data=json.dumps(merge_data)
+            data=serialization.dumps(merge_data)
         )
 
     def get_line_items_for_deal(self, deal_id):
@@ -471,6 +1984,33 @@ class HubSpotService(BaseService):
             completed_at=resp['completedAt']
         )
 
+    def get_associations_batch(self, from_object_type, to_object_type, from_object_ids):
+        self.ensure_auth()
+        started_at = datetime.now(timezone.utc)
+        results = self.batch_executor.execute(
+            inputs=[{'id': from_object_id} for from_object_id in from_object_ids],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v3/associations/{from_object_type}/{to_object_type}/batch/read",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results']
+        )
+        return HubSpotAssociationBatchReadResponse(
+            status='COMPLETE',
+            results=results,
+            started_at=started_at,
+            completed_at=datetime.now(timezone.utc)
+        )
+
+    def get_line_items_for_deals(self, deal_ids):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting line items for {len(deal_ids)} deals", severity='DEBUG')
+        return self.get_associations_batch(
+            from_object_type='deals',
+            to_object_type='line_items',
+            from_object_ids=deal_ids
+        )
+
     def get_line_item(self, line_item_id, properties=None):
         self.ensure_auth()
         self.logger.log_text(f"Getting line item {line_item_id} with properties {properties}", severity='DEBUG')
@@ -483,15 +2023,14 @@ class HubSpotService(BaseService):
     def get_line_items(self, line_item_ids, properties=None):
         self.ensure_auth()
         self.logger.log_text(f"Getting line items {line_item_ids} with properties {properties}", severity='DEBUG')
-        data = {
-            'properties': properties,
-            'inputs': [{'id': line_item_id} for line_item_id in line_item_ids]
-        }
-        return self.hubspot_client.custom_request(
-            method='POST',
-            endpoint=f"crm/v3/objects/line_items/batch/read",
-            data=json.dumps(data)
-        )['content']['results']
+        return self.batch_executor.execute(
+            inputs=[{'id': line_item_id} for line_item_id in line_item_ids],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v3/objects/line_items/batch/read",
+                data=serialization.dumps({'properties': properties, 'inputs': inputs})
+            )['content']['results']
+        )
 
     def create_line_item(self, properties):
         self.ensure_auth()
@@ -504,14 +2043,47 @@ class HubSpotService(BaseService):
     def create_line_items(self, line_items):
         self.ensure_auth()
         self.logger.log_text(f"Creating line items {line_items}", severity='DEBUG')
-        data = {
-            'inputs': [{'properties': line_item} for line_item in line_items]
-        }
-        return self.hubspot_client.custom_request(
-            method='POST',
-            endpoint=f"crm/v3/objects/line_items/batch/create",
-            data=json.dumps(data)
-        )['content']['results']
+        # creates are not idempotent, so a failed chunk is reported instead of retried
+        return self.batch_executor.execute(
+            inputs=[{'properties': line_item} for line_item in line_items],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v3/objects/line_items/batch/create",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results'],
+            retry=False
+        )
+
+    def create_deal_line_items(self, line_items_by_deal):
+        self.ensure_auth()
+        self.logger.log_text(f"Creating line items for {len(line_items_by_deal)} deals", severity='DEBUG')
+        # creates are not idempotent, so a failed chunk is reported instead of retried
+        return self.batch_executor.execute(
+            inputs=[
+                {
+                    'properties': line_item,
+                    'associations': [
+                        {
+                            'to': {
+                                'id': deal_id
+                            },
+                            'types': [
+                                {
+                                    'associationCategory': 'HUBSPOT_DEFINED',
+                                    'associationTypeId': 20
+                                }
+                            ]
+                        }
+                    ]
+                } for deal_id, line_items in line_items_by_deal.items() for line_item in line_items
+            ],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v3/objects/line_items/batch/create",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results'],
+            retry=False
+        )
 
     def set_deal_for_line_item(self, line_item_id, deal_id):
         self.ensure_auth()
@@ -524,8 +2096,8 @@ class HubSpotService(BaseService):
     def set_deal_for_line_items(self, line_items, deal_id):
         self.ensure_auth()
         self.logger.log_text(f"Setting deal {deal_id} for line items {line_items}", severity='DEBUG')
-        data = {
-            'inputs': [
+        return self.batch_executor.execute(
+            inputs=[
                 {
                     'from': {
                         'id': line_item['id']
@@ -540,13 +2112,13 @@ class HubSpotService(BaseService):
                         }
                     ]
                 } for line_item in line_items
-            ]
-        }
-        return self.hubspot_client.custom_request(
-            method='POST',
-            endpoint=f"crm/v4/associations/line_items/deals/batch/create",
-            data=json.dumps(data)
-        )['content']
+            ],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v4/associations/line_items/deals/batch/create",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results']
+        )
 
     def update_line_items(self, records):
         self.ensure_auth()
@@ -554,10 +2126,14 @@ class HubSpotService(BaseService):
             f"Updating {len(records)} line items",
             severity='DEBUG'
         )
-        return self.hubspot_client.update_records_batch(
-            object_type='line_item',
-            records=records
-        )['content']
+        return self.batch_executor.execute(
+            inputs=records,
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint="crm/v3/objects/line_item/batch/update",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']['results']
+        )
 
     def delete_line_item(self, line_item_id):
         self.ensure_auth()
@@ -570,14 +2146,14 @@ class HubSpotService(BaseService):
     def delete_line_items(self, line_item_ids):
         self.ensure_auth()
         self.logger.log_text(f"Deleting line items {line_item_ids}", severity='DEBUG')
-        data = {
-            'inputs': [{'id': line_item_id} for line_item_id in line_item_ids]
-        }
-        return self.hubspot_client.custom_request(
-            method='POST',
-            endpoint=f"crm/v3/objects/line_items/batch/archive",
-            data=json.dumps(data)
-        )['content']
+        return self.batch_executor.execute(
+            inputs=[{'id': line_item_id} for line_item_id in line_item_ids],
+            request=lambda inputs: self.hubspot_client.custom_request(
+                method='POST',
+                endpoint=f"crm/v3/objects/line_items/batch/archive",
+                data=serialization.dumps({'inputs': inputs})
+            )['content']
+        )
 
     def get_products(self, property_names, after=None):
         self.ensure_auth()
@@ -587,16 +2163,53 @@ class HubSpotService(BaseService):
             after=after
         )['content']
 
-    def get_all_products(self, property_names):
+    def products_modified_since(self, modified_after: int) -> bool:
+        self.ensure_auth()
+        return self.hubspot_client.custom_request(
+            method='POST',
+            endpoint="crm/v3/objects/products/search",
+            data=serialization.dumps({
+                'filterGroups': [{
+                    'filters': [{'propertyName': 'hs_lastmodifieddate', 'operator': 'GT', 'value': modified_after}]
+                }],
+                'properties': ['hs_object_id'],
+                'limit': 1
+            })
+        )['content']['total'] > 0
+
+    def get_all_products(self, property_names, refresh: bool = False):
+        key = tuple(property_names)
+        cached = self.product_cache.get(key)
+        # prices are written from the catalog, so a cached copy is only served after HubSpot confirms nothing changed
+        fresh = cached and time.time() * 1000 - cached[0] < self.product_cache_ttl * 1000
+        if not refresh and fresh and not self.products_modified_since(modified_after=cached[0]):
+            return dict(cached[1])
         self.ensure_auth()
         self.logger.log_text(f"Getting products", severity='DEBUG')
+        fetched_at = int(time.time() * 1000)
         products = []
         result = self.get_products(property_names=property_names)
         products += result['results']
         while result.get('paging'):
             result = self.get_products(property_names=property_names, after=result['paging']['next']['after'])
             products += result['results']
-        return {p['id']: p['properties'] for p in products}
+        products = {p['id']: p['properties'] for p in products}
+        self.product_cache[key] = (fetched_at, products)
+        return dict(products)
+
+    def load_owners(self):
+        self.ensure_auth()
+        self.logger.log_text(f"Getting owners", severity='DEBUG')
+        after = None
+        while True:
+            endpoint = "crm/v3/owners?limit=100" + (f"&after={after}" if after else '')
+            result = self.hubspot_client.custom_request(method='GET', endpoint=endpoint)['content']
+            for owner in result['results']:
+                if owner.get('email'):
+                    self.cache[owner['email']] = owner['id']
+            if not result.get('paging'):
+                return len(self.cache)
+            after = result['paging']['next']['after']
 
     def get_owner_by_email(self, email: str = None):
         self.ensure_auth()
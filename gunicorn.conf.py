@@ -0,0 +1,27 @@
+import os
+
+# gRPC clients (Firestore, Cloud Tasks, Logging) are imported before fork when the app is preloaded
+os.environ.setdefault('GRPC_ENABLE_FORK_SUPPORT', 'true')
+
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+# one event loop per CPU, request concurrency within a worker comes from server.threadpool_size
+workers = int(os.environ.get('WEB_CONCURRENCY', cpus))
+
+# import main and build the app once, before forking the workers
+preload_app = True
+
+# Cloud Run's request timeout, so a busy worker is not killed before Cloud Run gives up on the request
+timeout = int(os.environ.get('REQUEST_TIMEOUT', 300))
+# Cloud Run sends SIGTERM and waits 10 seconds before SIGKILL
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 9))
+# longer than the Google front end's idle timeout, so it closes idle connections rather than us
+keepalive = int(os.environ.get('KEEPALIVE', 620))
+
+forwarded_allow_ips = '*'
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
@@ -0,0 +1,143 @@
+from unittest import mock
+
+import pytest
+from google.cloud import firestore
+
+from app import functions
+from app.containers import Container
+from app.services import LazyLogger
+
+
+@pytest.fixture(autouse=True)
+def logging_client():
+    # keeps tests from building a Cloud Logging client
+    LazyLogger.client = mock.MagicMock()
+    yield LazyLogger.client
+    LazyLogger.reset()
+
+
+@pytest.fixture
+def container():
+    container = Container()
+    container.config.from_yaml('etc/config-dev.yaml')
+    container.wire(modules=[functions])
+    yield container
+    container.unwire()
+
+
+class FakeSnapshot:
+
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data) if self.data is not None else None
+
+
+class FakeDocument:
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self, self.client.documents.get(self.path))
+
+    def set(self, fields, merge=False):
+        current = self.client.documents.get(self.path) if merge else None
+        self.client.documents[self.path] = {**(current or {}), **fields}
+
+    def update(self, fields):
+        if self.path not in self.client.documents:
+            raise KeyError(self.path)
+        document = self.client.documents[self.path]
+        for field, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                document.pop(field, None)
+            else:
+                document[field] = value
+
+    def delete(self):
+        self.client.documents.pop(self.path, None)
+
+
+class FakeCollection:
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def document(self, document_id=None):
+        return FakeDocument(self.client, f"{self.path}/{document_id}")
+
+    def select(self, field_paths):
+        return self
+
+    def stream(self):
+        depth = self.path.count('/') + 1
+        return [
+            FakeSnapshot(FakeDocument(self.client, path), data) for path, data in list(self.client.documents.items())
+            if path.startswith(f"{self.path}/") and path.count('/') == depth
+        ]
+
+
+class FakeWriter:
+    # writes land immediately, which is enough for code that reads back only after committing
+
+    _max_attempts = 1
+    _read_only = False
+    _id = None
+
+    def set(self, ref, fields, merge=False):
+        ref.set(fields, merge=merge)
+
+    def update(self, ref, fields):
+        ref.update(fields)
+
+    def delete(self, ref):
+        ref.delete()
+
+    def commit(self):
+        pass
+
+    def _clean_up(self):
+        pass
+
+    def _begin(self, retry_id=None):
+        pass
+
+    def _commit(self):
+        pass
+
+    def _rollback(self):
+        pass
+
+
+class FakeFirestore:
+
+    def __init__(self):
+        self.documents = {}
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriter()
+
+    def transaction(self):
+        return FakeWriter()
+
+    def get_all(self, refs, transaction=None):
+        return [ref.get() for ref in refs]
+
+
+@pytest.fixture
+def firestore_client():
+    return FakeFirestore()
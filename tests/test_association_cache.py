@@ -0,0 +1,103 @@
+import json
+from unittest import mock
+
+import pytest
+
+from app.services import BatchExecutor, HubSpotService
+
+
+class HubSpotClient:
+
+    def __init__(self):
+        self.auth_refreshed = False
+        self.companies = {'1': '100', '2': '200'}
+        self.reads = []
+        self.during_read = None
+        self.set_company_for_deal = mock.MagicMock()
+
+    def custom_request(self, method, endpoint, data=None):
+        if endpoint.endswith('/batch/create'):
+            raise Exception('HubSpot unavailable')
+        deal_ids = [association['id'] for association in json.loads(data)['inputs']]
+        self.reads.append(deal_ids)
+        if self.during_read:
+            self.during_read()
+        return {'content': {'results': [
+            {'from': {'id': deal_id}, 'to': [{'id': self.companies[deal_id], 'type': 'deal_to_company'}]}
+            for deal_id in deal_ids if deal_id in self.companies
+        ]}}
+
+
+@pytest.fixture
+def hubspot_client():
+    return HubSpotClient()
+
+
+@pytest.fixture
+def hubspot_service(hubspot_client):
+    HubSpotService.deal_company_cache = {}
+    HubSpotService.deal_company_writes = {}
+    yield HubSpotService(
+        firestore_collection='hubspot',
+        auth_document='auth',
+        access_token_location='access_token',
+        expires_at_location='expires_at',
+        hubspot_client=hubspot_client,
+        firestore_client=mock.MagicMock(),
+        batch_executor=BatchExecutor(backoff_seconds=0, requests_per_second=0, max_retries=0),
+        association_cache_ttl=60
+    )
+    HubSpotService.deal_company_cache = {}
+    HubSpotService.deal_company_writes = {}
+
+
+def test_associations_are_read_once_within_the_ttl(hubspot_service, hubspot_client):
+    assert hubspot_service.get_companies_for_deals([1, 2]) == {'1': '100', '2': '200'}
+    assert hubspot_service.get_company_for_deal(1).first().id == '100'
+    assert hubspot_service.get_companies_for_deals([1, 2]) == {'1': '100', '2': '200'}
+
+    assert hubspot_client.reads == [['1', '2']]
+
+
+def test_only_uncached_deals_are_read(hubspot_service, hubspot_client):
+    hubspot_service.get_companies_for_deals([1])
+    hubspot_service.get_companies_for_deals([1, 2])
+
+    assert hubspot_client.reads == [['1'], ['2']]
+
+
+def test_setting_a_company_invalidates_the_deal(hubspot_service, hubspot_client):
+    hubspot_service.get_companies_for_deals([1, 2])
+    hubspot_client.companies['1'] = '101'
+
+    hubspot_service.set_company_for_deal(deal_id=1, company_id=101)
+
+    assert hubspot_service.get_companies_for_deals([1, 2]) == {'1': '101', '2': '200'}
+    assert hubspot_client.reads == [['1', '2'], ['1']]
+
+
+def test_a_failed_batch_write_still_invalidates_the_deals(hubspot_service, hubspot_client):
+    hubspot_service.get_companies_for_deals([1, 2])
+
+    with pytest.raises(Exception):
+        hubspot_service.set_company_for_deals([{'deal_id': 2, 'company_id': 201}])
+
+    hubspot_service.get_companies_for_deals([1, 2])
+    assert hubspot_client.reads == [['1', '2'], ['2']]
+
+
+def test_a_read_that_overlaps_a_write_is_not_cached(hubspot_service, hubspot_client):
+    hubspot_client.during_read = lambda: hubspot_service.invalidate_companies_for_deals([1])
+
+    assert hubspot_service.get_companies_for_deals([1, 2]) == {'1': '100', '2': '200'}
+
+    hubspot_client.during_read = None
+    hubspot_service.get_companies_for_deals([1, 2])
+    assert hubspot_client.reads == [['1', '2'], ['1']]
+
+
+def test_callers_cannot_change_the_cached_associations(hubspot_service, hubspot_client):
+    hubspot_service.get_company_for_deal(1).results[0].first()
+
+    assert hubspot_service.get_company_for_deal(1).first().id == '100'
+    assert hubspot_client.reads == [['1']]
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from app.services import BatchExecutionError, BatchExecutor
+
+
+def executor(**kwargs):
+    return BatchExecutor(**{'chunk_size': 2, 'backoff_seconds': 0, 'requests_per_second': 0, **kwargs})
+
+
+def test_inputs_are_sent_in_chunks_and_results_collected():
+    chunks = []
+    lock = threading.Lock()
+
+    def request(chunk):
+        with lock:
+            chunks.append(chunk)
+        return [item * 10 for item in chunk]
+
+    results = executor().execute([1, 2, 3, 4, 5], request)
+
+    assert sorted(results) == [10, 20, 30, 40, 50]
+    assert sorted(chunks) == [[1, 2], [3, 4], [5]]
+
+
+def test_only_failed_chunks_are_retried():
+    calls = []
+    lock = threading.Lock()
+
+    def request(chunk):
+        with lock:
+            calls.append(chunk)
+            if chunk == [3, 4] and calls.count(chunk) == 1:
+                raise Exception('HubSpot unavailable')
+        return chunk
+
+    results = executor().execute([1, 2, 3, 4, 5], request)
+
+    assert sorted(results) == [1, 2, 3, 4, 5]
+    assert calls.count([1, 2]) == 1
+    assert calls.count([3, 4]) == 2
+
+
+def test_a_partial_failure_reports_the_results_and_failed_inputs():
+    def request(chunk):
+        if 3 in chunk:
+            raise Exception('HubSpot unavailable')
+        return chunk
+
+    with pytest.raises(BatchExecutionError) as error:
+        executor(max_retries=2).execute([1, 2, 3, 4, 5], request)
+
+    assert sorted(error.value.results) == [1, 2, 5]
+    assert error.value.failed_inputs == [3, 4]
+    assert '1 of 3 batch chunks failed' in str(error.value)
+
+
+def test_no_retry_fails_on_the_first_error():
+    calls = []
+
+    def request(chunk):
+        calls.append(chunk)
+        raise Exception('HubSpot unavailable')
+
+    with pytest.raises(BatchExecutionError) as error:
+        executor().execute([1, 2], request, retry=False)
+
+    assert calls == [[1, 2]]
+    assert error.value.results == []
+    assert error.value.failed_inputs == [1, 2]
@@ -0,0 +1,142 @@
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions
+from app.models import (
+    BatchItemStatus, EmergeBillingInfoResult, EmergeCompanyBillingInfo, HubSpotCompanySyncRequest, HubSpotDealSyncRequest
+)
+from app.services import BatchExecutionError
+
+
+@pytest.fixture
+def services(container):
+    emerge_service = mock.MagicMock()
+    hubspot_service = mock.MagicMock()
+    task_service = mock.MagicMock()
+    container.emerge_service.override(providers.Object(emerge_service))
+    container.hubspot_service.override(providers.Object(hubspot_service))
+    container.task_service.override(providers.Object(task_service))
+    return emerge_service, hubspot_service, task_service
+
+
+def billing_results(company_ids, year, month, use_snapshot):
+    for company_id in company_ids:
+        if company_id == 2:
+            yield EmergeBillingInfoResult(company_id=company_id, error='Emerge timed out')
+        else:
+            yield EmergeBillingInfoResult(
+                company_id=company_id,
+                billing_info=EmergeCompanyBillingInfo.model_validate({'EmergeCompanyId': company_id})
+            )
+
+
+def company_sync_request(object_id, emerge_company_id):
+    return HubSpotCompanySyncRequest(object_id=object_id, type='COMPANY', emerge_company_id=emerge_company_id)
+
+
+def test_company_batch_reports_a_status_per_item(services):
+    emerge_service, hubspot_service, task_service = services
+    emerge_service.get_customers_billing_info.side_effect = billing_results
+
+    def update_companies(records):
+        failed = [record for record in records if record['id'] == '13']
+        raise BatchExecutionError('1 of 2 updates failed', results=[], failed_inputs=failed)
+
+    hubspot_service.update_companies.side_effect = update_companies
+    sync_requests = [
+        company_sync_request(10, None),
+        company_sync_request(11, 1),
+        company_sync_request(12, 2),
+        company_sync_request(13, 3),
+        company_sync_request(11, 1),
+    ]
+
+    results = functions.process_batch(
+        functions.sync_emerge_companies_batch,
+        'hubspot/v1/company-sync/worker',
+        sync_requests,
+        lane='bulk'
+    )
+
+    assert [result.status for result in results] == [
+        BatchItemStatus.SKIPPED,
+        BatchItemStatus.SKIPPED,
+        BatchItemStatus.FAILED,
+        BatchItemStatus.FAILED,
+        BatchItemStatus.SUCCEEDED,
+    ]
+    assert results[2].detail == 'Emerge timed out'
+    assert results[3].detail == '1 of 2 updates failed'
+    assert sorted(record['id'] for record in hubspot_service.update_companies.call_args.kwargs['records']) == ['11', '13']
+    # only the failed items are retried, one task each on the single item worker
+    assert task_service.enqueue.call_args_list == [
+        mock.call('hubspot/v1/company-sync/worker', payload=sync_requests[2], lane='bulk'),
+        mock.call('hubspot/v1/company-sync/worker', payload=sync_requests[3], lane='bulk'),
+    ]
+
+
+def test_failed_shared_lookup_fails_every_pending_item(services):
+    emerge_service, hubspot_service, task_service = services
+    emerge_service.get_customers_billing_info.side_effect = billing_results
+    hubspot_service.get_companies_for_deals.side_effect = Exception('HubSpot unavailable')
+    sync_requests = [
+        HubSpotCompanySyncRequest(object_id=20, type='DEAL', emerge_company_id=1),
+        HubSpotCompanySyncRequest(object_id=21, type='DEAL', emerge_company_id=None),
+    ]
+
+    results = functions.process_batch(
+        functions.sync_emerge_companies_batch,
+        'hubspot/v1/company-sync/worker',
+        sync_requests,
+        lane='bulk'
+    )
+
+    assert [result.status for result in results] == [BatchItemStatus.FAILED, BatchItemStatus.SKIPPED]
+    hubspot_service.update_companies.assert_not_called()
+    task_service.enqueue.assert_called_once_with('hubspot/v1/company-sync/worker', payload=sync_requests[0], lane='bulk')
+
+
+def test_successful_batch_enqueues_nothing(services):
+    emerge_service, hubspot_service, task_service = services
+    emerge_service.get_customers_billing_info.side_effect = billing_results
+
+    results = functions.process_batch(
+        functions.sync_emerge_companies_batch,
+        'hubspot/v1/company-sync/worker',
+        [company_sync_request(11, 1), company_sync_request(13, 3)],
+        lane='bulk'
+    )
+
+    assert all(result.status == BatchItemStatus.SUCCEEDED for result in results)
+    task_service.enqueue.assert_not_called()
+
+
+def customer_deal(deal_id, original_deal_id):
+    return {
+        'id': deal_id,
+        'properties': {'dealname': 'Customer Deal - Acme', 'original_closed_won_deal': original_deal_id}
+    }
+
+
+def test_a_failed_original_deal_association_fails_every_customer_deal_sharing_it(services):
+    emerge_service, hubspot_service, task_service = services
+    hubspot_service.get_companies_for_deals.return_value = {}
+    hubspot_service.get_deals.return_value = [
+        customer_deal('30', '500'), customer_deal('31', '500'), customer_deal('32', '600')
+    ]
+    hubspot_service.get_companies_by_names.return_value = {'acme': [{'id': '900'}]}
+    hubspot_service.set_company_for_deals.side_effect = BatchExecutionError(
+        'HubSpot unavailable',
+        results=[],
+        failed_inputs=[{'from': {'id': '500'}, 'to': {'id': '900'}, 'type': 'deal_to_company'}]
+    )
+    sync_requests = [HubSpotDealSyncRequest(object_id=deal_id) for deal_id in (30, 31, 32)]
+
+    results = functions.associate_customer_deals_batch(sync_requests=sync_requests)
+
+    assert [result.status for result in results[:2]] == [BatchItemStatus.FAILED, BatchItemStatus.FAILED]
+    assert results[2].status != BatchItemStatus.FAILED
+    associations = hubspot_service.set_customer_company_for_deals.call_args.kwargs['associations']
+    assert associations == [{'deal_id': '32', 'company_id': '900'}]
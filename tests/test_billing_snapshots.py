@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+
+from app.services import BillingSnapshotService, EmergeService
+
+
+@pytest.fixture
+def snapshots(firestore_client):
+    return BillingSnapshotService(firestore_client, collection='emerge_billing_snapshots', current_month_ttl=900)
+
+
+@pytest.fixture
+def emerge_client():
+    emerge_client = mock.MagicMock()
+    emerge_client.customer_billing_info.side_effect = lambda company_id, year, month: {
+        'EmergeCompanyId': company_id,
+        'EmergeCompanyName': 'Live'
+    }
+    return emerge_client
+
+
+def store(firestore_client, year, month, fetched_at, name='Stored'):
+    firestore_client.collection('emerge_billing_snapshots').document(f"7-{year}-{month:02d}").set({
+        'company_id': 7,
+        'fetched_at': fetched_at,
+        'billing_info': {'EmergeCompanyId': 7, 'EmergeCompanyName': name}
+    })
+
+
+def test_a_month_is_closed_a_day_after_it_ends(snapshots):
+    assert not snapshots.is_closed(2026, 9, as_of=datetime(2026, 10, 1, 12, tzinfo=timezone.utc))
+    assert snapshots.is_closed(2026, 9, as_of=datetime(2026, 10, 2, tzinfo=timezone.utc))
+    assert snapshots.is_closed(2025, 12, as_of=datetime(2026, 1, 2, tzinfo=timezone.utc))
+
+
+def test_closed_months_are_served_from_the_store_on_the_sync_path(firestore_client, snapshots, emerge_client):
+    store(firestore_client, 2026, 8, fetched_at=datetime(2026, 9, 15, tzinfo=timezone.utc))
+    emerge_service = EmergeService(emerge_client, billing_snapshot_service=snapshots)
+
+    billing_info = emerge_service.get_customer_billing_info(company_id=7, year=2026, month=8, use_snapshot=False)
+
+    assert billing_info.company_name == 'Stored'
+    assert billing_info.stale_as_of is None
+    emerge_client.customer_billing_info.assert_not_called()
+
+
+def test_a_snapshot_fetched_while_the_month_was_open_is_not_final(firestore_client, snapshots, emerge_client):
+    store(firestore_client, 2026, 8, fetched_at=datetime(2026, 8, 20, tzinfo=timezone.utc))
+    emerge_service = EmergeService(emerge_client, billing_snapshot_service=snapshots)
+
+    billing_info = emerge_service.get_customer_billing_info(company_id=7, year=2026, month=8, use_snapshot=False)
+
+    assert billing_info.company_name == 'Live'
+    refreshed = snapshots.get_snapshot(company_id=7, year=2026, month=8, closed_only=True)
+    assert refreshed.company_name == 'Live'
+
+
+def test_the_open_month_is_read_live_on_the_sync_path_and_cached_for_the_crm_card(snapshots, emerge_client):
+    now = datetime.now(timezone.utc)
+    emerge_service = EmergeService(emerge_client, billing_snapshot_service=snapshots)
+
+    emerge_service.get_customer_billing_info(company_id=7, year=now.year, month=now.month, use_snapshot=False)
+    emerge_service.get_customer_billing_info(company_id=7, year=now.year, month=now.month, use_snapshot=False)
+    assert emerge_client.customer_billing_info.call_count == 2
+
+    emerge_service.get_customer_billing_info(company_id=7, year=now.year, month=now.month)
+    assert emerge_client.customer_billing_info.call_count == 2
+
+
+def test_an_expired_open_month_snapshot_is_only_a_fallback(firestore_client, snapshots):
+    now = datetime.now(timezone.utc)
+    store(firestore_client, now.year, now.month, fetched_at=now - timedelta(hours=1))
+
+    assert snapshots.get_snapshot(company_id=7, year=now.year, month=now.month) is None
+    fallback = snapshots.get_snapshot(company_id=7, year=now.year, month=now.month, allow_stale=True)
+    assert fallback.stale_as_of == now - timedelta(hours=1)
@@ -0,0 +1,55 @@
+import time
+from unittest import mock
+
+from app.models import EmergeCompanyBillingInfo
+from app.services import EmergeService
+
+
+def billing_info(company_id, year, month):
+    if company_id == 1:
+        # stalls past the deadline, and keeps its worker busy after it is abandoned
+        time.sleep(0.6)
+    return {'EmergeCompanyId': company_id}
+
+
+def emerge_service():
+    emerge_client = mock.MagicMock()
+    emerge_client.customer_billing_info.side_effect = billing_info
+    return EmergeService(emerge_client)
+
+
+def results_by_company(results):
+    return {result.company_id: result for result in results}
+
+
+def test_calls_queued_behind_an_abandoned_call_get_their_own_deadline():
+    results = results_by_company(
+        emerge_service().get_customers_billing_info(
+            company_ids=[1, 2, 3],
+            year=2026,
+            month=10,
+            max_concurrency=1,
+            timeout=0.2,
+            use_snapshot=False
+        )
+    )
+
+    assert results[1].error == 'Timed out after 0.2s'
+    assert results[2].ok and results[3].ok
+    assert results[2].billing_info == EmergeCompanyBillingInfo.model_validate({'EmergeCompanyId': 2})
+
+
+def test_results_are_yielded_as_calls_finish():
+    results = list(
+        emerge_service().get_customers_billing_info(
+            company_ids=[2, 3, 4],
+            year=2026,
+            month=10,
+            max_concurrency=2,
+            timeout=1,
+            use_snapshot=False
+        )
+    )
+
+    assert sorted(result.company_id for result in results) == [2, 3, 4]
+    assert all(result.ok for result in results)
@@ -0,0 +1,122 @@
+from unittest import mock
+
+import pytest
+
+from app.services import CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch('app.services.time.monotonic', clock):
+        yield clock
+
+
+def failing():
+    raise RuntimeError('Emerge unavailable')
+
+
+def breaker(minimum_calls=4, slow_call_seconds=10, half_open_max_calls=1):
+    return CircuitBreaker(
+        name='emerge',
+        failure_rate_threshold=0.5,
+        minimum_calls=minimum_calls,
+        window_size=4,
+        slow_call_seconds=slow_call_seconds,
+        open_seconds=30,
+        half_open_max_calls=half_open_max_calls
+    )
+
+
+def test_stays_closed_below_the_minimum_calls(clock):
+    circuit_breaker = breaker()
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            circuit_breaker.call(failing)
+
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_at_the_failure_rate_and_rejects_calls(clock):
+    circuit_breaker = breaker()
+    circuit_breaker.call(lambda: 'ok')
+    circuit_breaker.call(lambda: 'ok')
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            circuit_breaker.call(failing)
+
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    function = mock.Mock()
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.call(function)
+    function.assert_not_called()
+
+
+def test_slow_calls_count_as_failures(clock):
+    circuit_breaker = breaker(slow_call_seconds=10)
+
+    def slow():
+        clock.now += 11
+        return 'ok'
+
+    for _ in range(4):
+        assert circuit_breaker.call(slow) == 'ok'
+
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_probe_closes_on_success(clock):
+    circuit_breaker = breaker(minimum_calls=1)
+    with pytest.raises(RuntimeError):
+        circuit_breaker.call(failing)
+    clock.now += 30
+
+    assert circuit_breaker.call(lambda: 'ok') == 'ok'
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe_reopens_on_failure(clock):
+    circuit_breaker = breaker(minimum_calls=1)
+    with pytest.raises(RuntimeError):
+        circuit_breaker.call(failing)
+    clock.now += 30
+
+    with pytest.raises(RuntimeError):
+        circuit_breaker.call(failing)
+
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.call(lambda: 'ok')
+
+
+def test_half_open_admits_a_limited_number_of_probes(clock):
+    circuit_breaker = breaker(minimum_calls=1, half_open_max_calls=1)
+    with pytest.raises(RuntimeError):
+        circuit_breaker.call(failing)
+    clock.now += 30
+
+    assert circuit_breaker.allow()
+    assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    assert not circuit_breaker.allow()
+
+
+def test_opening_is_logged_after_the_lock_is_released(clock, logging_client):
+    circuit_breaker = breaker(minimum_calls=1)
+    lock_held = []
+    logging_client.logger.return_value.log_text.side_effect = lambda *args, **kwargs: lock_held.append(
+        circuit_breaker.lock.locked()
+    )
+
+    with pytest.raises(RuntimeError):
+        circuit_breaker.call(failing)
+
+    assert lock_held == [False]
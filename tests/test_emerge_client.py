@@ -0,0 +1,64 @@
+from unittest import mock
+
+import pytest
+
+from app.services import CircuitBreaker, EmergeClient
+
+
+def response(status_code, headers=None, body=None):
+    return mock.MagicMock(status_code=status_code, headers=headers or {}, text='throttled', json=lambda: body)
+
+
+@pytest.fixture
+def sleep():
+    with mock.patch('app.services.sleep') as sleep:
+        yield sleep
+
+
+def client():
+    return EmergeClient(
+        access_token='token',
+        throttle_retries=3,
+        throttle_backoff_seconds=1,
+        throttle_max_wait_seconds=10
+    )
+
+
+def test_throttled_calls_back_off_then_succeed(sleep):
+    responses = [response(429), response(429), response(200, body={})]
+    with mock.patch('app.services.requests.request', side_effect=responses):
+        assert client().customer_billing_info(company_id=1, year=2026, month=10) == {}
+
+    assert sleep.call_args_list == [mock.call(1), mock.call(2)]
+
+
+def test_retry_after_is_honoured(sleep):
+    with mock.patch(
+        'app.services.requests.request',
+        side_effect=[response(429, headers={'Retry-After': '4'}), response(200, body={})]
+    ):
+        client().customer_billing_info(company_id=1, year=2026, month=10)
+
+    sleep.assert_called_once_with(4)
+
+
+def test_sustained_throttling_fails_the_call_and_counts_against_the_breaker(sleep):
+    circuit_breaker = CircuitBreaker(name='emerge', minimum_calls=1)
+    emerge_client = client()
+
+    with mock.patch('app.services.requests.request', return_value=response(429)) as request:
+        with pytest.raises(Exception, match='throttled'):
+            circuit_breaker.call(emerge_client.customer_billing_info, company_id=1, year=2026, month=10)
+
+    assert request.call_count == 4
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+
+
+def test_a_retry_after_beyond_the_limit_fails_at_once(sleep):
+    throttled = response(429, headers={'Retry-After': '120'})
+    with mock.patch('app.services.requests.request', return_value=throttled) as request:
+        with pytest.raises(Exception, match='throttled'):
+            client().customer_billing_info(company_id=1, year=2026, month=10)
+
+    assert request.call_count == 1
+    sleep.assert_not_called()
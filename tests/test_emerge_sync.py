@@ -0,0 +1,64 @@
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions
+from app.models import EmergeCompanyInfo
+from app.services import FirestoreService
+
+
+def customer(company_id, last_modified_date):
+    return EmergeCompanyInfo.model_validate({
+        'EmergeCompanyId': company_id,
+        'EmergeCompanyName': f"Customer {company_id}",
+        'HubSpotObjectId': 100 + company_id,
+        'AccountStatus': 'Active',
+        'DateOpened': '2020-01-01T00:00:00',
+        'NumberOfUsers': 1,
+        'NumberOfLocations': 1,
+        'LastModifiedDate': last_modified_date
+    })
+
+
+@pytest.fixture
+def sync(container, firestore_client):
+    emerge_service = mock.MagicMock()
+    emerge_service.get_all_customers.return_value = [
+        customer(1, '2026-10-01T00:00:00'),
+        customer(2, '2026-10-02T00:00:00'),
+        customer(3, '2026-10-03T00:00:00'),
+    ]
+    task_service = mock.MagicMock()
+    firestore_service = FirestoreService(firestore_client)
+    firestore_client.collection('emerge_sync').document('settings').set({'watermark': '2026-09-01T00:00:00+00:00'})
+    container.emerge_service.override(providers.Object(emerge_service))
+    container.task_service.override(providers.Object(task_service))
+    container.firestore_service.override(providers.Object(firestore_service))
+    container.config.emerge.sync.batch_size.from_value(1)
+    container.config.hubspot.batch.requests_per_second.from_value(None)
+    return task_service, firestore_service
+
+
+def synced_company_ids(task_service):
+    return [call.kwargs['payload'][0].emerge_company_id for call in task_service.enqueue.call_args_list]
+
+
+def test_failed_enqueue_keeps_the_position_before_the_batch(sync):
+    task_service, firestore_service = sync
+    task_service.enqueue.side_effect = [None, RuntimeError('Cloud Tasks unavailable')]
+
+    with pytest.raises(RuntimeError):
+        functions.sync_emerge_companies_to_hubspot()
+
+    state = firestore_service.get_emerge_sync_state()
+    assert state['run']['position'] == ['2026-10-01T00:00:00+00:00', 1]
+    assert state['watermark'] == '2026-09-01T00:00:00+00:00'
+
+    task_service.enqueue.side_effect = None
+    assert functions.sync_emerge_companies_to_hubspot()
+
+    assert synced_company_ids(task_service) == [1, 2, 2, 3]
+    state = firestore_service.get_emerge_sync_state()
+    assert 'run' not in state
+    assert state['watermark'] == '2026-10-03T00:00:00+00:00'
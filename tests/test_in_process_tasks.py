@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.services import InProcessTaskService, current_task_name
+
+
+class Recorder:
+
+    def __init__(self, expected, fail_times=0):
+        self.expected = expected
+        self.fail_times = fail_times
+        self.calls = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, payload):
+        with self.lock:
+            self.calls.append((payload, current_task_name.get()))
+            if len(self.calls) <= self.fail_times:
+                raise Exception('handler failed')
+            if len(self.calls) >= self.expected:
+                self.done.set()
+
+
+def in_the(seconds):
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+def test_scheduled_tasks_run_in_schedule_time_order():
+    recorder = Recorder(expected=3)
+    task_service = InProcessTaskService({'worker': recorder}, max_workers=1)
+
+    task_service.enqueue('worker', payload='c', schedule_time=in_the(0.3))
+    task_service.enqueue('worker', payload='a', schedule_time=in_the(0.1))
+    task_service.enqueue('worker', payload='b', schedule_time=in_the(0.2))
+
+    assert recorder.done.wait(timeout=5)
+    assert [payload for payload, _ in recorder.calls] == ['a', 'b', 'c']
+    task_service.shutdown()
+
+
+def test_a_scheduled_task_does_not_hold_back_immediate_ones(logging_client):
+    recorder = Recorder(expected=1)
+    task_service = InProcessTaskService({'worker': recorder}, max_workers=1)
+
+    task_service.enqueue('worker', payload='later', schedule_time=in_the(30))
+    task_service.enqueue('worker', payload='now')
+
+    assert recorder.done.wait(timeout=5)
+    task_service.shutdown()
+    assert [payload for payload, _ in recorder.calls] == ['now']
+    logged = [entry.args[0] for entry in logging_client.logger.return_value.log_text.call_args_list]
+    assert 'Dropping 1 scheduled in-process tasks on shutdown' in logged
+
+
+def test_failed_tasks_are_retried_under_the_same_task_name():
+    recorder = Recorder(expected=3, fail_times=2)
+    task_service = InProcessTaskService({'worker': recorder}, backoff_seconds=0.01)
+
+    task_service.enqueue('worker', payload='a')
+
+    assert recorder.done.wait(timeout=5)
+    assert len({task_name for _, task_name in recorder.calls}) == 1
+    assert recorder.calls[0][1].startswith('in-process-')
+    task_service.shutdown()
+
+
+def test_a_task_is_given_up_after_the_retry_limit():
+    recorder = Recorder(expected=99, fail_times=99)
+    task_service = InProcessTaskService({'worker': recorder}, max_retries=2, backoff_seconds=0.01)
+    task_service.enqueue('worker', payload='a')
+
+    recorder.done.wait(timeout=0.5)
+
+    assert len(recorder.calls) == 3
+    task_service.shutdown()
+
+
+def test_unknown_handlers_are_rejected():
+    task_service = InProcessTaskService({})
+
+    with pytest.raises(ValueError):
+        task_service.enqueue('missing')
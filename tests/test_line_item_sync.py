@@ -0,0 +1,111 @@
+from app.functions import plan_line_item_sync
+from app.models import PricingTier
+
+PRODUCTS = {
+    '1': {'name': 'County Search', 'price': '10.00', 'tier_2': '8.00', 'hs_sku': 'CS-1'},
+    '2': {'name': 'Drug Test', 'price': '25', 'tier_2': None, 'hs_sku': 'DT-1'},
+    '3': {'name': 'No SKU', 'price': '5', 'tier_2': '4', 'hs_sku': None},
+}
+
+
+def line_item(line_item_id, product_id, price, quantity='1'):
+    return {
+        'id': line_item_id,
+        'properties': {'hs_product_id': product_id, 'price': price, 'quantity': quantity}
+    }
+
+
+def test_matching_line_items_are_left_alone():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_1,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '10'), line_item('b', '2', '25.0')]
+    )
+
+    assert plan.is_empty()
+    assert plan.unchanged_line_item_ids == ['a', 'b']
+
+
+def test_price_and_quantity_changes_are_planned_as_updates():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_1,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '9.00'), line_item('b', '2', '25', quantity='0')]
+    )
+
+    assert plan.line_items_to_update == [
+        {'id': 'a', 'properties': {'price': '10.00'}},
+        {'id': 'b', 'properties': {'quantity': '1'}},
+    ]
+    assert plan.line_items_to_create == []
+    assert plan.line_item_ids_to_delete == []
+
+
+def test_stale_line_items_are_reused_before_creating_new_ones():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_1,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '99', '1')]
+    )
+
+    assert plan.line_items_to_update == [{
+        'id': 'a',
+        'properties': {'name': 'County Search', 'hs_product_id': '1', 'quantity': '1', 'price': '10.00', 'hs_sku': 'CS-1'}
+    }]
+    assert plan.line_items_to_create == [
+        {'name': 'Drug Test', 'hs_product_id': '2', 'quantity': '1', 'price': '25', 'hs_sku': 'DT-1'}
+    ]
+    assert plan.line_item_ids_to_delete == []
+
+
+def test_products_without_a_tier_price_or_sku_are_removed():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_2,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '8'), line_item('b', '2', '25'), line_item('c', '3', '4')]
+    )
+
+    assert plan.unchanged_line_item_ids == ['a']
+    assert sorted(plan.line_item_ids_to_delete) == ['b', 'c']
+
+
+def test_duplicate_line_items_are_deleted():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_2,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '8'), line_item('b', '1', '8')]
+    )
+
+    assert plan.unchanged_line_item_ids == ['a']
+    assert plan.line_item_ids_to_delete == ['b']
+
+
+def test_no_pricing_tier_deletes_every_line_item():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=None,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '10'), line_item('b', '2', '25')]
+    )
+
+    assert plan.line_item_ids_to_delete == ['a', 'b']
+    assert plan.line_items_to_create == []
+
+
+def test_prices_only_never_creates_or_deletes():
+    plan = plan_line_item_sync(
+        deal_id=1,
+        pricing_tier=PricingTier.TIER_1,
+        products=PRODUCTS,
+        deal_line_items=[line_item('a', '1', '9'), line_item('b', '99', '1', quantity='0')],
+        prices_only=True
+    )
+
+    assert plan.line_items_to_update == [{'id': 'a', 'properties': {'price': '10.00'}}]
+    assert plan.line_items_to_create == []
+    assert plan.line_item_ids_to_delete == []
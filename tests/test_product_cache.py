@@ -0,0 +1,79 @@
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions
+from app.services import HubSpotService
+
+
+@pytest.fixture
+def hubspot_client():
+    hubspot_client = mock.MagicMock(auth_refreshed=False)
+    hubspot_client.get_records.return_value = {
+        'content': {'results': [{'id': '1', 'properties': {'name': 'County Search', 'price': '10'}}]}
+    }
+    hubspot_client.custom_request.return_value = {'content': {'total': 0}}
+    return hubspot_client
+
+
+@pytest.fixture
+def hubspot_service(hubspot_client):
+    HubSpotService.product_cache = {}
+    yield HubSpotService(
+        firestore_collection='hubspot',
+        auth_document='auth',
+        access_token_location='access_token',
+        expires_at_location='expires_at',
+        hubspot_client=hubspot_client,
+        firestore_client=mock.MagicMock(),
+        batch_executor=mock.MagicMock(),
+        product_cache_ttl=300
+    )
+    HubSpotService.product_cache = {}
+
+
+def test_unchanged_catalog_is_served_from_the_cache(hubspot_service, hubspot_client):
+    hubspot_service.get_all_products(property_names=['name', 'price'])
+    products = hubspot_service.get_all_products(property_names=['name', 'price'])
+
+    assert products == {'1': {'name': 'County Search', 'price': '10'}}
+    assert hubspot_client.get_records.call_count == 1
+    search = hubspot_client.custom_request.call_args.kwargs
+    assert search['endpoint'] == 'crm/v3/objects/products/search'
+
+
+def test_a_catalog_change_is_read_before_the_next_price_write(hubspot_service, hubspot_client):
+    hubspot_service.get_all_products(property_names=['name', 'price'])
+    hubspot_client.get_records.return_value = {
+        'content': {'results': [{'id': '1', 'properties': {'name': 'County Search', 'price': '12'}}]}
+    }
+    hubspot_client.custom_request.return_value = {'content': {'total': 1}}
+
+    products = hubspot_service.get_all_products(property_names=['name', 'price'])
+
+    assert products['1']['price'] == '12'
+    assert hubspot_client.get_records.call_count == 2
+
+
+def test_an_expired_cache_is_read_again_without_a_search(hubspot_service, hubspot_client):
+    hubspot_service.product_cache_ttl = 0
+    hubspot_service.get_all_products(property_names=['name', 'price'])
+    hubspot_service.get_all_products(property_names=['name', 'price'])
+
+    assert hubspot_client.get_records.call_count == 2
+    hubspot_client.custom_request.assert_not_called()
+
+
+def test_warm_up_primes_the_product_catalog(container, hubspot_service, hubspot_client):
+    container.hubspot_service.override(providers.Object(hubspot_service))
+    container.firestore_service.override(providers.Object(mock.MagicMock()))
+    hubspot_client.custom_request.side_effect = lambda method, endpoint, **kwargs: {
+        'content': {'total': 0} if endpoint.endswith('/search') else {'results': []}
+    }
+
+    report = functions.warm_up()
+
+    assert report['products']['loaded'] == 1
+    hubspot_service.get_all_products(property_names=functions.PRODUCT_PROPERTIES)
+    assert hubspot_client.get_records.call_count == 1
@@ -0,0 +1,43 @@
+from app import serialization
+from app.models import HubSpotCompanySyncRequest, HubSpotLineItemSyncRequest
+
+
+def test_company_sync_batch_with_none_fields_round_trips():
+    batch = [
+        HubSpotCompanySyncRequest(object_id=1, type='COMPANY', emerge_company_id=10),
+        HubSpotCompanySyncRequest(
+            object_id=2,
+            type='DEAL',
+            emerge_company_id=None,
+            days_from_last_report=3,
+            account_manager_email=None,
+            status_change_date=None
+        ),
+    ]
+
+    restored = serialization.validate_list(HubSpotCompanySyncRequest, serialization.loads(serialization.dumps(batch)))
+
+    assert restored == batch
+
+
+def test_line_item_sync_batch_keeps_a_cleared_pricing_tier():
+    batch = [
+        HubSpotLineItemSyncRequest(object_id=1, pricing_tier='A'),
+        HubSpotLineItemSyncRequest(object_id=2, pricing_tier=None),
+    ]
+
+    restored = serialization.validate_list(HubSpotLineItemSyncRequest, serialization.loads(serialization.dumps(batch)))
+
+    assert restored == batch
+    assert restored[1].pricing_tier is None
+
+
+def test_batch_serialized_without_none_fields_still_validates():
+    batch = [HubSpotCompanySyncRequest(object_id=None, type='COMPANY', emerge_company_id=None)]
+
+    restored = serialization.validate_list(
+        HubSpotCompanySyncRequest,
+        serialization.loads(serialization.dumps(batch, exclude_none=True))
+    )
+
+    assert restored[0].emerge_company_id is None
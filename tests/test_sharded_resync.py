@@ -0,0 +1,144 @@
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions
+from app.models import BatchItemResult, BatchItemStatus, EmergeCompanyInfo, EmergeSyncShardBatchRequest, \
+    EmergeSyncShardRequest
+from app.services import FirestoreService
+
+
+def customer(company_id):
+    return EmergeCompanyInfo.model_validate({
+        'EmergeCompanyId': company_id,
+        'EmergeCompanyName': f"Customer {company_id}",
+        'HubSpotObjectId': 100 + company_id,
+        'AccountStatus': 'Active',
+        'DateOpened': '2020-01-01T00:00:00',
+        'NumberOfUsers': 1,
+        'NumberOfLocations': 1
+    })
+
+
+@pytest.fixture
+def resync(container, firestore_client):
+    emerge_service = mock.MagicMock()
+    emerge_service.get_all_customers.return_value = [customer(company_id) for company_id in range(7, 0, -1)]
+    task_service = mock.MagicMock()
+    firestore_service = FirestoreService(firestore_client)
+    container.emerge_service.override(providers.Object(emerge_service))
+    container.task_service.override(providers.Object(task_service))
+    container.firestore_service.override(providers.Object(firestore_service))
+    container.config.emerge.sync.batch_size.from_value(2)
+    return emerge_service, task_service, firestore_service
+
+
+def enqueued(task_service, relative_handler_uri):
+    return [
+        call.kwargs['payload'] for call in task_service.enqueue.call_args_list if call.args[0] == relative_handler_uri
+    ]
+
+
+def sync_batch(sync_requests, **kwargs):
+    return [
+        BatchItemResult(
+            object_id=sync_request.object_id,
+            status=BatchItemStatus.FAILED if sync_request.emerge_company_id == 7 else BatchItemStatus.SUCCEEDED
+        ) for sync_request in sync_requests
+    ]
+
+
+def run_shards(task_service, shard_count):
+    for shard_request in enqueued(task_service, 'intellifi/v1/companies/sync/shard/worker')[:shard_count]:
+        functions.sync_emerge_companies_shard(shard_request=shard_request)
+
+
+def test_customer_list_is_fetched_once_for_all_shards(resync):
+    emerge_service, task_service, firestore_service = resync
+
+    run_id = functions.start_sharded_resync(shard_count=3)
+
+    emerge_service.get_all_customers.assert_called_once()
+    shards = [firestore_service.get_resync_shard(run_id=run_id, shard_index=shard_index) for shard_index in range(3)]
+    assert [shard['total'] for shard in shards] == [3, 2, 2]
+    assert [shard['batch_count'] for shard in shards] == [2, 1, 1]
+    batch = firestore_service.get_resync_batch(run_id=run_id, batch_id='0-0')
+    assert [sync_request['emerge_company_id'] for sync_request in batch['sync_requests']] == [1, 4]
+    assert len(enqueued(task_service, 'intellifi/v1/companies/sync/shard/worker')) == 3
+
+
+def test_resync_does_not_start_while_an_incremental_sync_holds_the_lease(resync):
+    _, task_service, firestore_service = resync
+    firestore_service.acquire_emerge_sync_lease(holder='incremental', duration=900)
+
+    assert functions.start_sharded_resync(shard_count=2) is None
+    task_service.enqueue.assert_not_called()
+
+
+def test_shards_dispatch_in_parallel(resync):
+    _, task_service, firestore_service = resync
+    run_id = functions.start_sharded_resync(shard_count=2)
+    # shard 0 is still dispatching on another instance
+    firestore_service.acquire_resync_shard_lease(run_id=run_id, shard_index=0, holder='other', duration=900)
+
+    with pytest.raises(RuntimeError):
+        functions.sync_emerge_companies_shard(
+            shard_request=EmergeSyncShardRequest(run_id=run_id, shard_index=0, shard_count=2)
+        )
+    functions.sync_emerge_companies_shard(
+        shard_request=EmergeSyncShardRequest(run_id=run_id, shard_index=1, shard_count=2)
+    )
+
+    batches = enqueued(task_service, 'intellifi/v1/companies/sync/shard/batch/worker')
+    assert [batch.batch_id for batch in batches] == ['1-0', '1-1']
+    assert firestore_service.get_resync_shard(run_id=run_id, shard_index=1)['status'] == 'dispatched'
+
+
+def test_redelivered_batches_are_counted_once_and_the_run_completes(resync, firestore_client):
+    _, task_service, firestore_service = resync
+    run_id = functions.start_sharded_resync(shard_count=2)
+    run_shards(task_service, 2)
+    batches = enqueued(task_service, 'intellifi/v1/companies/sync/shard/batch/worker')
+
+    with mock.patch.object(functions, 'sync_emerge_companies_batch', side_effect=sync_batch) as batch_function:
+        for batch in batches:
+            functions.sync_emerge_companies_shard_batch(batch_request=batch)
+        # Cloud Tasks redelivers a batch that already landed
+        assert functions.sync_emerge_companies_shard_batch(batch_request=batches[0]) == []
+
+    assert batch_function.call_count == len(batches)
+    run = firestore_service.get_resync_run(run_id=run_id)
+    assert (run['status'], run['total'], run['processed'], run['failed']) == ('completed', 7, 7, 1)
+    # the finished resync hands the global lease back to the incremental sync
+    assert firestore_service.acquire_emerge_sync_lease(holder='incremental', duration=900)
+
+
+def test_batches_finishing_before_dispatch_ends_still_complete_the_shard(resync):
+    _, task_service, firestore_service = resync
+    run_id = functions.start_sharded_resync(shard_count=1)
+
+    with mock.patch.object(functions, 'sync_emerge_companies_batch', side_effect=sync_batch):
+        for batch_index in range(4):
+            functions.sync_emerge_companies_shard_batch(
+                batch_request=EmergeSyncShardBatchRequest(run_id=run_id, shard_index=0, batch_id=f"0-{batch_index}")
+            )
+    assert firestore_service.get_resync_shard(run_id=run_id, shard_index=0)['status'] == 'pending'
+    run_shards(task_service, 1)
+
+    assert firestore_service.get_resync_run(run_id=run_id)['status'] == 'completed'
+
+
+def test_shard_batches_are_staggered_over_the_dispatch_window(resync, container):
+    _, task_service, _ = resync
+    container.config.emerge.sync.dispatch_window_seconds.from_value(60)
+    container.config.hubspot.batch.requests_per_second.from_value(None)
+    functions.start_sharded_resync(shard_count=1)
+
+    run_shards(task_service, 1)
+
+    schedule_times = [
+        call.kwargs['schedule_time'] for call in task_service.enqueue.call_args_list
+        if call.args[0] == 'intellifi/v1/companies/sync/shard/batch/worker'
+    ]
+    assert [(schedule_time - schedule_times[0]).total_seconds() for schedule_time in schedule_times] == [0, 15, 30, 45]
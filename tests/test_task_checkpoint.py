@@ -0,0 +1,112 @@
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions, services
+from app.models import EmergeCompanyBillingInfo, HubSpotCompanySyncRequest
+from app.services import CircuitOpenError, TaskCheckpoint
+
+TASK_NAME = 'projects/intellifi/locations/us-central1/queues/intellifi-events-queue/tasks/company-7'
+
+
+class CheckpointStore:
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    def get_task_checkpoint(self, key):
+        return dict(self.checkpoints[key]) if key in self.checkpoints else None
+
+    def record_task_step(self, key, step, value, ttl_seconds):
+        self.checkpoints.setdefault(key, {})[step] = value
+
+    def delete_task_checkpoint(self, key):
+        self.checkpoints.pop(key, None)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    with mock.patch('app.services.sleep') as sleep:
+        yield sleep
+
+
+def checkpoint(store, task_name=TASK_NAME, max_retries=2):
+    return TaskCheckpoint(store, task_name=task_name, scope='company-sync-7', max_retries=max_retries)
+
+
+def test_retried_task_resumes_after_the_last_completed_step():
+    store = CheckpointStore()
+    billing_info = EmergeCompanyBillingInfo.model_validate({'EmergeCompanyId': 7, 'EmergeCompanyName': 'Acme'})
+    first_attempt = checkpoint(store, max_retries=0)
+    first_attempt.step('billing', lambda: billing_info, model=EmergeCompanyBillingInfo)
+    with pytest.raises(RuntimeError):
+        first_attempt.step('update', mock.Mock(side_effect=RuntimeError('HubSpot unavailable')))
+
+    fetch = mock.Mock()
+    retry = checkpoint(store)
+    restored = retry.step('billing', fetch, model=EmergeCompanyBillingInfo)
+
+    fetch.assert_not_called()
+    assert restored == billing_info
+    assert retry.step('update', lambda: {'id': '1'}) == {'id': '1'}
+    retry.complete()
+    assert store.checkpoints == {}
+
+
+def test_transient_step_failures_are_retried_with_backoff(no_backoff):
+    function = mock.Mock(side_effect=[RuntimeError('timeout'), RuntimeError('timeout'), 'ok'])
+
+    assert checkpoint(CheckpointStore()).step('update', function) == 'ok'
+    assert function.call_count == 3
+    assert no_backoff.call_args_list == [mock.call(1.0), mock.call(2.0)]
+
+
+def test_non_idempotent_steps_and_open_circuits_are_not_retried():
+    merge = mock.Mock(side_effect=RuntimeError('timeout'))
+    with pytest.raises(RuntimeError):
+        checkpoint(CheckpointStore()).step('merge-2', merge, retry=False)
+    assert merge.call_count == 1
+
+    emerge = mock.Mock(side_effect=CircuitOpenError('Circuit emerge is open'))
+    with pytest.raises(CircuitOpenError):
+        checkpoint(CheckpointStore()).step('billing', emerge)
+    assert emerge.call_count == 1
+
+
+def test_nothing_is_recorded_outside_a_task():
+    store = CheckpointStore()
+    untracked = checkpoint(store, task_name=None)
+
+    assert untracked.step('billing', lambda: 'ok') == 'ok'
+    assert store.checkpoints == {}
+
+
+def test_company_sync_retry_skips_completed_emerge_and_merge_calls(container):
+    store = CheckpointStore()
+    emerge_service = mock.MagicMock()
+    emerge_service.get_customer_billing_info.return_value = EmergeCompanyBillingInfo.model_validate(
+        {'EmergeCompanyId': 7, 'EmergeCompanyName': 'Acme'}
+    )
+    hubspot_service = mock.MagicMock()
+    hubspot_service.get_company_by_emerge_company.return_value = {'total': 2, 'results': [{'id': '1'}, {'id': '2'}]}
+    hubspot_service.merge_companies.return_value = {'content': 'merged'}
+    hubspot_service.get_owner_by_email.return_value = None
+    # every retry of the first attempt fails, the redelivered task succeeds
+    hubspot_service.update_company.side_effect = [RuntimeError('HubSpot unavailable')] * 3 + [{'id': '1'}]
+    container.firestore_service.override(providers.Object(store))
+    container.emerge_service.override(providers.Object(emerge_service))
+    container.hubspot_service.override(providers.Object(hubspot_service))
+    sync_request = HubSpotCompanySyncRequest(type='COMPANY', emerge_company_id=7)
+
+    with services.task_scope(TASK_NAME):
+        with pytest.raises(RuntimeError):
+            functions.sync_emerge_company_to_hubspot(hubspot_company_sync_request=sync_request)
+        functions.sync_emerge_company_to_hubspot(hubspot_company_sync_request=sync_request)
+
+    emerge_service.get_customer_billing_info.assert_called_once()
+    hubspot_service.get_company_by_emerge_company.assert_called_once()
+    hubspot_service.merge_companies.assert_called_once_with(company_to_merge='2', company_to_keep='1')
+    assert hubspot_service.update_company.call_args.kwargs['company_id'] == '1'
+    assert hubspot_service.update_company.call_args.kwargs['properties']['name'] == 'Acme'
+    assert store.checkpoints == {}
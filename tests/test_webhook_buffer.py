@@ -0,0 +1,120 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from app.models import HubSpotWebhookEvent
+from app.services import WebhookEventBuffer
+
+
+def event(event_id):
+    return HubSpotWebhookEvent(
+        objectId=1,
+        propertyName='pricing_tier',
+        propertyValue='A',
+        changeSource='CRM_UI',
+        eventId=event_id,
+        subscriptionId=1,
+        portalId=1,
+        appId=1,
+        occurredAt=0,
+        subscriptionType='deal.propertyChange',
+        attemptNumber=0
+    )
+
+
+class TaskService:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+        self.enqueued = threading.Event()
+
+    def enqueue(self, uri, payload, lane=None):
+        if self.fail:
+            raise Exception('Cloud Tasks unavailable')
+        # live batches hold events, replayed batches hold what was persisted
+        self.batches.append([
+            queued_event['eventId'] if isinstance(queued_event, dict) else queued_event.eventId
+            for queued_event in payload
+        ])
+        self.enqueued.set()
+
+
+@pytest.fixture
+def firestore_service():
+    firestore_service = mock.MagicMock()
+    firestore_service.get_pending_webhook_event_batch_ids.return_value = []
+    return firestore_service
+
+
+def buffer(task_service, firestore_service, **kwargs):
+    webhook_event_buffer = WebhookEventBuffer(task_service, firestore_service, **kwargs)
+    webhook_event_buffer.start()
+    return webhook_event_buffer
+
+
+def test_a_full_batch_is_flushed_without_waiting_for_the_interval(firestore_service):
+    task_service = TaskService()
+    webhook_event_buffer = buffer(task_service, firestore_service, batch_size=2, flush_interval=30)
+
+    assert webhook_event_buffer.offer([event(1), event(2)])
+
+    assert task_service.enqueued.wait(timeout=5)
+    assert task_service.batches == [[1, 2]]
+    webhook_event_buffer.stop()
+
+
+def test_a_partial_batch_is_flushed_after_the_interval(firestore_service):
+    task_service = TaskService()
+    webhook_event_buffer = buffer(task_service, firestore_service, batch_size=50, flush_interval=0.05)
+
+    webhook_event_buffer.offer([event(1)])
+
+    assert task_service.enqueued.wait(timeout=5)
+    assert task_service.batches == [[1]]
+    webhook_event_buffer.stop()
+
+
+def test_buffered_events_are_flushed_on_shutdown(firestore_service):
+    task_service = TaskService()
+    webhook_event_buffer = buffer(task_service, firestore_service, batch_size=2, flush_interval=30)
+    webhook_event_buffer.offer([event(1)])
+
+    webhook_event_buffer.stop()
+
+    assert task_service.batches == [[1]]
+    assert not webhook_event_buffer.offer([event(2)])
+
+
+def test_a_full_buffer_refuses_events(firestore_service):
+    webhook_event_buffer = WebhookEventBuffer(TaskService(), firestore_service, max_size=2)
+
+    assert not webhook_event_buffer.offer([event(1)])
+    webhook_event_buffer.accepting = True
+    assert webhook_event_buffer.offer([event(1), event(2)])
+    assert not webhook_event_buffer.offer([event(3)])
+
+
+def test_events_that_cannot_be_enqueued_are_persisted(firestore_service):
+    webhook_event_buffer = buffer(TaskService(fail=True), firestore_service, batch_size=2, flush_interval=30)
+    webhook_event_buffer.offer([event(1), event(2)])
+
+    webhook_event_buffer.stop()
+
+    events = firestore_service.add_pending_webhook_events.call_args.kwargs['events']
+    assert [persisted['eventId'] for persisted in events] == [1, 2]
+
+
+def test_persisted_batches_are_replayed_once_claimed(firestore_service):
+    task_service = TaskService()
+    firestore_service.get_pending_webhook_event_batch_ids.return_value = ['a', 'b']
+    firestore_service.claim_pending_webhook_events.side_effect = lambda batch_id, holder, lease_seconds: (
+        [event(1).model_dump()] if batch_id == 'a' else None
+    )
+    webhook_event_buffer = WebhookEventBuffer(task_service, firestore_service)
+
+    webhook_event_buffer.replay_pending_events()
+
+    assert task_service.batches == [[1]]
+    firestore_service.delete_pending_webhook_events.assert_called_once_with(batch_id='a')
@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+from dependency_injector import providers
+
+from app import functions
+from app.models import HubSpotWebhookEvent
+from app.services import FirestoreService, WebhookEventDeduplicator
+
+
+def event(event_id, object_id=1):
+    return HubSpotWebhookEvent(
+        objectId=object_id,
+        propertyName='pricing_tier',
+        propertyValue='A',
+        changeSource='CRM_UI',
+        eventId=event_id,
+        subscriptionId=1,
+        portalId=1,
+        appId=1,
+        occurredAt=0,
+        subscriptionType='deal.propertyChange',
+        attemptNumber=0
+    )
+
+
+class EventStore:
+
+    def __init__(self):
+        self.documents = {}
+        self.client = mock.MagicMock()
+        events = self.client.collection.return_value.document.return_value.collection.return_value
+        events.document.side_effect = lambda event_id: mock.MagicMock(id=event_id)
+        self.client.get_all.side_effect = lambda refs, transaction=None: [self.snapshot(ref.id) for ref in refs]
+        self.client.transaction.side_effect = self.transaction
+        self.client.batch.side_effect = self.batch
+
+    def snapshot(self, event_id):
+        document = self.documents.get(event_id)
+        return mock.MagicMock(id=event_id, exists=document is not None, to_dict=lambda: dict(document))
+
+    def write(self, ref, document):
+        self.documents[ref.id] = document
+
+    def transaction(self):
+        transaction = mock.MagicMock(_max_attempts=1, _read_only=False)
+        transaction.set.side_effect = self.write
+        return transaction
+
+    def batch(self):
+        batch = mock.MagicMock()
+        batch.set.side_effect = self.write
+        batch.delete.side_effect = lambda ref: self.documents.pop(ref.id, None)
+        return batch
+
+    def expire(self, event_id):
+        self.documents[str(event_id)]['expires_at'] = datetime.now(timezone.utc) - timedelta(seconds=1)
+
+
+@pytest.fixture
+def store():
+    return EventStore()
+
+
+@pytest.fixture
+def firestore_service(store):
+    return FirestoreService(store.client)
+
+
+def event_ids(events):
+    return [routed_event.eventId for routed_event in events]
+
+
+def test_accept_drops_events_seen_in_memory(firestore_service):
+    deduplicator = WebhookEventDeduplicator(firestore_service)
+    deduplicator.remember([1])
+
+    accepted = deduplicator.accept([event(1), event(2), event(2)])
+
+    assert event_ids(accepted) == [2]
+    assert (deduplicator.received, deduplicator.dropped) == (3, 2)
+
+
+def test_pending_claims_hold_events_until_their_lease_expires(store, firestore_service):
+    deduplicator = WebhookEventDeduplicator(firestore_service, claim_seconds=60)
+
+    assert event_ids(deduplicator.claim([event(1), event(2)])) == [1, 2]
+    assert store.documents['1']['status'] == 'pending'
+    assert deduplicator.claim([event(1)]) == []
+
+    store.expire(1)
+    assert event_ids(deduplicator.claim([event(1), event(2)])) == [1]
+
+
+def test_completed_events_are_dropped_for_good(store, firestore_service):
+    deduplicator = WebhookEventDeduplicator(firestore_service, ttl_seconds=3600)
+    deduplicator.complete(deduplicator.claim([event(1)]))
+
+    assert store.documents['1']['status'] == 'processed'
+    assert deduplicator.accept([event(1)]) == []
+    # another instance has no memory of the event, the processed claim still drops it
+    assert WebhookEventDeduplicator(firestore_service).claim([event(1)]) == []
+
+
+def test_released_events_can_be_claimed_again(store, firestore_service):
+    deduplicator = WebhookEventDeduplicator(firestore_service)
+    deduplicator.claim([event(1)])
+
+    deduplicator.release([event(1)])
+
+    assert store.documents == {}
+    assert event_ids(deduplicator.claim([event(1)])) == [1]
+
+
+def test_memory_is_bounded(firestore_service):
+    deduplicator = WebhookEventDeduplicator(firestore_service, memory_size=2)
+
+    deduplicator.remember([1, 2, 3])
+
+    assert list(deduplicator.recent) == [2, 3]
+
+
+@pytest.fixture
+def route(container, firestore_service):
+    task_service = mock.MagicMock()
+    container.task_service.override(providers.Object(task_service))
+    container.firestore_service.override(providers.Object(firestore_service))
+    container.webhook_event_deduplicator.override(providers.Object(WebhookEventDeduplicator(firestore_service)))
+    return task_service
+
+
+def test_route_marks_events_processed_after_enqueueing(store, route):
+    functions.route_hubspot_events(events=[event(1)])
+    functions.route_hubspot_events(events=[event(1)])
+
+    assert route.enqueue.call_count == 1
+    assert store.documents['1']['status'] == 'processed'
+
+
+def test_route_releases_claims_when_enqueueing_fails(store, route):
+    with mock.patch.object(functions, 'enqueue_hubspot_event_tasks', side_effect=RuntimeError('Cloud Tasks down')):
+        with pytest.raises(RuntimeError):
+            functions.route_hubspot_events(events=[event(1)])
+
+    assert store.documents == {}
+
+
+def test_redelivery_after_a_crash_between_claim_and_enqueue_is_routed(store, route, container, firestore_service):
+    class Killed(BaseException):
+        pass
+
+    # the instance dies mid-request, so neither the release nor the completion runs
+    with mock.patch.object(functions, 'enqueue_hubspot_event_tasks', side_effect=Killed):
+        with pytest.raises(Killed):
+            functions.route_hubspot_events(events=[event(1)])
+    assert store.documents['1']['status'] == 'pending'
+
+    # HubSpot redelivers to a fresh instance once the pending claim has expired
+    container.webhook_event_deduplicator.override(providers.Object(WebhookEventDeduplicator(firestore_service)))
+    store.expire(1)
+    functions.route_hubspot_events(events=[event(1)])
+
+    assert route.enqueue.call_count == 1
+    assert store.documents['1']['status'] == 'processed'